@@ -0,0 +1,199 @@
+import os
+import glob
+import unittest
+import logging
+from unittest.mock import patch
+
+from tlvdb.tlv import TLV
+from tlvdb.tlvindex import IndexJournal
+from tlvdb.tlvstorage import TlvStorage
+from tlvdb.tlverrors import *
+
+lg = logging.getLogger("tests")
+
+
+class TestBatch(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        ROOT = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+        cls.IFILE = "%s/data/batch.idx" % ROOT
+        cls.JFILE = "%s/data/batch.jnl" % ROOT
+        cls.DFILE = "%s/data/batch.0.dat" % ROOT
+        for f in glob.glob("%s/data/batch.*" % ROOT):
+            os.remove(f)
+
+        cls.ts = TlvStorage(cls.IFILE, backfill=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.ts.close()
+
+    def test_0001_create_many(self):
+        first = TestBatch.ts.create(TLV({TLV("key"): TLV("single")}))
+
+        tlvs = [TLV({TLV("key"): TLV(i)}) for i in range(0, 100)]
+        TestBatch.ids = TestBatch.ts.create_many(tlvs)
+
+        self.assertEqual(TestBatch.ids, list(range(first + 1, first + 101)))
+        self.assertEqual(TestBatch.ts.index.nextid, first + 101)
+        self.assertEqual(TestBatch.ts.getHeader().items, 101)
+        self.assertEqual(os.path.getsize(TestBatch.DFILE),
+            sum(len(t.pack()) for t in tlvs) + len(TLV({TLV("key"): TLV("single")}).pack()))
+
+        for i, tid in enumerate(TestBatch.ids):
+            self.assertEqual(TestBatch.ts.read(tid).value[TLV("key")].value, i)
+
+        self.assertEqual(TestBatch.ts.create_many([]), [])
+
+    def test_0002_update_many(self):
+        objs = [TestBatch.ts.read(tid) for tid in TestBatch.ids[0:10]]
+        freed = sum(len(t.pack()) for t in objs[1::2])
+        for i, t in enumerate(objs):
+            # Even ones fit in place, odd ones have to move
+            if i % 2 == 0:
+                t.value[TLV("key")] = TLV(i + 100)
+            else:
+                t.value[TLV("key")] = TLV("moved away %d" % i)
+
+        size = os.path.getsize(TestBatch.DFILE)
+        TestBatch.ts.update_many(objs)
+
+        moved = sum(len(t.pack()) for t in objs[1::2])
+        self.assertEqual(os.path.getsize(TestBatch.DFILE), size + moved)
+
+        for i, tid in enumerate(TestBatch.ids[0:10]):
+            value = TestBatch.ts.read(tid).value[TLV("key")]
+            if i % 2 == 0:
+                self.assertEqual(value.value, i + 100)
+            else:
+                self.assertEqual(value, TLV("moved away %d" % i))
+
+        # The old places of the moved ones are free now
+        empty = TestBatch.ts.index.partitions[0]["empty"]
+        self.assertEqual(sum(empty[p] for p in empty), freed)
+
+    def test_0003_update_many_unknown(self):
+        t = TLV({TLV("key"): TLV(1)})
+        with self.assertRaises(WrongInstanceError):
+            TestBatch.ts.update_many([t])
+
+        t._tlvdb_id = 99999
+        with self.assertRaises(IndexNotFoundError):
+            TestBatch.ts.update_many([t])
+
+    def test_0004_delete_many(self):
+        jsize = os.path.getsize(TestBatch.JFILE)
+
+        deleted = TestBatch.ts.delete_many(TestBatch.ids[50:60] + [99999])
+        self.assertEqual(deleted, TestBatch.ids[50:60])
+
+        for tid in TestBatch.ids[50:60]:
+            with self.assertRaises(IndexNotFoundError):
+                TestBatch.ts.read(tid)
+
+        self.assertEqual(TestBatch.ts.read(TestBatch.ids[60]).value[TLV("key")].value, 60)
+        self.assertTrue(os.path.getsize(TestBatch.JFILE) > jsize)
+
+    def test_0005_reopen(self):
+        TestBatch.ts.close()
+        TestBatch.ts = TlvStorage(TestBatch.IFILE, backfill=True)
+
+        self.assertEqual(TestBatch.ts.getHeader().items, 91)
+        self.assertEqual(TestBatch.ts.read(TestBatch.ids[99]).value[TLV("key")].value, 99)
+        self.assertEqual(TestBatch.ts.index.nextid, TestBatch.ids[99] + 1)
+
+    def test_0006_read_many(self):
+        ids = list(reversed(TestBatch.ids[60:100])) + [TestBatch.ids[0]]
+        tlvs = TestBatch.ts.read_many(ids)
+
+        self.assertEqual([t._tlvdb_id for t in tlvs], ids)
+        for tid, t in zip(ids, tlvs):
+            self.assertEqual(t, TestBatch.ts.read(tid))
+
+        with self.assertRaises(IndexNotFoundError):
+            TestBatch.ts.read_many([TestBatch.ids[50]])
+
+    def test_0007_read_many_large(self):
+        # Records larger than a read chunk spill over the coalesced read
+        big = [TLV({TLV("key"): TLV("x" * (5000 + i))}) for i in range(0, 5)]
+        ids = TestBatch.ts.create_many(big)
+
+        tlvs = TestBatch.ts.read_many(ids + TestBatch.ids[90:95])
+        for t, orig in zip(tlvs, big):
+            self.assertEqual(t.value[TLV("key")], orig.value[TLV("key")])
+        for t, i in zip(tlvs[5:], range(90, 95)):
+            self.assertEqual(t.value[TLV("key")].value, i)
+
+    def test_0008_iread_many(self):
+        # Streamed in storage order
+        pairs = list(TestBatch.ts.iread_many(TestBatch.ids[99:60:-1]))
+        self.assertEqual([tid for tid, t in pairs], TestBatch.ids[61:100])
+        for tid, t in pairs:
+            self.assertEqual(t._tlvdb_id, tid)
+            self.assertEqual(t.value[TLV("key")].value, TestBatch.ids.index(tid))
+
+    def test_0009_scan(self):
+        ts = TestBatch.ts
+        found = list(ts.scan())
+
+        # Everything alive, in physical order
+        self.assertEqual(sorted(tid for tid, t in found), [tid for tid, part, pos in ts.index.range()])
+        positions = [ts.index.get(tid)[1] for tid, t in found]
+        self.assertEqual(positions, sorted(positions))
+        for tid, t in found:
+            self.assertEqual(t._tlvdb_id, tid)
+            self.assertEqual(t, ts.read(tid))
+
+        self.assertEqual(list(ts.scan(partition=0))[0:10], found[0:10])
+
+    def test_0010_scan_concurrent_delete(self):
+        ts = TestBatch.ts
+        scanned = []
+        for tid, t in ts.scan():
+            if not scanned:
+                # Delete one further down
+                ts.delete(TestBatch.ids[99])
+            scanned.append(tid)
+
+        self.assertFalse(TestBatch.ids[99] in scanned)
+        self.assertTrue(TestBatch.ids[98] in scanned)
+
+    def test_0011_scan_where(self):
+        ts = TestBatch.ts
+        found = list(ts.scan(where={"key": 70}))
+        self.assertEqual([tid for tid, t in found], [TestBatch.ids[70]])
+        self.assertEqual(found[0][1], ts.read(TestBatch.ids[70]))
+
+        found = list(ts.scan(where={"key": lambda v: type(v) is int and 80 <= v < 85}))
+        self.assertEqual(sorted(tid for tid, t in found), TestBatch.ids[80:85])
+
+        # Strings come as bytes, the big records spill over the reads
+        self.assertEqual(len(list(ts.scan(where={"key": lambda v: type(v) is bytes and len(v) >= 5000}))), 5)
+        self.assertEqual(list(ts.scan(where={"nokey": 1})), [])
+
+    def test_0012_sizes(self):
+        ts = TestBatch.ts
+        tids = [tid for tid, part, pos in ts.index.range()]
+        for tid in tids:
+            self.assertEqual(ts.index.getSize(tid), len(ts.read(tid).pack()))
+
+        # Shrunk in place, grown and moved
+        objs = ts.read_many(tids[0:2])
+        objs[0].value[TLV("key")] = TLV(1)
+        objs[1].value[TLV("key")] = TLV("y" * 100)
+        ts.update_many(objs)
+        t = ts.read(tids[2])
+        t.value[TLV("key")] = TLV("z" * 100)
+        ts.update(t)
+        for obj in objs + [t]:
+            self.assertEqual(ts.index.getSize(obj._tlvdb_id), len(obj.pack()))
+
+        # Holes are sized from the index, nothing is parsed
+        empty = ts.index.partitions[0]["empty"]
+        freed = sum(empty[p] for p in empty) + ts.index.getSize(tids[3]) + ts.index.getSize(tids[4])
+        with patch.object(TlvStorage, "_sizeAt", side_effect=AssertionError("parsed")):
+            ts.delete(tids[3])
+            ts.delete_many(tids[4:5])
+        self.assertEqual(sum(empty[p] for p in empty), freed)
+        self.assertEqual(ts.index.getSize(tids[3]), None)
@@ -0,0 +1,125 @@
+import os
+import glob
+import random
+import unittest
+import logging
+
+from tlvdb.tlv import TLV
+from tlvdb.tlvindex import IndexHeader, BTreeIndex
+from tlvdb.tlvstorage import TlvStorage
+from tlvdb.tlverrors import *
+
+lg = logging.getLogger("tests")
+
+ROOT = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+
+
+def cleanup(name):
+    for f in glob.glob("%s/data/%s.*" % (ROOT, name)):
+        os.remove(f)
+    return "%s/data/%s.idx" % (ROOT, name)
+
+
+class TestBTree(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.IFILE = cleanup("btree")
+        cls.cache = BTreeIndex.CACHE_PAGES
+        # Make sure pages are evicted and read back
+        BTreeIndex.CACHE_PAGES = 16
+        cls.ts = TlvStorage(cls.IFILE, backfill=True, index_type=IndexHeader.TYPE_BTREE)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.ts.close()
+        BTreeIndex.CACHE_PAGES = cls.cache
+
+    def test_0001_random_order(self):
+        index = TestBTree.ts.index
+        self.assertTrue(isinstance(index, BTreeIndex))
+
+        keys = list(range(1000000, 1020000))
+        random.seed(16)
+        random.shuffle(keys)
+        for key in keys:
+            index._set(0, key, key * 2)
+
+        for key in keys[0:2000]:
+            self.assertEqual(index.get(key), (0, key * 2))
+        self.assertEqual(index.get(999999), (False, None))
+        self.assertEqual(index.get(1020000), (False, None))
+
+        self.assertEqual([tid for tid, part, pos in index.range(1000100, 1000200)],
+            list(range(1000100, 1000200)))
+        self.assertEqual(len(list(index.range(1000000))), 20000)
+
+        for key in keys[0:10000]:
+            index._unset(key)
+        left = sorted(keys[10000:])
+        self.assertEqual([tid for tid, part, pos in index.range(1000000)], left)
+        for key in keys[10000:]:
+            index._unset(key)
+        self.assertEqual(list(index.range()), [])
+
+    def test_0002_storage(self):
+        ts = TestBTree.ts
+        TestBTree.ids = ts.create_many([TLV({TLV("key"): TLV(i)}) for i in range(0, 5000)])
+        TestBTree.ids += [ts.create(TLV({TLV("key"): TLV(i)})) for i in range(5000, 5100)]
+
+        t = ts.read(TestBTree.ids[7])
+        t.value[TLV("key")] = TLV("does not fit in the old place")
+        ts.update(t)
+        ts.delete_many(TestBTree.ids[100:200])
+
+        self.assertEqual(ts.getHeader().items, 5000)
+        self.assertEqual([tid for tid, part, pos in ts.index.range(TestBTree.ids[95], TestBTree.ids[205])],
+            TestBTree.ids[95:100] + TestBTree.ids[200:205])
+
+    def test_0003_reopen(self):
+        TestBTree.ts.close()
+        TestBTree.ts = TlvStorage(TestBTree.IFILE, backfill=True)
+        ts = TestBTree.ts
+
+        # Only the root was read
+        self.assertTrue(isinstance(ts.index, BTreeIndex))
+        self.assertEqual(len(ts.index.cache), 0)
+
+        self.assertEqual(ts.getHeader().items, 5000)
+        self.assertEqual(ts.index.nextid, TestBTree.ids[-1] + 1)
+        self.assertEqual(ts.read(TestBTree.ids[7]).value[TLV("key")],
+            TLV("does not fit in the old place"))
+        self.assertEqual(ts.read(TestBTree.ids[5099]).value[TLV("key")].value, 5099)
+        with self.assertRaises(IndexNotFoundError):
+            ts.read(TestBTree.ids[150])
+
+        tids = [tid for tid, part, pos in ts.index.range()]
+        self.assertEqual(tids, [tid for tid in TestBTree.ids if tid not in TestBTree.ids[100:200]])
+
+    def test_0004_vacuum(self):
+        ts = TestBTree.ts
+        ts.vacuum_thres = 0
+        ts.vacuum(force=True)
+
+        self.assertEqual(len(ts.index.partitions[0]["empty"]), 0)
+        for i in range(0, 5100, 37):
+            if i != 7 and not 100 <= i < 200:
+                self.assertEqual(ts.read(TestBTree.ids[i]).value[TLV("key")].value, i)
+
+
+class TestRange(unittest.TestCase):
+
+    def test_0001_same_order(self):
+        for index_type in (IndexHeader.TYPE_HASH, IndexHeader.TYPE_DISKHASH, IndexHeader.TYPE_BTREE):
+            ts = TlvStorage(cleanup("range%d" % index_type), partitions=2, index_type=index_type)
+            try:
+                ids = ts.create_many([TLV(i) for i in range(0, 100)])
+                ts.delete_many(ids[10:20])
+
+                found = list(ts.index.range(ids[5], ids[25]))
+                self.assertEqual([tid for tid, part, pos in found], ids[5:10] + ids[20:25])
+                for tid, part, pos in found:
+                    self.assertEqual(ts.index.get(tid), (part, pos))
+                self.assertEqual(len(list(ts.index.range())), 90)
+            finally:
+                ts.close()
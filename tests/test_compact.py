@@ -0,0 +1,162 @@
+import os
+import glob
+import time
+import unittest
+import logging
+import threading
+
+from tlvdb.tlv import TLV
+from tlvdb.tlvstorage import TlvStorage
+from tlvdb.tlverrors import *
+
+lg = logging.getLogger("tests")
+
+ROOT = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+
+
+def cleanup(name):
+    for f in glob.glob("%s/data/%s.*" % (ROOT, name)):
+        os.remove(f)
+    return "%s/data/%s.idx" % (ROOT, name)
+
+
+def entry(i):
+    return TLV({TLV("key"): TLV(i), TLV("pad"): TLV("x" * (i % 50))})
+
+
+def value(i):
+    return entry(i).getDecodedValue()
+
+
+class TestCompact(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.IFILE = cleanup("compact_online")
+        cls.DFILE = "%s/data/compact_online.0.dat" % ROOT
+        cls.ts = TlvStorage(cls.IFILE, backfill=True)
+        cls.ids = cls.ts.create_many([entry(i) for i in range(0, 300)])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.ts.close()
+
+    def check(self, ts, gone):
+        for i, tid in enumerate(TestCompact.ids):
+            if i in gone:
+                self.assertEqual(ts.index.get(tid), (False, None))
+            else:
+                self.assertEqual(ts.read(tid).getDecodedValue(), value(i))
+
+    def test_0001_steps(self):
+        ts = TestCompact.ts
+        ts.delete_many(TestCompact.ids[0:300:3])
+        TestCompact.gone = set(range(0, 300, 3))
+        size = os.path.getsize(TestCompact.DFILE)
+
+        # A few bytes per call: it takes many partial steps
+        calls = 1
+        while not ts.compact(io_budget=200, max_bytes=100):
+            calls += 1
+            self.check(ts, TestCompact.gone)
+        self.assertTrue(calls > 10)
+
+        live = sum(len(entry(i).pack()) for i in range(0, 300) if i not in TestCompact.gone)
+        self.assertEqual(os.path.getsize(TestCompact.DFILE), live)
+        self.assertEqual(len(ts.index.partitions[0]["empty"]), 0)
+        self.assertTrue(live < size)
+        self.check(ts, TestCompact.gone)
+
+        # Appends continue at the new end
+        tid = ts.create(entry(1000))
+        self.assertEqual(ts.index.get(tid), (0, live))
+        ts.delete(tid)
+        self.assertTrue(ts.compact())
+
+    def test_0002_bigger_than_gap(self):
+        ts = TestCompact.ts
+        # A small hole right before a large entry
+        small = ts.create(TLV(1))
+        big = ts.create(TLV("y" * 5000))
+        ts.delete(small)
+
+        self.assertTrue(ts.compact())
+        self.assertEqual(ts.read(big), TLV("y" * 5000))
+        self.assertEqual(len(ts.index.partitions[0]["empty"]), 0)
+        ts.delete(big)
+        self.assertTrue(ts.compact())
+        self.check(ts, TestCompact.gone)
+
+    def test_0003_reopen(self):
+        TestCompact.ts.close()
+        TestCompact.ts = TlvStorage(TestCompact.IFILE, backfill=True)
+        self.check(TestCompact.ts, TestCompact.gone)
+        self.assertEqual(len(TestCompact.ts.index.partitions[0]["empty"]), 0)
+
+    def test_0004_background(self):
+        ts = TestCompact.ts
+        ts.delete_many(TestCompact.ids[1:300:3])
+        TestCompact.gone |= set(range(1, 300, 3))
+        alive = [(i, tid) for i, tid in enumerate(TestCompact.ids) if i not in TestCompact.gone]
+        errors = []
+        stop = threading.Event()
+
+        def reader():
+            try:
+                while not stop.is_set():
+                    for i, tid in alive:
+                        if ts.read(tid).getDecodedValue() != value(i):
+                            errors.append(tid)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=reader) for n in range(0, 2)]
+        for t in threads:
+            t.start()
+
+        compactor = ts.startCompactor(interval=0.01, time_budget=0.005)
+        created = [(ts.create(entry(i)), i) for i in range(0, 50)]
+        for n in range(0, 500):
+            if len(ts.index.partitions[0]["empty"]) == 0 and "compact" not in ts.dfds[0]:
+                break
+            time.sleep(0.01)
+
+        stop.set()
+        for t in threads:
+            t.join()
+        compactor.stop()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(ts.index.partitions[0]["empty"]), 0)
+        for tid, i in created:
+            self.assertEqual(ts.read(tid).getDecodedValue(), value(i))
+        self.check(ts, TestCompact.gone)
+
+    def test_0005_transaction(self):
+        ts = TestCompact.ts
+        ts.beginTransaction()
+        try:
+            with self.assertRaises(AlreadyInTranceError):
+                ts.compact()
+        finally:
+            ts.endTransaction()
+
+    def test_0006_mmap(self):
+        ts = TlvStorage(cleanup("compact_mmap"), mmap_reads=True, partitions=2)
+        try:
+            ids = ts.create_many([entry(i) for i in range(0, 100)])
+            ids += ts.create_many([entry(i) for i in range(100, 200)])
+            ts.delete_many(ids[0:200:2])
+            self.assertTrue(ts.compact())
+
+            for i, tid in enumerate(ids):
+                if i % 2:
+                    self.assertEqual(ts.read(tid).getDecodedValue(), value(i))
+
+            # Not truncated under the readers, appends reuse the tail
+            end = ts.getPartitionSize(0)
+            tid = ts.create_many([entry(7)])[0]
+            self.assertEqual(ts.index.get(tid)[1], end)
+            self.assertEqual(ts.read(tid), entry(7))
+        finally:
+            ts.close()
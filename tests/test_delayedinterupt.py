@@ -1,7 +1,7 @@
 import os
 import signal
 from tlvdb.util import DelayedInterrupt
-from mock import Mock
+from unittest.mock import Mock
 import unittest
 
 
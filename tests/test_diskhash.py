@@ -0,0 +1,121 @@
+import os
+import glob
+import unittest
+import logging
+import threading
+
+from tlvdb.tlv import TLV
+from tlvdb.tlvindex import IndexHeader, DiskHashIndex
+from tlvdb.tlvstorage import TlvStorage
+from tlvdb.tlverrors import *
+
+lg = logging.getLogger("tests")
+
+
+class TestDiskHash(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        ROOT = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+        cls.IFILE = "%s/data/diskhash.idx" % ROOT
+        cls.SFILE = "%s/data/diskhash.free" % ROOT
+        for f in glob.glob("%s/data/diskhash.*" % ROOT):
+            os.remove(f)
+
+        cls.ts = TlvStorage(cls.IFILE, backfill=True, partitions=2,
+            index_type=IndexHeader.TYPE_DISKHASH)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.ts.close()
+
+    def test_0001_create(self):
+        ts = TestDiskHash.ts
+        self.assertTrue(isinstance(ts.index, DiskHashIndex))
+        self.assertEqual(ts.getHeader().type, IndexHeader.TYPE_DISKHASH)
+
+        # Enough to resize the table a few times
+        TestDiskHash.ids = ts.create_many([TLV({TLV("key"): TLV(i)}) for i in range(0, 3000)])
+        TestDiskHash.ids.append(ts.create(TLV({TLV("key"): TLV(3000)})))
+
+        self.assertTrue(ts.index.capacity * DiskHashIndex.LOAD >= 3001)
+        self.assertEqual(ts.getHeader().items, 3001)
+        for i in range(0, 3001, 97):
+            self.assertEqual(ts.read(TestDiskHash.ids[i]).value[TLV("key")].value, i)
+        self.assertEqual(ts.index.get(99999), (False, None))
+
+    def test_0002_update_delete(self):
+        ts = TestDiskHash.ts
+        t = ts.read(TestDiskHash.ids[10])
+        t.value[TLV("key")] = TLV("does not fit in the old place")
+        ts.update(t)
+
+        ts.delete_many(TestDiskHash.ids[20:30])
+        for tid in TestDiskHash.ids[20:30]:
+            with self.assertRaises(IndexNotFoundError):
+                ts.read(tid)
+
+        # Deleted slots are reused
+        used = ts.index.used
+        ts.index._set(0, TestDiskHash.ids[20], 0)
+        ts.index._unset(TestDiskHash.ids[20])
+        self.assertEqual(ts.index.used, used)
+        self.assertEqual(ts.getHeader().items, 2991)
+        TestDiskHash.items = [p["items"] for p in ts.index.partitions]
+
+    def test_0003_reopen(self):
+        TestDiskHash.ts.close()
+        TestDiskHash.ts = TlvStorage(TestDiskHash.IFILE, backfill=True)
+        ts = TestDiskHash.ts
+
+        # Nothing was loaded
+        self.assertTrue(isinstance(ts.index, DiskHashIndex))
+        self.assertEqual(len(ts.index.offsets), 0)
+
+        self.assertEqual(ts.getHeader().items, 2991)
+        self.assertEqual(ts.index.nextid, TestDiskHash.ids[-1] + 1)
+        self.assertEqual([p["items"] for p in ts.index.partitions], TestDiskHash.items)
+        self.assertTrue(len(ts.index.partitions[0]["empty"]) > 0)
+        self.assertEqual(ts.read(TestDiskHash.ids[10]).value[TLV("key")],
+            TLV("does not fit in the old place"))
+        with self.assertRaises(IndexNotFoundError):
+            ts.read(TestDiskHash.ids[25])
+
+    def test_0004_concurrent_resize(self):
+        ts = TestDiskHash.ts
+        errors = []
+        stop = threading.Event()
+
+        def reader():
+            while not stop.is_set():
+                for i in range(100, 3000, 211):
+                    try:
+                        if ts.read(TestDiskHash.ids[i]).value[TLV("key")].value != i:
+                            errors.append(i)
+                    except Exception as e:
+                        errors.append(e)
+
+        threads = [threading.Thread(target=reader) for n in range(0, 2)]
+        for t in threads:
+            t.start()
+        try:
+            ids = ts.create_many([TLV(i) for i in range(0, 5000)])
+        finally:
+            stop.set()
+            for t in threads:
+                t.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(ts.read(ids[4999]).value, 4999)
+        TestDiskHash.more = ids
+
+    def test_0005_vacuum(self):
+        ts = TestDiskHash.ts
+        ts.vacuum_thres = 0
+        ts.vacuum(force=True)
+
+        self.assertEqual([len(p["empty"]) for p in ts.index.partitions], [0, 0])
+        for i in range(0, 3001, 101):
+            if not 20 <= i < 30 and i != 10:
+                self.assertEqual(ts.read(TestDiskHash.ids[i]).value[TLV("key")].value, i)
+        self.assertEqual(ts.read(TestDiskHash.more[1234]).value, 1234)
@@ -0,0 +1,110 @@
+import os
+import glob
+import unittest
+import logging
+
+from tlvdb.tlv import TLV
+from tlvdb.tlvindex import FreeSpace
+from tlvdb.tlvstorage import TlvStorage
+from tlvdb.tlverrors import *
+
+lg = logging.getLogger("tests")
+
+
+class TestFreeSpace(unittest.TestCase):
+
+    def test_0001_best_fit(self):
+        f = FreeSpace()
+        f.add(100, 50)
+        f.add(300, 10)
+        f.add(500, 20)
+
+        # smallest that fits, split the remainder
+        self.assertEqual(f.take(15), (500, (515, 5)))
+        self.assertEqual(f.take(10), (300, None))
+        self.assertEqual(f.take(60), None)
+        self.assertEqual(len(f), 2)
+
+    def test_0002_merge(self):
+        f = FreeSpace()
+        f.add(0, 10)
+        f.add(20, 10)
+        removed, hole = f.add(10, 10)
+
+        self.assertEqual(sorted(removed), [0, 20])
+        self.assertEqual(hole, (0, 30))
+        self.assertEqual(list(f.items()), [(0, 30)])
+
+    def test_0003_unknown_size(self):
+        f = FreeSpace()
+        f.add(0, 0)
+        f.add(10, 10)
+        self.assertEqual(len(f), 2)
+        self.assertEqual(f.take(5), (10, (15, 5)))
+        self.assertEqual(f.take(5), (15, None))
+        self.assertEqual(f.take(1), None)
+
+    def test_0004_load(self):
+        f = FreeSpace()
+        f.load([(300, 10), (0, 0), (100, 50), (500, 20)])
+
+        self.assertEqual(len(f), 4)
+        self.assertEqual(f.offsets, [100, 300, 500])
+        self.assertEqual(f.take(15), (500, (515, 5)))
+        self.assertEqual(f.add(290, 10)[1], (290, 20))
+
+
+class TestBackfill(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        ROOT = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+        cls.IFILE = "%s/data/backfill.idx" % ROOT
+        for f in glob.glob("%s/data/backfill.*" % ROOT):
+            os.remove(f)
+
+        cls.ts = TlvStorage(cls.IFILE, backfill=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.ts.close()
+
+    def test_0001_reuse_hole(self):
+        ts = TestBackfill.ts
+        ids = [ts.create(TLV({TLV("key"): TLV("value%d" % i)})) for i in range(0, 4)]
+        end = ts._getDataFileEnd(0)
+
+        _, pos = ts.index.get(ids[1])
+        ts.delete(ids[1])
+
+        tid = ts.create(TLV({TLV("key"): TLV("valueX")}))
+        self.assertEqual(ts.index.get(tid), (0, pos))
+        self.assertEqual(ts._getDataFileEnd(0), end)
+        self.assertEqual(len(ts.index.partitions[0]["empty"]), 0)
+        TestBackfill.ids = ids
+
+    def test_0002_merge_and_split(self):
+        ts = TestBackfill.ts
+        _, pos = ts.index.get(TestBackfill.ids[2])
+        ts.delete(TestBackfill.ids[2])
+        ts.delete(TestBackfill.ids[3])
+
+        empty = ts.index.partitions[0]["empty"]
+        self.assertEqual(list(empty.items()), [(pos, 2 * 15)])
+
+        tid = ts.create(TLV("0123456789"))
+        self.assertEqual(ts.index.get(tid), (0, pos))
+        self.assertEqual(list(empty.items()), [(pos + 12, 18)])
+        TestBackfill.hole = (pos + 12, 18)
+
+    def test_0003_reload(self):
+        ts = TestBackfill.ts
+        ts.close()
+        TestBackfill.ts = ts = TlvStorage(TestBackfill.IFILE, backfill=True)
+        self.assertEqual(list(ts.index.partitions[0]["empty"].items()), [TestBackfill.hole])
+        ts.index.checkpoint()
+        ts.close()
+
+        TestBackfill.ts = ts = TlvStorage(TestBackfill.IFILE, backfill=True)
+        self.assertEqual(list(ts.index.partitions[0]["empty"].items()), [TestBackfill.hole])
+        self.assertEqual(ts.read(TestBackfill.ids[0]).value[TLV("key")], TLV("value0"))
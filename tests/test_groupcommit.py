@@ -0,0 +1,146 @@
+import os
+import glob
+import unittest
+import logging
+import threading
+from unittest.mock import patch
+
+from tlvdb.tlv import TLV
+from tlvdb.tlvstorage import TlvStorage
+from tlvdb.tlverrors import *
+
+lg = logging.getLogger("tests")
+
+ROOT = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+
+
+def cleanup(name):
+    for f in glob.glob("%s/data/%s.*" % (ROOT, name)):
+        os.remove(f)
+    return "%s/data/%s.idx" % (ROOT, name)
+
+
+def entry(i):
+    return TLV({TLV("key"): TLV(i), TLV("pad"): TLV("x" * (i % 30))})
+
+
+def writers(ts, threads=8, count=50):
+    """
+    Create, update and delete from many threads, return the surviving
+    {id: number}
+    """
+    found = {}
+    lock = threading.Lock()
+
+    def writer(n):
+        for i in range(n * count, (n + 1) * count):
+            tid = ts.create(entry(i))
+            if i % 5 == 0:
+                t = ts.read(tid)
+                t.value[TLV("pad")] = TLV("moved away %d" % i)
+                ts.update(t)
+            if i % 7 == 0:
+                ts.delete(tid)
+                continue
+            with lock:
+                found[tid] = i
+
+    ts_threads = [threading.Thread(target=writer, args=(n,)) for n in range(0, threads)]
+    for t in ts_threads:
+        t.start()
+    for t in ts_threads:
+        t.join()
+    return found
+
+
+class TestGroupCommit(unittest.TestCase):
+
+    def check(self, ts, found):
+        for tid, i in found.items():
+            value = ts.read(tid).value
+            self.assertEqual(value[TLV("key")].getDecodedValue(), i)
+            if i % 5 == 0:
+                self.assertEqual(value[TLV("pad")], TLV("moved away %d" % i))
+
+    def test_0001_flush(self):
+        path = cleanup("group_flush")
+        ts = TlvStorage(path, backfill=True, partitions=2)
+        committer = ts.startGroupCommit(interval=0.05)
+        self.assertTrue(ts.startGroupCommit() is committer)
+
+        with patch.object(TlvStorage, "_flushIndex", wraps=ts._flushIndex) as flush:
+            found = writers(ts)
+        # Writers shared the rounds
+        self.assertTrue(0 < flush.call_count == committer.rounds < 400)
+        self.check(ts, found)
+
+        # Handed to the OS when the writers returned
+        other = TlvStorage(path)
+        try:
+            self.check(other, found)
+        finally:
+            other.close()
+
+        ts.close()
+        self.assertFalse(committer.is_alive())
+        ts = TlvStorage(path)
+        try:
+            self.check(ts, found)
+        finally:
+            ts.close()
+
+    def test_0002_fsync(self):
+        ts = TlvStorage(cleanup("group_fsync"), partitions=2)
+        try:
+            committer = ts.startGroupCommit("fsync", interval=0.05, batch=4)
+            with patch.object(os, "fsync", wraps=os.fsync) as fsync:
+                found = writers(ts, threads=4, count=20)
+            # Partitions, index and journal once per round
+            self.assertTrue(fsync.call_count <= 4 * committer.rounds)
+            self.assertTrue(committer.rounds < 80)
+            self.check(ts, found)
+        finally:
+            ts.close()
+
+    def test_0003_none(self):
+        path = cleanup("group_none")
+        ts = TlvStorage(path)
+        committer = ts.startGroupCommit("none", interval=10)
+
+        # Nothing waits for the round
+        tid = ts.create(entry(1))
+        self.assertEqual(committer.rounds, 0)
+        self.assertEqual(ts.read(tid), entry(1))
+
+        # The last round runs on close
+        ts.close()
+        self.assertEqual(committer.rounds, 1)
+        ts = TlvStorage(path)
+        try:
+            self.assertEqual(ts.read(tid).getDecodedValue(), entry(1).getDecodedValue())
+        finally:
+            ts.close()
+
+    def test_0004_transaction(self):
+        ts = TlvStorage(cleanup("group_trance"))
+        try:
+            committer = ts.startGroupCommit(interval=10)
+            ts.beginTransaction()
+            try:
+                with patch.object(committer, "commit", side_effect=AssertionError("committed")):
+                    ids = ts.create_many([entry(i) for i in range(0, 10)])
+                    ts.delete(ids[0])
+            finally:
+                ts.endTransaction()
+            self.assertEqual(committer.rounds, 0)
+        finally:
+            ts.close()
+
+    def test_0005_durability(self):
+        ts = TlvStorage(cleanup("group_durability"))
+        try:
+            with self.assertRaises(DurabilityError):
+                ts.startGroupCommit("sometimes")
+            self.assertTrue(ts.committer is None)
+        finally:
+            ts.close()
@@ -0,0 +1,167 @@
+import os
+import glob
+import struct
+import unittest
+import logging
+from unittest.mock import patch
+
+from tlvdb.tlv import TLV
+from tlvdb.tlvindex import IndexHeader, IndexEntry, IndexJournal
+from tlvdb.tlvstorage import TlvStorage
+from tlvdb.tlverrors import *
+
+lg = logging.getLogger("tests")
+
+
+class TestJournal(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        ROOT = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+        cls.IFILE = "%s/data/journal.idx" % ROOT
+        cls.JFILE = "%s/data/journal.jnl" % ROOT
+        for f in glob.glob("%s/data/journal.*" % ROOT):
+            os.remove(f)
+
+        cls.ts = TlvStorage(cls.IFILE)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.ts.close()
+
+    def test_0001_create_appends(self):
+        idx_size = os.path.getsize(TestJournal.IFILE)
+
+        TestJournal.ids = []
+        for i in range(0, 10):
+            TestJournal.ids.append(TestJournal.ts.create(TLV({TLV("key"): TLV(i)})))
+
+        # Only the journal grows, one record per create
+        self.assertEqual(os.path.getsize(TestJournal.IFILE), idx_size)
+        self.assertEqual(os.path.getsize(TestJournal.JFILE), 10 * IndexJournal.LENGTH)
+
+    def test_0002_delete_update_appends(self):
+        TestJournal.ts.delete(TestJournal.ids[0])
+
+        t = TestJournal.ts.read(TestJournal.ids[1])
+        t.value[TLV("key")] = TLV("does not fit in the old place")
+        TestJournal.ts.update(t)
+
+        # delete + empty, update + empty
+        self.assertEqual(os.path.getsize(TestJournal.JFILE), 14 * IndexJournal.LENGTH)
+
+    def test_0003_replay(self):
+        TestJournal.ts.close()
+        TestJournal.ts = TlvStorage(TestJournal.IFILE)
+
+        with self.assertRaises(IndexNotFoundError):
+            TestJournal.ts.read(TestJournal.ids[0])
+
+        t = TestJournal.ts.read(TestJournal.ids[1])
+        self.assertEqual(t.value[TLV("key")], TLV("does not fit in the old place"))
+
+        t = TestJournal.ts.read(TestJournal.ids[-1])
+        self.assertEqual(t.value[TLV("key")], TLV(9))
+
+        self.assertEqual(TestJournal.ts.getHeader().items, 9)
+        self.assertEqual(TestJournal.ts.index.nextid, TestJournal.ids[-1] + 1)
+        self.assertEqual(len(TestJournal.ts.index.partitions[0]["empty"]), 2)
+
+    def test_0004_checkpoint(self):
+        TestJournal.ts.index.checkpoint()
+        self.assertEqual(os.path.getsize(TestJournal.JFILE), 0)
+        self.assertEqual(os.path.getsize(TestJournal.IFILE),
+            IndexHeader.LENGTH + 11 * IndexEntry.LENGTH)
+
+        TestJournal.ts.close()
+        TestJournal.ts = TlvStorage(TestJournal.IFILE)
+        t = TestJournal.ts.read(TestJournal.ids[-1])
+        self.assertEqual(t.value[TLV("key")], TLV(9))
+        self.assertEqual(TestJournal.ts.getHeader().items, 9)
+
+    def test_0005_upgrade_version(self):
+        TestJournal.ts.close()
+
+        # Rewrite it as a version 2 database, entries without sizes
+        with open(TestJournal.IFILE, "r+b") as f:
+            f.write(b"\x02")
+            f.seek(IndexHeader.LENGTH)
+            entries = list(struct.iter_unpack(IndexEntry.FORMAT, f.read()))
+            f.seek(IndexHeader.LENGTH)
+            f.truncate()
+            for part, key, offset, size in entries:
+                f.write(struct.pack(IndexEntry.V2_FORMAT, part, key, offset))
+
+        # ... with a version 2 journal record
+        with open(TestJournal.JFILE, "wb") as f:
+            f.write(IndexJournal.V2_RECORD.pack(IndexJournal.OP_DEL, 0, TestJournal.ids[2], 0))
+
+        TestJournal.ts = TlvStorage(TestJournal.IFILE)
+        ts = TestJournal.ts
+        self.assertEqual(ts.getHeader().version, IndexHeader.VERSION)
+        self.assertEqual(ts.read(TestJournal.ids[-1]).value[TLV("key")], TLV(9))
+        self.assertEqual(ts.index.get(TestJournal.ids[2]), (False, None))
+        self.assertEqual(os.path.getsize(TestJournal.JFILE), 0)
+
+        # The sizes were measured and stored
+        for tid in TestJournal.ids[3:]:
+            self.assertEqual(ts.index.getSize(tid), len(ts.read(tid).pack()))
+        ts.close()
+        TestJournal.ts = TlvStorage(TestJournal.IFILE)
+        self.assertEqual(TestJournal.ts.index.getSize(TestJournal.ids[-1]),
+            len(TLV({TLV("key"): TLV(9)}).pack()))
+
+        TestJournal.ts.close()
+        with open(TestJournal.IFILE, "r+b") as f:
+            f.write(b"\xff")
+
+        with self.assertRaises(UnsupportedVersionError):
+            TlvStorage(TestJournal.IFILE)
+
+        with open(TestJournal.IFILE, "r+b") as f:
+            f.write(struct.pack("<B", IndexHeader.VERSION))
+        TestJournal.ts = TlvStorage(TestJournal.IFILE)
+
+    def test_0006_update_transaction(self):
+        ts = TestJournal.ts
+        tid = TestJournal.ids[-1]
+        t = ts.read(tid)
+        t.value[TLV("key")] = TLV("grown, moved away")
+
+        ts.beginTransaction()
+        try:
+            with patch.object(TlvStorage, "_flushData", side_effect=AssertionError("flushed")), \
+                    patch.object(ts.index, "flush", side_effect=AssertionError("flushed")):
+                ts.update(t)
+                self.assertEqual(ts.read(tid).value[TLV("key")], TLV("grown, moved away"))
+        finally:
+            ts.endTransaction()
+
+        ts.close()
+        TestJournal.ts = TlvStorage(TestJournal.IFILE)
+        self.assertEqual(TestJournal.ts.read(tid).value[TLV("key")], TLV("grown, moved away"))
+
+    def test_0007_update_in_place(self):
+        ts = TestJournal.ts
+        tid = TestJournal.ids[-1]
+        t = ts.read(tid)
+        pos = ts.index.get(tid)
+        jsize = os.path.getsize(TestJournal.JFILE)
+
+        # Same size: nothing is read back, the index is left alone
+        t.value[TLV("key")] = TLV("GROWN, MOVED AWAY")
+        with patch.object(TlvStorage, "read", side_effect=AssertionError("read")), \
+                patch.object(TlvStorage, "_sizeAt", side_effect=AssertionError("parsed")), \
+                patch.object(ts.index, "flush", wraps=ts.index.flush) as flush:
+            ts.update(t)
+        self.assertEqual(flush.call_count, 0)
+        self.assertEqual(os.path.getsize(TestJournal.JFILE), jsize)
+        self.assertEqual(ts.index.get(tid), pos)
+        self.assertEqual(ts.read(tid).value[TLV("key")], TLV("GROWN, MOVED AWAY"))
+
+        # Smaller: in place, only the entry is journaled
+        t.value[TLV("key")] = TLV("shrunk")
+        ts.update(t)
+        self.assertEqual(ts.index.get(tid), pos)
+        self.assertEqual(ts.index.getSize(tid), len(t.pack()))
+        self.assertEqual(os.path.getsize(TestJournal.JFILE), jsize + IndexJournal.LENGTH)
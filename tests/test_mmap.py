@@ -0,0 +1,86 @@
+import os
+import glob
+import unittest
+import logging
+from threading import Thread
+
+from tlvdb.tlv import TLV
+from tlvdb.tlvstorage import TlvStorage
+from tlvdb.tlverrors import *
+
+lg = logging.getLogger("tests")
+
+
+class TestMmap(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        ROOT = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+        cls.IFILE = "%s/data/mmap.idx" % ROOT
+        for f in glob.glob("%s/data/mmap.*" % ROOT):
+            os.remove(f)
+
+        cls.ts = TlvStorage(cls.IFILE, mmap_reads=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.ts.close()
+
+    def test_0001_read_unflushed(self):
+        ts = TestMmap.ts
+        ts.beginTransaction()
+        TestMmap.ids = [ts.create(TLV({TLV("key"): TLV(i)})) for i in range(0, 100)]
+
+        # Still in the buffer, the read has to flush and map
+        t = ts.read(TestMmap.ids[-1])
+        self.assertEqual(t.value[TLV("key")], TLV(99))
+        ts.endTransaction()
+
+        self.assertIsNotNone(ts.dfds[0]["map"])
+
+    def test_0002_read_after_growth(self):
+        ts = TestMmap.ts
+        t = ts.read(TestMmap.ids[0])
+        t.value[TLV("key")] = TLV("this does not fit anymore")
+        ts.update(t)
+
+        t = ts.read(TestMmap.ids[0])
+        self.assertEqual(t.value[TLV("key")], TLV("this does not fit anymore"))
+
+    def test_0003_read_after_vacuum(self):
+        ts = TestMmap.ts
+        ts.delete(TestMmap.ids[1])
+        ts.vacuum(force=True)
+
+        for i, tid in enumerate(TestMmap.ids[2:]):
+            self.assertEqual(ts.read(tid).value[TLV("key")], TLV(i + 2))
+
+    def test_0004_concurrent(self):
+        ts = TestMmap.ts
+        errors = []
+
+        def reader():
+            try:
+                for j in range(0, 5):
+                    for i, tid in enumerate(TestMmap.ids[2:]):
+                        self.assertEqual(ts.read(tid).value[TLV("key")], TLV(i + 2))
+            except Exception as e:
+                errors.append(e)
+
+        readers = [Thread(target=reader) for i in range(0, 4)]
+        for r in readers:
+            r.start()
+
+        for i in range(0, 50):
+            ts.create(TLV({TLV("other"): TLV(i)}))
+            tid = TestMmap.ids[2 + i]
+            t = ts.read(tid)
+            t.value[TLV("key")] = TLV(i + 2)
+            ts.update(t)
+            if i % 10 == 0:
+                ts.vacuum(force=True)
+
+        for r in readers:
+            r.join()
+
+        self.assertEqual(errors, [])
@@ -4,7 +4,8 @@ import unittest
 import logging as lg
 
 import tlvdb.util as util
-from tlvdb.tlv import IPackable
+from tlvdb import tlv
+from tlvdb.tlv import IPackable, packable
 from tlvdb.tlverrors import *
 from tlvdb.tlvstorage import TlvStorage
 
@@ -18,6 +19,16 @@ class Person(IPackable):
         self.age = age
 
 
+@packable
+class Employee(Person):
+
+    packaged = ["name", "numbers", "age", "company"]
+
+    def __init__(self, name="", numbers=[], age=-1, company=""):
+        super(Employee, self).__init__(name, numbers, age)
+        self.company = company
+
+
 class TestODB(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -40,3 +51,74 @@ class TestODB(unittest.TestCase):
     def test_0002_read(self):
         p = TestODB.ts.read(TestODB.pid, klass=Person)
         lg.debug("Got %s" % p)
+        self.assertEqual(p.name, b"Andreas")
+        self.assertEqual(p.numbers, [b"0712312312", b"0897408123"])
+        self.assertEqual(p.age, 30)
+
+    def test_0003_pack_compat(self):
+        p = Person("Andreas", ["0712312312", "0897408123"], 30)
+        self.assertEqual(bytes(p.pack()), bytes(p.toTLV().pack()))
+
+    def test_0004_schema(self):
+        self.assertIsNot(Person.schema(), Employee.schema())
+        self.assertIs(Person.schema(), Person.schema())
+        self.assertEqual(Employee.schema().attrs, Employee.packaged)
+
+        e = Employee("Andreas", ["0712312312"], 30, "ACME")
+        data = e.pack()
+        self.assertEqual(bytes(data), bytes(e.toTLV().pack()))
+        self.assertEqual(bytes(tlv.dumps([e])), b"T\x01" + bytes(data))
+
+        e2 = Employee().unpackFrom(b"..." + bytes(data), 3)
+        self.assertEqual(e2._tlvdb_size, len(data))
+        self.assertEqual((e2.name, e2.numbers, e2.age, e2.company),
+            (b"Andreas", [b"0712312312"], 30, b"ACME"))
+
+    def test_0005_schema_missing_attr(self):
+        # A Person record read as an Employee keeps the default company
+        pid = TestODB.ts.create(Person("Bob", [], 40))
+        e = TestODB.ts.read(pid, klass=Employee)
+        self.assertEqual((e.name, e.age, e.company), (b"Bob", 40, ""))
+
+        p = Person("Bob")
+        del p.numbers
+        self.assertEqual(Person().unpackFrom(p.pack()).numbers, [])
+
+    def test_0006_large_record(self):
+        p = Person("A" * 1000, ["%010d" % i for i in range(0, 500)], 30)
+        pid = TestODB.ts.create(p)
+        p2 = TestODB.ts.read(pid, klass=Person)
+        self.assertEqual(p2.name, b"A" * 1000)
+        self.assertEqual(len(p2.numbers), 500)
+        self.assertEqual(p2.numbers[499], b"0000000499")
+
+    def test_0007_fields(self):
+        p = Person("B" * 10, ["%010d" % i for i in range(0, 5000)], 31)
+        pid = TestODB.ts.create(p)
+
+        p2 = TestODB.ts.read(pid, klass=Person, fields=["name"])
+        self.assertEqual((p2.name, p2.numbers, p2.age), (b"B" * 10, [], -1))
+        p2 = TestODB.ts.read(pid, klass=Person, fields=["age", "name"])
+        self.assertEqual((p2.name, p2.age), (b"B" * 10, 31))
+
+        # Partial objects are not written back
+        with self.assertRaises(WrongInstanceError):
+            TestODB.ts.update(p2)
+
+        t = TestODB.ts.read(pid, fields=["age", "missing"])
+        self.assertEqual(t.getDecodedValue(), {b"age": 31})
+
+    def test_0008_lazy(self):
+        pid = TestODB.ts.create(Person("Lazy", ["%010d" % i for i in range(0, 500)], 32))
+        t = TestODB.ts.read(pid, klass=tlv.LazyTLV)
+
+        self.assertEqual(t["age"].value, 32)
+        self.assertEqual(len(t._pending), 2)
+        self.assertTrue("numbers" in t)
+        self.assertEqual(t.get("missing"), None)
+
+        # Everything is decoded when needed as a whole
+        self.assertEqual(t, TestODB.ts.read(pid))
+        self.assertEqual(len(t._pending), 0)
+        TestODB.ts.update(t)
+        self.assertEqual(TestODB.ts.read(pid, klass=Person).numbers[499], b"0000000499")
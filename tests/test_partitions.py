@@ -0,0 +1,280 @@
+import os
+import glob
+import unittest
+import logging
+import threading
+
+from tlvdb.tlv import TLV
+from tlvdb.tlvstorage import TlvStorage
+from tlvdb.tlvpolicy import HashPolicy, RolloverPolicy, LeastFragmentedPolicy
+from tlvdb.tlverrors import *
+
+lg = logging.getLogger("tests")
+
+ROOT = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+
+
+def cleanup(name):
+    for f in glob.glob("%s/data/%s.*" % (ROOT, name)):
+        os.remove(f)
+    return "%s/data/%s.idx" % (ROOT, name)
+
+
+class TestPartitions(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.IFILE = cleanup("parts")
+        cls.ts = TlvStorage(cls.IFILE, backfill=True, partitions=3)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.ts.close()
+
+    def test_0001_round_robin(self):
+        self.assertEqual(TestPartitions.ts.getHeader().partitions, 3)
+
+        TestPartitions.ids = [TestPartitions.ts.create(TLV({TLV("key"): TLV(i)}))
+            for i in range(0, 30)]
+
+        for part, cont in enumerate(TestPartitions.ts.index.partitions):
+            self.assertEqual(cont["items"], 10)
+            self.assertTrue(os.path.getsize("%s/data/parts.%d.dat" % (ROOT, part)) > 0)
+
+        for i, tid in enumerate(TestPartitions.ids):
+            self.assertEqual(TestPartitions.ts.read(tid).value[TLV("key")].value, i)
+
+    def test_0002_add_partition(self):
+        self.assertEqual(TestPartitions.ts.addPartition(), 3)
+        TestPartitions.ids.extend(TestPartitions.ts.create_many(
+            [TLV({TLV("key"): TLV(i)}) for i in range(30, 34)]))
+
+        self.assertEqual(TestPartitions.ts.index.partitions[3]["items"], 4)
+        self.assertEqual(TestPartitions.ts.getHeader().items, 34)
+
+    def test_0003_update_delete(self):
+        t = TestPartitions.ts.read(TestPartitions.ids[4])
+        part = TestPartitions.ts.index.get(t._tlvdb_id)[0]
+        t.value[TLV("key")] = TLV("does not fit in the old place")
+        TestPartitions.ts.update(t)
+
+        # Moves stay in their partition
+        self.assertEqual(TestPartitions.ts.index.get(t._tlvdb_id)[0], part)
+        TestPartitions.ts.delete(TestPartitions.ids[5])
+
+    def test_0004_vacuum(self):
+        TestPartitions.ts.vacuum(force=True)
+        self.assertEqual(glob.glob("%s/data/parts.*.swp" % ROOT), [])
+
+        self.assertEqual(TestPartitions.ts.read(TestPartitions.ids[4]).value[TLV("key")],
+            TLV("does not fit in the old place"))
+        for i, tid in enumerate(TestPartitions.ids):
+            if i not in (4, 5):
+                self.assertEqual(TestPartitions.ts.read(tid).value[TLV("key")].value, i)
+
+    def test_0005_reopen(self):
+        TestPartitions.ts.close()
+        TestPartitions.ts = TlvStorage(TestPartitions.IFILE, backfill=True)
+
+        self.assertEqual(len(TestPartitions.ts.dfds), 4)
+        self.assertEqual(TestPartitions.ts.getHeader().items, 33)
+        with self.assertRaises(IndexNotFoundError):
+            TestPartitions.ts.read(TestPartitions.ids[5])
+        self.assertEqual(TestPartitions.ts.read(TestPartitions.ids[33]).value[TLV("key")].value, 33)
+
+    def test_0006_parallel_writers(self):
+        ts = TestPartitions.ts
+        created = []
+
+        def writer(n):
+            for i in range(0, 100):
+                created.append((ts.create(TLV({TLV("key"): TLV("w%d-%d" % (n, i))})), n, i))
+
+        threads = [threading.Thread(target=writer, args=(n,)) for n in range(0, 4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(set(tid for tid, n, i in created)), 400)
+        for tid, n, i in created:
+            self.assertEqual(ts.read(tid).value[TLV("key")], TLV("w%d-%d" % (n, i)))
+
+
+class TestPolicies(unittest.TestCase):
+
+    def test_0001_hash(self):
+        ts = TlvStorage(cleanup("policy_hash"), partitions=4, policy=HashPolicy())
+        try:
+            for i in range(0, 20):
+                tid = ts.create(TLV(i))
+                self.assertEqual(ts.index.get(tid)[0], tid % 4)
+        finally:
+            ts.close()
+
+    def test_0002_rollover(self):
+        ts = TlvStorage(cleanup("policy_roll"), policy=RolloverPolicy(100))
+        try:
+            ids = [ts.create(TLV("x" * 40)) for i in range(0, 10)]
+
+            # Two 42 byte entries per partition
+            self.assertEqual(len(ts.dfds), 5)
+            for part in range(0, 5):
+                self.assertEqual(ts.getPartitionSize(part), 84)
+            for tid in ids:
+                self.assertEqual(ts.read(tid), TLV("x" * 40))
+        finally:
+            ts.close()
+
+    def test_0003_least_fragmented(self):
+        ts = TlvStorage(cleanup("policy_frag"), partitions=2, policy=LeastFragmentedPolicy())
+        try:
+            first = ts.create(TLV(1))
+            self.assertEqual(ts.index.get(first)[0], 0)
+
+            ts.delete(first)
+            for i in range(0, 3):
+                self.assertEqual(ts.index.get(ts.create(TLV(i)))[0], 1)
+        finally:
+            ts.close()
+
+
+class TestLocations(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.IFILE = cleanup("locations")
+        cls.ts = TlvStorage(cls.IFILE, partitions=3, vacuum_thres=0)
+        cls.ids = cls.ts.create_many([TLV({TLV("key"): TLV(i)}) for i in range(0, 30)])
+        cls.ids += [cls.ts.create(TLV({TLV("key"): TLV(i)})) for i in range(30, 60)]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.ts.close()
+
+    def test_0001_get(self):
+        ts = TestLocations.ts
+        for tid in TestLocations.ids:
+            part, pos = ts.index.get(tid)
+            self.assertTrue((pos, tid) in ts.index.entries(part))
+
+        self.assertEqual(ts.index.get(99999), (False, None))
+        self.assertEqual(sum(len(ts.index.entries(p)) for p in range(0, 3)), 60)
+        self.assertEqual([cont["items"] for cont in ts.index.partitions],
+            [len(ts.index.entries(p)) for p in range(0, 3)])
+
+    def test_0002_read_without_index_lock(self):
+        ts = TestLocations.ts
+        locked = threading.Event()
+        done = threading.Event()
+
+        def holder():
+            with ts.index.lock:
+                locked.set()
+                done.wait(10)
+
+        t = threading.Thread(target=holder)
+        t.start()
+        locked.wait()
+        try:
+            self.assertEqual(ts.read(TestLocations.ids[42]).value[TLV("key")].value, 42)
+            self.assertEqual(len(ts.read_many(TestLocations.ids)), 60)
+        finally:
+            done.set()
+            t.join()
+
+    def test_0003_read_while_vacuum(self):
+        ts = TestLocations.ts
+        ts.delete_many(TestLocations.ids[0:60:3])
+        alive = [(i, tid) for i, tid in enumerate(TestLocations.ids) if i % 3]
+        errors = []
+
+        def reader():
+            try:
+                for n in range(0, 5):
+                    for i, tid in alive:
+                        if ts.read(tid).value[TLV("key")].value != i:
+                            errors.append(tid)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=reader) for n in range(0, 3)]
+        for t in threads:
+            t.start()
+        for n in range(0, 5):
+            ts.vacuum(force=True)
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+
+    def test_0004_reopen(self):
+        TestLocations.ts.close()
+        TestLocations.ts = TlvStorage(TestLocations.IFILE)
+        ts = TestLocations.ts
+
+        self.assertEqual(ts.getHeader().items, 40)
+        for i, tid in enumerate(TestLocations.ids):
+            if i % 3:
+                self.assertEqual(ts.read(tid).value[TLV("key")].value, i)
+            else:
+                self.assertEqual(ts.index.get(tid), (False, None))
+
+
+class TestCompactIndex(unittest.TestCase):
+
+    def test_0001_memory(self):
+        ts = TlvStorage(cleanup("compact"), partitions=2)
+        try:
+            ids = ts.create_many([TLV(i) for i in range(0, 10000)])
+            ts.delete(ids[10])
+
+            index = ts.index
+            self.assertEqual(index.get(ids[10]), (False, None))
+            self.assertEqual(index.get(ids[-1] + 100000), (False, None))
+            self.assertEqual(index.countItems(), 9999)
+
+            # About 9 bytes per ID
+            used = index.offsets.buffer_info()[1] * index.offsets.itemsize + len(index.parts)
+            self.assertTrue(used < 10000 * 9 * 2)
+            self.assertEqual(len(index.parts), len(index.offsets))
+        finally:
+            ts.close()
+
+        ts = TlvStorage("%s/data/compact.idx" % ROOT)
+        try:
+            self.assertEqual(ts.getHeader().items, 9999)
+            self.assertEqual(ts.read(ids[-1]).value, 9999)
+            with self.assertRaises(IndexNotFoundError):
+                ts.read(ids[10])
+        finally:
+            ts.close()
+
+    def test_0002_bulk_load(self):
+        IFILE = cleanup("bulk")
+        ts = TlvStorage(IFILE, backfill=True, partitions=3)
+        try:
+            ids = ts.create_many([TLV("x" * (i % 7)) for i in range(0, 300)])
+            ids += [ts.create(TLV(i)) for i in range(0, 30)]
+            ts.delete_many(ids[0:300:4])
+            ts.index.checkpoint()
+
+            locations = [ts.index.get(tid) for tid in ids]
+            empty = [dict(p["empty"].items()) for p in ts.index.partitions]
+            items = [p["items"] for p in ts.index.partitions]
+        finally:
+            ts.close()
+
+        # A torn entry at the end is ignored
+        with open(IFILE, "ab") as f:
+            f.write(b"\x01\x02\x03")
+
+        ts = TlvStorage(IFILE, backfill=True)
+        try:
+            self.assertEqual([ts.index.get(tid) for tid in ids], locations)
+            self.assertEqual([dict(p["empty"].items()) for p in ts.index.partitions], empty)
+            self.assertEqual([p["items"] for p in ts.index.partitions], items)
+            self.assertEqual(ts.index.nextid, ids[-1] + 1)
+            self.assertEqual(ts.read(ids[299]), TLV("x" * (299 % 7)))
+        finally:
+            ts.close()
@@ -0,0 +1,104 @@
+import os
+import glob
+import unittest
+import logging
+
+from tlvdb.tlv import TLV, IPackable
+from tlvdb.tlvindex import SecondaryIndex
+from tlvdb.tlvstorage import TlvStorage
+from tlvdb.tlverrors import *
+
+lg = logging.getLogger("tests")
+
+
+class Person(IPackable):
+
+    packaged = ["name", "numbers", "age"]
+    indexed = ["name", "age"]
+
+    def __init__(self, name="", numbers=[], age=-1):
+        self.name = name
+        self.numbers = numbers
+        self.age = age
+
+
+class TestSecondary(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        ROOT = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+        cls.IFILE = "%s/data/secondary.idx" % ROOT
+        cls.SFILE = "%s/data/secondary.Person.sdx" % ROOT
+        for f in glob.glob("%s/data/secondary.*" % ROOT):
+            os.remove(f)
+
+        cls.ts = TlvStorage(cls.IFILE)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.ts.close()
+
+    def test_0001_create(self):
+        ts = TestSecondary.ts
+        TestSecondary.ids = ts.create_many([Person("p%d" % (i % 10), ["07%d" % i], i) for i in range(0, 100)])
+        TestSecondary.ids.append(ts.create(Person("Andreas", [], 30)))
+
+        # Plain TLVs are not indexed
+        ts.create(TLV({TLV("name"): TLV("Andreas")}))
+        self.assertEqual(list(ts.secondary), ["Person"])
+        self.assertTrue(os.path.getsize(TestSecondary.SFILE) > 0)
+
+    def test_0002_find(self):
+        ts = TestSecondary.ts
+        found = ts.find(Person, name="p3")
+        self.assertEqual([p.age for p in found], list(range(3, 100, 10)))
+
+        found = ts.find(Person, name="Andreas", age=30)
+        self.assertEqual([p._tlvdb_id for p in found], [TestSecondary.ids[100]])
+        self.assertEqual(ts.find(Person, name="Andreas", age=31), [])
+
+        # numbers is not indexed, only filtered
+        self.assertEqual(len(ts.find(Person, name="p3", numbers=[b"0713"])), 1)
+        with self.assertRaises(NotIndexedError):
+            ts.find(Person, numbers=[])
+
+    def test_0003_range(self):
+        ts = TestSecondary.ts
+        self.assertEqual([p.age for p in ts.range(Person, "age", 35, 45)], list(range(35, 45)))
+        self.assertEqual([p.age for p in ts.range(Person, "age", 98)], [98, 99])
+        self.assertEqual([p.name for p in ts.range(Person, "name", "p8")][0:3], [b"p8"] * 3)
+        with self.assertRaises(NotIndexedError):
+            ts.range(Person, "numbers")
+
+    def test_0004_update_delete(self):
+        ts = TestSecondary.ts
+        p = ts.read(TestSecondary.ids[3], Person)
+        p.name = "renamed"
+        ts.update(p)
+
+        ts.delete(TestSecondary.ids[13])
+        ts.delete_many(TestSecondary.ids[23:24])
+
+        self.assertEqual([p.age for p in ts.find(Person, name="p3")], list(range(33, 100, 10)))
+        self.assertEqual([p.age for p in ts.find(Person, name="renamed")], [3])
+        self.assertEqual(ts.find(Person, age=13), [])
+
+    def test_0005_vacuum_reopen(self):
+        TestSecondary.ts.vacuum(force=True)
+        TestSecondary.ts.close()
+        TestSecondary.ts = TlvStorage(TestSecondary.IFILE)
+        ts = TestSecondary.ts
+
+        self.assertEqual([p.age for p in ts.find(Person, name="p3")], list(range(33, 100, 10)))
+        self.assertEqual([p.age for p in ts.find(Person, name="renamed")], [3])
+        self.assertEqual([p.age for p in ts.range(Person, "age", 10, 15)], [10, 11, 12, 14])
+
+    def test_0006_compact(self):
+        sec = TestSecondary.ts.secondary["Person"]
+        sec.checkpoint()
+        self.assertEqual(sec.records, len(sec.byid))
+
+        with open(TestSecondary.SFILE, "rb") as f:
+            reread = SecondaryIndex(f)
+        self.assertEqual(reread.byid, sec.byid)
+        self.assertEqual(reread.sorted, sec.sorted)
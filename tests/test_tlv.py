@@ -1,10 +1,13 @@
 import os
 import time
+import struct
 import unittest
 import logging as lg
 
 import tlvdb.util as util
+from tlvdb import tlv
 from tlvdb.tlv import TLV
+from tlvdb.tlverrors import *
 from tlvdb.tlvindex import HashIndex
 
 
@@ -67,3 +70,135 @@ class TestTLV(unittest.TestCase):
         self.assertEqual(TestTLV.t.value[1].value, 32)
         self.assertEqual(TestTLV.t.value[2].value, b"a")
         self.assertEqual(TestTLV.t.value[3].value[TLV("key")], TLV("value"))
+
+    def test_0004_decode_buffer(self):
+        data = b"xx" + TestTLV.t.pack() + b"yy"
+
+        t, end = tlv.decode(memoryview(data), 2)
+        self.assertEqual(end, len(data) - 2)
+        self.assertEqual(tlv.skip(data, 2), end)
+        self.assertEqual(t.value[4].value[4].value, 25600000)
+        self.assertEqual(t.value[3].value[TLV("key")], TLV("value"))
+        self.assertEqual(t.getDecodedValue(), TestTLV.t.getDecodedValue())
+
+    def test_0005_decode_short_or_bad(self):
+        data = TestTLV.t.pack()
+        for cut in (1, 5, len(data) - 1):
+            with self.assertRaises(TlvShortBufferError):
+                tlv.decode(data[:cut])
+            with self.assertRaises(TlvShortBufferError):
+                tlv.skip(data[:cut])
+
+        with self.assertRaises(TlvSpecError):
+            tlv.decode(b"Z12345678")
+
+    def test_0006_read_stream(self):
+        # Records larger than the first chunk need a second read
+        big = TLV([TLV("x" * 200) for i in range(0, 40)])
+        TestTLV.FD.seek(0)
+        TestTLV.FD.truncate()
+        big.setSource(TestTLV.FD)
+        end = big.write(0)
+        TestTLV.FD.flush()
+
+        t = TLV(fd=TestTLV.FD)
+        self.assertEqual(t.read(0), end)
+        self.assertEqual(TestTLV.FD.tell(), end)
+        self.assertEqual(t.size(0), end)
+        self.assertEqual(t.value[39], TLV("x" * 200))
+
+    def test_0007_pack_into(self):
+        t = TLV({TLV("a"): TLV([TLV(1), TLV(-1), TLV(70000), TLV(0.5)])})
+        expected = b"K\x01s\x01aT\x04B\x01b\xffI\x70\x11\x01\x00d" + struct.pack("<d", 0.5)
+        self.assertEqual(bytes(t.pack()), expected)
+        self.assertEqual(t.packedSize(), len(expected))
+
+        buf = bytearray(b"." * (len(expected) + 4))
+        self.assertEqual(t.pack_into(buf, 2), len(expected) + 2)
+        self.assertEqual(bytes(buf), b".." + expected + b"..")
+
+    def test_0008_pack_long(self):
+        # Up to 255 keep the one byte length, then varint lengths
+        self.assertEqual(bytes(TLV("x" * 255).pack()[:2]), b"s\xff")
+        self.assertEqual(bytes(TLV("x" * 256).pack()[:3]), b"S\x80\x02")
+        self.assertEqual(bytes(tlv.dumps([1] * 300)[:3]), b"L\xac\x02")
+
+        t = TLV({
+            TLV("blob"): TLV(b"\x00" * 70000),
+            TLV("list"): TLV([TLV(i) for i in range(0, 1000)]),
+            TLV("dict"): TLV(dict((TLV(i), TLV(str(i))) for i in range(0, 300)))
+        })
+        data = t.pack()
+        self.assertEqual(len(data), t.packedSize())
+        self.assertEqual(tlv.skip(data), len(data))
+
+        t2, end = tlv.decode(data)
+        self.assertEqual(end, len(data))
+        self.assertEqual(t2.value[TLV("blob")], TLV(b"\x00" * 70000))
+        self.assertEqual(t2.value[TLV("list")].type, b"T")
+        self.assertEqual(t2.value[TLV("list")].value[999].value, 999)
+        self.assertEqual(t2.getDecodedValue()[b"dict"][299], b"299")
+        self.assertEqual(bytes(t2.pack()), bytes(data))
+
+        value = tlv.loads(data)
+        self.assertEqual(len(value[b"list"]), 1000)
+        self.assertEqual(bytes(tlv.dumps(value)), bytes(data))
+
+        with self.assertRaises(TlvShortBufferError):
+            tlv.decode(data[:2])
+
+    def test_0009_dumps_loads(self):
+        value = {"a": [1, -1, -200, 70000, 2**40, 0.5, "str", b"bytes"], "b": {}}
+        data = tlv.dumps(value)
+
+        # Same bytes as going through TLV objects
+        self.assertEqual(bytes(data), bytes(TLV({
+            TLV("a"): TLV([TLV(1), TLV(-1), TLV(-200), TLV(70000), TLV(2**40),
+                TLV(0.5), TLV("str"), TLV(b"bytes")]),
+            TLV("b"): TLV({})
+        }).pack()))
+
+        self.assertEqual(tlv.loads(data), {
+            b"a": [1, -1, -200, 70000, 2**40, 0.5, b"str", b"bytes"],
+            b"b": {}
+        })
+        self.assertEqual(tlv.decodeValue(b".." + data, 2), (tlv.loads(data), len(data) + 2))
+        self.assertEqual(tlv.loads(TestTLV.t.pack()), TestTLV.t.getDecodedValue())
+
+    def test_0010_matches(self):
+        data = tlv.dumps({"name": "x", "age": 3, "big": list(range(0, 300)), "sub": {"a": 1}})
+
+        self.assertTrue(tlv.matches(data, 0, tlv.predicates({"name": "x"})))
+        self.assertTrue(tlv.matches(data, 0, tlv.predicates({"name": b"x", "age": 3})))
+        self.assertTrue(tlv.matches(data, 0, tlv.predicates({"age": lambda v: v < 5})))
+        self.assertTrue(tlv.matches(data, 0, tlv.predicates({"sub": {"a": 1}})))
+        self.assertFalse(tlv.matches(data, 0, tlv.predicates({"name": "y"})))
+        self.assertFalse(tlv.matches(data, 0, tlv.predicates({"missing": 1})))
+        self.assertFalse(tlv.matches(tlv.dumps([1, 2]), 0, tlv.predicates({"name": "x"})))
+
+        # The big list is only skipped, so this matches before the buffer ends
+        self.assertTrue(tlv.matches(data[:len(data) - 20], 0, tlv.predicates({"name": "x"})))
+        with self.assertRaises(TlvShortBufferError):
+            tlv.matches(data[:20], 0, tlv.predicates({"sub": {}}))
+
+    def test_0011_project(self):
+        data = tlv.dumps({"name": "x", "big": list(range(0, 300)), "age": 3})
+
+        self.assertEqual(tlv.project(data, 0, [b"age", b"none"])[0], {b"age": 3})
+        found, end = tlv.project(data, 0, [b"name"])
+        self.assertEqual(found, {b"name": b"x"})
+        self.assertEqual(end, 11)
+
+        # Only what comes before the last wanted key has to be there
+        self.assertEqual(tlv.project(data[:11], 0, [b"name"])[0], {b"name": b"x"})
+        with self.assertRaises(TlvShortBufferError):
+            tlv.project(data[:100], 0, [b"age"])
+        with self.assertRaises(TlvSpecError):
+            tlv.project(tlv.dumps([1]), 0, [b"age"])
+
+        t = tlv.LazyTLV().unpackFrom(b".." + bytes(data), 2)
+        self.assertEqual(t._tlvdb_size, len(data))
+        self.assertEqual(t[TLV("age")], TLV(3))
+        self.assertEqual(len(t.keys()), 3)
+        self.assertEqual(bytes(t.pack()), bytes(data))
+        self.assertEqual(tlv.LazyTLV().unpackFrom(tlv.dumps([1])).getDecodedValue(), [1])
@@ -0,0 +1,81 @@
+import os
+import glob
+import unittest
+import logging
+import tempfile
+from unittest.mock import patch
+
+from tlvdb import tlv
+from tlvdb import util
+from tlvdb.tlv import TLV
+from tlvdb.tlvstorage import TlvStorage
+from tlvdb.tlverrors import *
+
+lg = logging.getLogger("tests")
+
+ROOT = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+
+
+class TestRawVacuum(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        for f in glob.glob("%s/data/rawvacuum.*" % ROOT):
+            os.remove(f)
+        cls.IFILE = "%s/data/rawvacuum.idx" % ROOT
+        cls.DFILE = "%s/data/rawvacuum.0.dat" % ROOT
+        cls.ts = TlvStorage(cls.IFILE, vacuum_thres=0)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.ts.close()
+
+    def test_0001_no_decode(self):
+        ts = TestRawVacuum.ts
+        values = [TLV({TLV("key"): TLV(i), TLV("list"): TLV([TLV(j) for j in range(0, i % 20)])})
+            for i in range(0, 200)]
+        values[50] = TLV("z" * 20000)
+        ids = ts.create_many(values)
+        # Three holes: four runs of neighbours
+        ts.delete_many([ids[10], ids[11], ids[100], ids[150]])
+
+        with patch.object(tlv, "_decode", side_effect=AssertionError("decoded")), \
+                patch.object(tlv, "_load", side_effect=AssertionError("decoded")), \
+                patch.object(util, "copy_range", wraps=util.copy_range) as copy:
+            ts.vacuum(force=True)
+
+        self.assertEqual(copy.call_count, 4)
+        gone = (10, 11, 100, 150)
+        self.assertEqual(os.path.getsize(TestRawVacuum.DFILE),
+            sum(len(v.pack()) for i, v in enumerate(values) if i not in gone))
+        for i, tid in enumerate(ids):
+            if i not in gone:
+                self.assertEqual(bytes(ts.read(tid).pack()), bytes(values[i].pack()))
+
+    def test_0002_copy_fallbacks(self):
+        data = bytes(range(0, 256)) * 40
+        with tempfile.TemporaryFile() as src:
+            src.write(data)
+            src.flush()
+
+            for failing in ([], ["copy_file_range"], ["copy_file_range", "sendfile"]):
+                with tempfile.TemporaryFile() as dst:
+                    dst.write(b"head")
+                    dst.flush()
+
+                    patches = [patch.object(os, name, side_effect=OSError("not here"))
+                        for name in failing]
+                    for p in patches:
+                        p.start()
+                    try:
+                        util.copy_range(src.fileno(), dst.fileno(), 100, 5000)
+                    finally:
+                        for p in patches:
+                            p.stop()
+
+                    dst.seek(0)
+                    self.assertEqual(dst.read(), b"head" + data[100:5100])
+
+            with tempfile.TemporaryFile() as dst:
+                with self.assertRaises(EOFError):
+                    util.copy_range(src.fileno(), dst.fileno(), len(data) - 10, 20)
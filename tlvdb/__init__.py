@@ -1 +1 @@
-__all__ = ["tlv", "tlverrors", "tlvindex", "tlvstorage", "util"]
+__all__ = ["tlv", "tlverrors", "tlvindex", "tlvpolicy", "tlvstorage", "util"]
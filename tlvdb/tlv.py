@@ -4,13 +4,525 @@ import json
 
 lg = logging.getLogger("tlv")
 
-from tlvdb.tlverrors import TlvSpecError
+from tlvdb.tlverrors import TlvSpecError, TlvShortBufferError
 
 
 H=2**16
 I=2**32
 Q=2**64
 
+READ_CHUNK = 4096
+"""Initial read size when decoding from a stream"""
+
+SCALARS = [None] * 256
+"""Precompiled fixed size scalars, indexed by type code"""
+TAGGED = [None] * 256
+"""Same as SCALARS, including the type code"""
+for _code in "BHIQbhiqd":
+    SCALARS[ord(_code)] = struct.Struct("<%s" % _code)
+    TAGGED[ord(_code)] = struct.Struct("<B%s" % _code)
+
+HEADER = struct.Struct("<BB")
+"""Type code and one byte length of strings, lists and dicts"""
+
+FORMAT_VERSION = 2
+"""
+Wire format version:
+
+- 1: strings, lists and dicts up to 255 long (``s``, ``T``, ``K``)
+- 2: longer ones use ``S``, ``L``, ``D`` with a LEB128 varint length
+"""
+
+CODES = [struct.pack("<B", _code) for _code in range(256)]
+"""Type code to its ``bytes`` representation"""
+
+_T = ord("T")
+_K = ord("K")
+_S = ord("s")
+_D = ord("d")
+
+LONG = [0] * 256
+"""Short to long form type code (0: none)"""
+SHORT = [0] * 256
+"""Long to short form type code (0: none)"""
+for _short, _long in ((_T, ord("L")), (_K, ord("D")), (_S, ord("S"))):
+    LONG[_short] = _long
+    SHORT[_long] = _short
+
+_MISSING = object()
+
+
+def decode(buf, offset=0, tlv=None):
+    """
+    Decode the TLV starting at ``offset`` of a buffer (bytes, bytearray, mmap,
+    memoryview...) into ``tlv`` (or a new TLV). Return the TLV and the offset
+    right after it. Raises TlvShortBufferError if the buffer ends too early
+    """
+    try:
+        return _decode(buf, offset, tlv)
+    except (IndexError, struct.error):
+        raise TlvShortBufferError("Buffer ended while decoding from %d" % offset)
+
+def _decode(buf, offset, t):
+    if t is None:
+        t = TLV.__new__(TLV)
+        t.fd = None
+
+    code = buf[offset]
+    if code == _T or code == _K or code == _S:
+        length = buf[offset + 1]
+        offset += 2
+    elif SHORT[code]:
+        code = SHORT[code]
+        length, offset = _readVarint(buf, offset + 1)
+    else:
+        spec = SCALARS[code]
+        if spec is None:
+            raise TlvSpecError("While reading type=%s" % CODES[code], "unknown type code")
+        t.type = CODES[code]
+        t.length = spec.size
+        t.value = spec.unpack_from(buf, offset + 1)[0]
+        return t, offset + 1 + spec.size
+
+    # Always the short type, packing picks the form
+    t.type = CODES[code]
+
+    # Lists! recursive
+    if code == _T:
+        value = []
+        for i in range(0, length):
+            child, offset = _decode(buf, offset, None)
+            value.append(child)
+    elif code == _K:
+        value = {}
+        for i in range(0, length):
+            key, offset = _decode(buf, offset, None)
+            val, offset = _decode(buf, offset, None)
+            value[key] = val
+    else:
+        end = offset + length
+        if end > len(buf):
+            raise TlvShortBufferError("String ends at %d, buffer at %d" % (end, len(buf)))
+        value = bytes(buf[offset:end])
+        offset = end
+
+    t.length = length
+    t.value = value
+    return t, offset
+
+def skip(buf, offset=0):
+    """
+    Return the offset right after the TLV starting at ``offset`` without
+    decoding any value
+    """
+    try:
+        end = _skip(buf, offset)
+    except IndexError:
+        end = len(buf) + 1
+
+    if end > len(buf):
+        raise TlvShortBufferError("Buffer ended while sizing from %d" % offset)
+    return end
+
+def _skip(buf, offset):
+    code = buf[offset]
+    if code == _T or code == _K or code == _S:
+        length = buf[offset + 1]
+        offset += 2
+    elif SHORT[code]:
+        code = SHORT[code]
+        length, offset = _readVarint(buf, offset + 1)
+    else:
+        spec = SCALARS[code]
+        if spec is None:
+            raise TlvSpecError("While sizing type=%s" % CODES[code], "unknown type code")
+        return offset + 1 + spec.size
+
+    if code == _S:
+        return offset + length
+
+    if code == _K:
+        length *= 2
+    for i in range(0, length):
+        offset = _skip(buf, offset)
+    return offset
+
+def varint(n):
+    """
+    LEB128 encoding of an unsigned integer
+    """
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return out
+
+def _readVarint(buf, offset):
+    """
+    Return the LEB128 integer at offset and the offset right after it
+    """
+    n = 0
+    shift = 0
+    while True:
+        b = buf[offset]
+        offset += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, offset
+        shift += 7
+
+def readBuffered(fd, pos, decoder):
+    """
+    Read from ``pos`` just enough data for ``decoder(buf, 0)`` to succeed and
+    return its result. The decoder returns (anything, end offset) like
+    decode(). The stream is left right after the decoded data
+    """
+    size = READ_CHUNK
+    while True:
+        fd.seek(pos)
+        buf = fd.read(size)
+        try:
+            result, end = decoder(buf, 0)
+        except TlvShortBufferError:
+            if len(buf) < size:
+                raise TlvSpecError("While reading from pos=%d" % pos, "unexpected end of file")
+            size *= 4
+            continue
+
+        fd.seek(pos + end)
+        return result, end
+
+def intType(value):
+    """
+    Smallest type code (as a ``str``) that can hold the integer
+    """
+    if value >= 0:
+        if value < 256:
+            return "B"
+        elif value < H:
+            return "H"
+        elif value < I:
+            return "I"
+        elif value < Q:
+            return "Q"
+    elif value >= -2**7:
+        return "b"
+    elif value >= -2**15:
+        return "h"
+    elif value >= -2**31:
+        return "i"
+    elif value >= -2**63:
+        return "q"
+
+    raise TlvSpecError("While packing value=%d" % value, "integer out of range")
+
+def dumps(obj):
+    """
+    Encode python values (int, float, str, bytes, list, set, tuple, dict,
+    IPackable, TLV) straight to the TLV wire format without building TLV
+    objects. Returns a bytearray
+    """
+    out = bytearray()
+    _dump(obj, out)
+    return out
+
+def _dump(value, out):
+    t = type(value)
+    if t is int:
+        code = ord(intType(value))
+        out += TAGGED[code].pack(code, value)
+    elif t is bytes or t is str:
+        if t is str:
+            try:
+                value = value.encode("ascii")
+            except UnicodeError as e:
+                raise TlvSpecError("While packing value=%s" % value, str(e))
+        out += _header(_S, len(value))
+        out += value
+    elif t is dict:
+        out += _header(_K, len(value))
+        for k, v in value.items():
+            _dump(k, out)
+            _dump(v, out)
+    elif t is list or t is set or t is tuple:
+        out += _header(_T, len(value))
+        for i in value:
+            _dump(i, out)
+    elif t is float:
+        out += TAGGED[_D].pack(_D, value)
+    elif isinstance(value, TLV):
+        out += value.pack()
+    elif isinstance(value, IPackable):
+        value.schema().packInto(value, out)
+    else:
+        raise RuntimeError("Unsupported type for value '%s'" % str(value))
+
+def _header(code, length):
+    """
+    Type code and length of a string, list or dict, in the long form if the
+    length does not fit in one byte
+    """
+    if length > 255:
+        return CODES[LONG[code]] + varint(length)
+    return HEADER.pack(code, length)
+
+def _headerSize(length):
+    if length > 255:
+        return 1 + len(varint(length))
+    return 2
+
+def loads(buf, offset=0):
+    """
+    Decode the TLV at ``offset`` of a buffer straight to python values.
+    Strings come back as bytes
+    """
+    return decodeValue(buf, offset)[0]
+
+def decodeValue(buf, offset=0):
+    """
+    Like loads() but return the value and the offset right after it
+    """
+    try:
+        return _load(buf, offset)
+    except (IndexError, struct.error):
+        raise TlvShortBufferError("Buffer ended while decoding from %d" % offset)
+
+def _load(buf, offset):
+    code = buf[offset]
+    if code == _T or code == _K or code == _S:
+        length = buf[offset + 1]
+        offset += 2
+    elif SHORT[code]:
+        code = SHORT[code]
+        length, offset = _readVarint(buf, offset + 1)
+    else:
+        spec = SCALARS[code]
+        if spec is None:
+            raise TlvSpecError("While reading type=%s" % CODES[code], "unknown type code")
+        return spec.unpack_from(buf, offset + 1)[0], offset + 1 + spec.size
+
+    if code == _K:
+        value = {}
+        for i in range(0, length):
+            key, offset = _load(buf, offset)
+            value[key], offset = _load(buf, offset)
+        return value, offset
+    elif code == _T:
+        value = []
+        for i in range(0, length):
+            item, offset = _load(buf, offset)
+            value.append(item)
+        return value, offset
+
+    end = offset + length
+    if end > len(buf):
+        raise TlvShortBufferError("String ends at %d, buffer at %d" % (end, len(buf)))
+    return bytes(buf[offset:end]), end
+
+
+def _decoded(value):
+    """
+    A python value as loads() would return it
+    """
+    t = type(value)
+    if t is str:
+        return value.encode("ascii")
+    if t is list or t is tuple or t is set:
+        return [_decoded(v) for v in value]
+    if t is dict:
+        return dict((_decoded(k), _decoded(v)) for k, v in value.items())
+    return value
+
+def predicates(where):
+    """
+    Prepare ``{key: value or callable}`` for matches(). Callables get the
+    decoded value (strings as bytes), other values are compared for equality
+    """
+    tests = {}
+    for key, test in where.items():
+        if not callable(test):
+            test = (lambda expected: lambda value: value == expected)(_decoded(test))
+        tests[_decoded(key)] = test
+    return tests
+
+def matches(buf, offset, tests):
+    """
+    Check the dict TLV at ``offset`` against predicates() without decoding
+    it: only the values of the tested keys are decoded, the rest are skipped
+    by size. Records that are not dicts or miss a tested key do not match
+    """
+    try:
+        code = buf[offset]
+        if code == _K:
+            length = buf[offset + 1]
+            offset += 2
+        elif SHORT[code] == _K:
+            length, offset = _readVarint(buf, offset + 1)
+        else:
+            return False
+
+        pending = len(tests)
+        for i in range(0, length):
+            key, offset = _load(buf, offset)
+            test = tests.get(key) if type(key) is not list else None
+            if test is None:
+                offset = _skip(buf, offset)
+                continue
+
+            value, offset = _load(buf, offset)
+            if not test(value):
+                return False
+
+            pending -= 1
+            if pending == 0:
+                return True
+    except (IndexError, struct.error):
+        raise TlvShortBufferError("Buffer ended while matching from %d" % offset)
+
+    return pending == 0
+
+def project(buf, offset, keys, decoder=_load):
+    """
+    Decode with ``decoder(buf, offset)`` only the values of ``keys`` (as
+    loads() returns them) of the dict TLV at ``offset``. The other values are
+    skipped by size and the walk stops once all the keys are found. Returns a
+    ``{key: value}`` dict without the keys that are not there and the offset
+    where it stopped
+    """
+    wanted = set(keys)
+    found = {}
+    try:
+        code = buf[offset]
+        if code == _K:
+            length = buf[offset + 1]
+            offset += 2
+        elif SHORT[code] == _K:
+            length, offset = _readVarint(buf, offset + 1)
+        else:
+            raise TlvSpecError("While projecting type=%s" % CODES[code], "not a dict")
+
+        for i in range(0, length):
+            if len(found) == len(wanted):
+                break
+
+            key, offset = _load(buf, offset)
+            if type(key) is list or key not in wanted:
+                offset = _skip(buf, offset)
+                continue
+            found[key], offset = decoder(buf, offset)
+    except (IndexError, struct.error):
+        raise TlvShortBufferError("Buffer ended while projecting from %d" % offset)
+
+    if offset > len(buf):
+        raise TlvShortBufferError("Buffer ended while projecting at %d" % offset)
+    return found, offset
+
+def _decodeNew(buf, offset):
+    return _decode(buf, offset, None)
+
+
+class Schema(object):
+    """
+    Codec compiled once for an IPackable subclass from its ``packaged``
+    attributes: the attribute name keys are encoded once and records are
+    written/read in a single pass. Changes to ``packaged`` after the first
+    use are not picked up.
+    """
+
+    def __init__(self, klass):
+        self.klass = klass
+        self.attrs = list(klass.packaged)
+        if len(self.attrs) > 255:
+            raise TlvSpecError(
+                "While compiling %s" % klass.__name__,
+                "more than 255 packaged attributes"
+            )
+
+        # Pre-encoded keys and reverse lookup from the raw key
+        self.keys = [bytes(dumps(attr)) for attr in self.attrs]
+        self.names = {}
+        for attr in self.attrs:
+            self.names[attr.encode("ascii")] = attr
+
+    def packInto(self, obj, out):
+        """
+        Append the record of ``obj`` to the ``out`` bytearray
+        """
+        start = len(out)
+        out += HEADER.pack(_K, 0)
+
+        count = 0
+        for attr, key in zip(self.attrs, self.keys):
+            value = getattr(obj, attr, _MISSING)
+            if value is _MISSING:
+                continue
+            out += key
+            _dump(value, out)
+            count += 1
+
+        out[start + 1] = count
+        return out
+
+    def pack(self, obj):
+        return self.packInto(obj, bytearray())
+
+    def unpackFrom(self, obj, buf, offset=0, fields=None):
+        """
+        Set the attributes of ``obj`` from the record at ``offset`` and return
+        the offset right after it. With ``fields`` only those attributes are
+        decoded and the offset is where the walk stopped (see project())
+        """
+        if fields is not None:
+            found, offset = project(buf, offset, [attr.encode("ascii") for attr in fields])
+            for attr in fields:
+                value = found.get(attr.encode("ascii"), _MISSING)
+                if value is _MISSING:
+                    lg.warning("Could not find attr=%s" % attr)
+                else:
+                    setattr(obj, attr, value)
+            return offset
+
+        try:
+            code = buf[offset]
+            if code == _K:
+                length = buf[offset + 1]
+                offset += 2
+            elif SHORT[code] == _K:
+                length, offset = _readVarint(buf, offset + 1)
+            else:
+                raise TlvSpecError(
+                    "While unpacking %s type=%s" % (self.klass.__name__, CODES[code]),
+                    "not a dict"
+                )
+
+            found = []
+            for i in range(0, length):
+                key, offset = _load(buf, offset)
+                value, offset = _load(buf, offset)
+                attr = self.names.get(key)
+                if attr is not None:
+                    setattr(obj, attr, value)
+                    found.append(attr)
+        except (IndexError, struct.error):
+            raise TlvShortBufferError("Buffer ended while unpacking %s" % self.klass.__name__)
+
+        if len(found) < len(self.attrs):
+            for attr in self.attrs:
+                if attr not in found:
+                    lg.warning("Could not find attr=%s" % attr)
+
+        return offset
+
+
+def packable(klass):
+    """
+    Class decorator compiling the Schema of an IPackable subclass up front
+    (it is otherwise compiled on first use)
+    """
+    klass._tlvdb_schema = Schema(klass)
+    return klass
+
 class BaseIO(object):
 
     def __init__(self, fd):
@@ -55,7 +567,7 @@ class IPackable(object):
         elif type(value) == dict:
             d = {}
             for k, v in value.items():
-                t[IPackable.valueToTLV(k)] = t[IPackable.valueToTLV(v)]
+                d[IPackable.valueToTLV(k)] = IPackable.valueToTLV(v)
             return TLV(d)
         else:
             return TLV(value)
@@ -72,35 +584,43 @@ class IPackable(object):
         return TLV(t)
 
 
+    @classmethod
+    def schema(cls):
+        """
+        The compiled Schema of this class (compiled on first use)
+        """
+        schema = cls.__dict__.get("_tlvdb_schema")
+        if schema is None:
+            schema = Schema(cls)
+            cls._tlvdb_schema = schema
+        return schema
+
     def pack(self, tab=""):
-        t = self.toTLV()
-        data = t.pack()
-        self._tlvdb_size = t._tlvdb_size
+        data = self.schema().pack(self)
+        self._tlvdb_size = len(data)
         return data
 
     def unpack(self, fd):
         """
         Unpack from the given file descriptor and return self
         """
-        t = TLV()
-        t.unpack(fd)
-        decoded = t.getDecodedValue()
-        print(decoded)
-        for attr in self.__class__.packaged:
-            # Convert to bytes if needed
-            attr_bytes = attr
-            try:
-                attr_bytes = attr.encode("ascii")
-            except:
-                pass
-            if attr_bytes not in decoded:
-                lg.warning("Could not find attr=%s" % attr)
-                continue
+        schema = self.schema()
+        self._tlvdb_size = readBuffered(fd, fd.tell(),
+            lambda buf, offset: (None, schema.unpackFrom(self, buf, offset)))[1]
+        return self
 
-            lg.debug("Unpacking %s" % attr)
-            setattr(self, attr, decoded[attr_bytes])
+    def unpackFrom(self, buf, offset=0, fields=None):
+        """
+        Unpack from a buffer at the given offset and return self. With
+        ``fields`` only those attributes are set: such a partial object can
+        not be saved back
+        """
+        if fields is not None:
+            self.schema().unpackFrom(self, buf, offset, fields)
+            self._tlvdb_fields = list(fields)
+            return self
 
-        self._tlvdb_size = t._tlvdb_size
+        self._tlvdb_size = self.schema().unpackFrom(self, buf, offset) - offset
         return self
 
     def __str__(self):
@@ -167,19 +687,7 @@ class TLV(BaseIO, IPackable):
             self.length = len(self.value)
             self.type = b"K"
         elif t == int:
-            tmpv = abs(self.value)
-            if tmpv < 256:
-                self.type = b"B"
-            elif tmpv < H:
-                self.type = b"H"
-            elif tmpv < I:
-                self.type = b"I"
-            elif tmpv < Q:
-                self.type = b"Q"
-
-            # sign
-            if self.value < 0:
-                self.type = self.type.lower()
+            self.type = intType(self.value).encode("ascii")
 
         elif t == float:
             self.type = b"d"
@@ -201,69 +709,10 @@ class TLV(BaseIO, IPackable):
 
 
     def size(self, pos, seek=True):
-        if seek:
-            self.seek(pos)
+        if not seek:
+            pos = self.fd.tell()
 
-        lg.debug("Sizing from %d" % pos)
-
-        data = self.fd.read(1)
-        self.type = struct.unpack("<c", data)[0]
-        data_len = 1
-
-
-        # Lists! recursive
-        if self.type == "T" or self.type == b"T":
-            data = self.fd.read(1)
-            self.length = struct.unpack("<B", data)[0]
-            data_len += 1
-
-            lg.debug("Sizing type=%s, length=%d" % (self.type, self.length))
-            pos += 2
-            for i in range(0, self.length):
-                tmp = TLV(fd=self.fd)
-                s = tmp.size(pos)
-                data_len += s
-                pos += s
-        elif self.type == "K" or self.type == b"K":
-            data = self.fd.read(1)
-            self.length = struct.unpack("<B", data)[0]
-            data_len += 1
-
-            lg.debug("Sizing type=%s, length=%d" % (self.type, self.length))
-            self.value = {}
-            pos += 2
-            for i in range(0, self.length):
-                key = TLV(fd=self.fd)
-                s = key.size(pos)
-                data_len += s
-                pos += s
-
-                val = TLV(fd=self.fd)
-                s = val.size(pos)
-                data_len += s
-                pos += s
-
-        elif self.type == "s" or self.type == b"s":
-            data = self.fd.read(1)
-            self.length = struct.unpack("<B", data)[0]
-            data_len += 1
-
-            lg.debug("Sizing String type=%s, length=%d" % (self.type, self.length))
-            data_len += self.length
-
-        # Load
-        else:
-            lg.debug("Sizing type=%s" % (self.type))
-
-            spec = "<%s" % self.type.decode("ascii")
-            lg.debug("        spec=%s" % (spec))
-
-            self.length = struct.calcsize(spec)
-            lg.debug("        length=%d" % (self.length))
-            data_len += self.length
-
-        lg.debug("Found size=%d" % data_len)
-        return data_len
+        return readBuffered(self.fd, pos, lambda buf, offset: (None, skip(buf, offset)))[1]
 
     def unpack(self, fd):
         """
@@ -275,110 +724,94 @@ class TLV(BaseIO, IPackable):
         self._tlvdb_size = self.read(self.fd.tell(), False)
         return self
 
-    def read(self, pos, seek=True):
-        if seek:
-            self.seek(pos)
-
-        lg.debug("Reading from %d" % pos)
+    def unpackFrom(self, buf, offset=0, fields=None):
+        """
+        Unpack from a buffer at the given offset and return self. With
+        ``fields`` (keys of a dict TLV) only those items are decoded: such a
+        partial TLV can not be saved back
+        """
+        if fields is not None:
+            found, end = project(buf, offset, [_decoded(key) for key in fields], _decodeNew)
+            self.setValue(dict((TLV(key), value) for key, value in found.items()))
+            self._tlvdb_fields = list(fields)
+            return self
+
+        end = decode(buf, offset, self)[1]
+        self._tlvdb_size = end - offset
+        return self
 
-        data = self.fd.read(1)
-        self.type = struct.unpack("<c", data)[0]
-        data_len = 1
+    def read(self, pos, seek=True):
+        if not seek:
+            pos = self.fd.tell()
 
-        # Lists! recursive
-        if self.type == "T" or self.type == b"T":
-            data = self.fd.read(1)
-            self.length = struct.unpack("<B", data)[0]
-            data_len += 1
-
-            lg.debug("Reading type=%s, length=%d" % (self.type, self.length))
-            self.value = []
-            pos += 2
-            for i in range(0, self.length):
-                tmp = TLV(fd=self.fd)
-                dl = tmp.read(pos, seek)
-                self.value.append(tmp)
-                data_len += dl
-                pos += dl
-        elif self.type == "K" or self.type == b"K":
-            data = self.fd.read(1)
-            self.length = struct.unpack("<B", data)[0]
-            data_len += 1
-
-            lg.debug("Reading type=%s, length=%d" % (self.type, self.length))
-            self.value = {}
-            pos += 2
-            for i in range(0, self.length):
-                key = TLV(fd=self.fd)
-                klen = key.read(pos, seek)
-                data_len += klen
-                pos += klen
-
-                val = TLV(fd=self.fd)
-                vlen = val.read(pos, seek)
-                data_len += vlen
-                pos += vlen
-
-                self.value[key] = val
-        elif self.type == "s" or self.type == b"s":
-            data = self.fd.read(1)
-            self.length = struct.unpack("<B", data)[0]
-            data_len += 1
-
-            lg.debug("Reading String type=%s, length=%d" % (self.type, self.length))
-            data = self.fd.read(self.length)
-            data_len += self.length
-            self.value = struct.unpack("%ds" % self.length, data)[0]
-        # Load
-        else:
-            lg.debug("Reading type=%s" % (self.type))
+        return readBuffered(self.fd, pos, lambda buf, offset: decode(buf, offset, self))[1]
 
-            spec = "<%s" % self.type.decode("ascii")
-            lg.info("        spec=%s" % (spec))
+    def packedSize(self):
+        """
+        Number of bytes pack() will produce
+        """
+        code = ord(self.type)
+        if code == _T:
+            size = _headerSize(len(self.value))
+            for i in self.value:
+                size += i.packedSize()
+            return size
+        elif code == _K:
+            size = _headerSize(len(self.value))
+            for k, v in self.value.items():
+                size += k.packedSize() + v.packedSize()
+            return size
+        elif code == _S:
+            return _headerSize(len(self.value)) + len(self.value)
 
-            # This validates the spec, so control it!
-            try:
-                self.length = struct.calcsize(spec)
-            except struct.error as e:
-                raise TlvSpecError(
-                    "While reading type=%s and spec=%s" % (self.type, spec),
-                    str(e)
-                )
-            lg.debug("        length=%d" % (self.length))
-            data = self.fd.read(self.length)
-            data_len += self.length
-            self.value = struct.unpack(spec, data)[0]
+        return 1 + SCALARS[code].size
 
-        lg.debug("Read %d" % data_len)
-        return data_len
+    def pack_into(self, buf, offset=0):
+        """
+        Encode into a preallocated writable buffer at ``offset`` and return
+        the offset right after the encoded data
+        """
+        code = ord(self.type)
+        if code == _T or code == _K or code == _S:
+            length = len(self.value)
+            self.length = length
+            if length > 255:
+                header = _header(code, length)
+                buf[offset:offset + len(header)] = header
+                offset += len(header)
+            else:
+                HEADER.pack_into(buf, offset, code, length)
+                offset += 2
+
+            if code == _T:
+                for i in self.value:
+                    offset = i.pack_into(buf, offset)
+            elif code == _K:
+                for k, v in self.value.items():
+                    offset = k.pack_into(buf, offset)
+                    offset = v.pack_into(buf, offset)
+            else:
+                buf[offset:offset + length] = self.value
+                offset += length
+            return offset
+
+        spec = SCALARS[code]
+        try:
+            buf[offset] = code
+            spec.pack_into(buf, offset + 1, self.value)
+        except struct.error as e:
+            raise TlvSpecError(
+                "While packing type=%s and value=%s" % (self.type, self.value),
+                str(e)
+            )
+        return offset + 1 + spec.size
 
     def pack(self, tab=""):
-        nexttab = "%s   " % tab
-        if self.type == "T" or self.type == b"T":
-            lg.debug("%sPacking List value as %d%s" % (tab, self.length, self.type))
-            data = struct.pack("<cB", self.type, self.length)
-            for i in self.value:
-                data += i.pack(nexttab)
-        elif self.type == "K" or self.type == b"K":
-            lg.debug("%sPacking Dict value as %d%s" % (tab, self.length, self.type))
-            data = struct.pack("<cB", self.type, self.length)
-            for k, v in self.value.items():
-                data += k.pack(nexttab) + v.pack(nexttab)
-        elif self.type == "s" or self.type == b"s":
-            try:
-                self.length = len(self.value)
-                spec = "<cB%ds" % self.length
-                lg.debug("%sPacking String value as %d%s" % (tab, self.length, self.type))
-                data = struct.pack(spec, self.type, self.length, self.value)
-            except struct.error as e:
-                raise TlvSpecError(
-                    "While packing spec=%s and value=%s" % (spec, self.value),
-                    str(e)
-                )
-        else:
-            lg.debug("%sPacking Generic value as <c%s" % (tab, self.type.decode("ascii")))
-            data = struct.pack("<c%s" % self.type.decode("ascii"), self.type, self.value)
-
+        """
+        Encode to a new bytearray, allocated once
+        """
+        data = bytearray(self.packedSize())
+        self.pack_into(data, 0)
         self._tlvdb_size = len(data)
         return data
 
@@ -387,13 +820,6 @@ class TLV(BaseIO, IPackable):
             self.seek(pos)
 
         data = self.pack()
-
-        try:
-            lg.debug("Writing type=%s, length=%d, data=%s @ pos=%d" % (self.type, self.length, data.encode("hex"), pos))
-        except:
-            lg.debug("Writing type=%s, length=%d, data=%s @ pos=%d" % (self.type, self.length, data, pos))
-
-        lg.debug("Writing data length = %d" % len(data))
         self.fd.write(data)
 
         return pos+len(data)
@@ -407,3 +833,100 @@ class TLV(BaseIO, IPackable):
             tmpval = ["%s:%s" % (k.__str__(), v.__str__()) for k,v in self.value.items()]
 
         return "(%s, %d, %s)" % (self.type, self.length, tmpval)
+
+
+class LazyTLV(TLV):
+    """
+    Dict TLV that decodes each value on first access by key. Unpacking only
+    decodes the keys and skips the values by size, so reading one item of a
+    wide record costs about that item. Using ``value`` (packing, comparing)
+    decodes all that is left. Other types are decoded as usual
+    """
+
+    def __init__(self, value=None, fd=None):
+        self._pending = {}
+        super(LazyTLV, self).__init__(value, fd)
+
+    @property
+    def value(self):
+        if self._pending:
+            for key in list(self._pending):
+                self._load(key)
+        return self._value
+
+    @value.setter
+    def value(self, value):
+        self._value = value
+        self._pending = {}
+
+    def __getitem__(self, key):
+        if not isinstance(key, TLV):
+            key = TLV(key)
+        if key in self._pending:
+            self._load(key)
+        return self._value[key]
+
+    def __contains__(self, key):
+        if not isinstance(key, TLV):
+            key = TLV(key)
+        return type(self._value) is dict and key in self._value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(self._value)
+
+    def _load(self, key):
+        buf, offset = self._pending.pop(key)
+        self._value[key] = decode(buf, offset)[0]
+
+    def _index(self, buf, offset):
+        """
+        Decode the keys of the dict at ``offset`` and return the offset right
+        after it. The record is copied, the buffer may be a map that changes
+        """
+        code = buf[offset]
+        if code != _K and SHORT[code] != _K:
+            return decode(buf, offset, self)[1]
+
+        end = skip(buf, offset)
+        record = bytes(buf[offset:end])
+        try:
+            if code == _K:
+                length = record[1]
+                pos = 2
+            else:
+                length, pos = _readVarint(record, 1)
+
+            value = {}
+            pending = {}
+            for i in range(0, length):
+                key, pos = _decode(record, pos, None)
+                value[key] = None
+                pending[key] = (record, pos)
+                pos = _skip(record, pos)
+        except (IndexError, struct.error):
+            raise TlvShortBufferError("Buffer ended while indexing from %d" % offset)
+
+        self.value = value
+        self._pending = pending
+        self.type = b"K"
+        self.length = length
+        return end
+
+    def unpackFrom(self, buf, offset=0, fields=None):
+        if fields is not None:
+            return super(LazyTLV, self).unpackFrom(buf, offset, fields)
+
+        self._tlvdb_size = self._index(buf, offset) - offset
+        return self
+
+    def read(self, pos, seek=True):
+        if not seek:
+            pos = self.fd.tell()
+
+        return readBuffered(self.fd, pos, lambda buf, offset: (None, self._index(buf, offset)))[1]
@@ -39,6 +39,13 @@ class TlvSpecError(ErrorWithCode):
         final_message = "%s. Struct Message: %s" % (message, original_message)
         super(TlvSpecError, self).__init__(final_message, 100)
 
+class TlvShortBufferError(ErrorWithCode):
+    """
+    The buffer ended in the middle of a TLV, the caller should read more
+    """
+    def __init__(self, message, code=101):
+        super(TlvShortBufferError, self).__init__(message, code)
+
 
 #
 # Database
@@ -51,6 +58,22 @@ class VacuumCleanerError(ErrorWithCode):
     def __init__(self, message, code=1001):
         super(VacuumCleanerError, self).__init__(message, code)
 
+class UnsupportedVersionError(ErrorWithCode):
+    def __init__(self, message, code=1002):
+        super(UnsupportedVersionError, self).__init__(message, code)
+
+class PartitionLimitError(ErrorWithCode):
+    def __init__(self, message, code=1003):
+        super(PartitionLimitError, self).__init__(message, code)
+
+class NotIndexedError(ErrorWithCode):
+    def __init__(self, message, code=1004):
+        super(NotIndexedError, self).__init__(message, code)
+
+class DurabilityError(ErrorWithCode):
+    def __init__(self, message, code=1005):
+        super(DurabilityError, self).__init__(message, code)
+
 class TransactionError(ErrorWithCode):
     def __init__(self, message, code=1010):
         super(TransactionError, self).__init__(message, code)
@@ -1,23 +1,34 @@
+import mmap
 import struct
+import bisect
+from array import array
 import logging as lg
-from multiprocessing import RLock
+from itertools import compress
+from collections import Counter, OrderedDict
+from contextlib import ExitStack
+from multiprocessing import Lock, RLock
 
-from tlvdb.tlv import TLV, BaseIO
+from tlvdb.tlv import TLV, BaseIO, dumps, decodeValue
+from tlvdb.tlverrors import UnsupportedVersionError, PartitionLimitError, TlvShortBufferError
 
 class IndexEntry(BaseIO):
     """
-    Map a key to the position in the partition
+    Map a key to the position in the partition and the size of the entry
+    (0: unknown)
     """
-    LENGTH = 17
+    FORMAT = "<BQQQ"
+    LENGTH = 25
 
-    def __init__(self, partition=None, key=None, offset=None, fd=None):
+    V2_FORMAT = "<BQQ"
+    """Without the size, up to version 2 and in the sidecar files"""
+    V2_LENGTH = 17
+
+    def __init__(self, partition=None, key=None, offset=None, size=0, fd=None):
         super(BaseIO, self).__init__(fd)
         self.partition = partition
         self.key = key
         self.offset = offset
-
-    def size(self):
-        return IndexEntry.LENGTH
+        self.size = size
 
     def read(self, pos, seek=True):
         if seek:
@@ -25,18 +36,20 @@ class IndexEntry(BaseIO):
 
         data = self.fd.read(IndexEntry.LENGTH)
 
-        self.partition,
+        (self.partition,
         self.key,
-        self.offset = struct.unpack("<BQQ", data)
+        self.offset,
+        self.size) = struct.unpack(IndexEntry.FORMAT, data)
 
     def write(self, pos, seek=True):
         if seek:
             self.seek(pos)
 
-        data = struct.pack("<BQQ",
+        data = struct.pack(IndexEntry.FORMAT,
             self.partition,
             self.key,
-            self.offset
+            self.offset,
+            self.size
         )
         self.fd.write(data)
 
@@ -52,6 +65,19 @@ class IndexHeader(BaseIO):
     TYPE_HASH = 1
     TYPE_BTREE = 2
 
+    TYPE_DISKHASH = 3
+
+    MAX_PARTITIONS = 254
+    """Partition 255 holds the empty slots"""
+
+    VERSION = 3
+    """
+    Format version of the database, older versions are upgraded on load:
+
+    - 2: TLV types of tlv.FORMAT_VERSION 2
+    - 3: HashIndex entries and journal records carry the entry size
+    """
+
     def __init__(self, fd):
         super(IndexHeader, self).__init__(fd)
         self.version = -1
@@ -91,6 +117,17 @@ class IndexHeader(BaseIO):
     def size(self):
         return IndexHeader.LENGTH
 
+    @staticmethod
+    def peekType(fd):
+        """
+        Index type of an existing index file, None for a new one
+        """
+        fd.seek(0)
+        data = fd.read(IndexHeader.USED)
+        if len(data) < IndexHeader.USED:
+            return None
+        return data[1]
+
     def getStrInfo(self):
         s = (
             "Header Version: %s\n"
@@ -101,13 +138,217 @@ class IndexHeader(BaseIO):
         return s
 
 
-class Index(object):
+class FreeSpace(object):
+    """
+    The empty slots (holes) of one partition, mapping offset to size. Holes of
+    known size are also kept sorted by offset (to merge neighbours) and by
+    size (for best-fit allocation). Holes of size 0 have an unknown size (no
+    backfill) and only mark the partition as dirty.
+
+    Behaves like the ``offset -> size`` dict it replaces.
+    """
+
+    def __init__(self):
+        self.holes = {}
+        self.offsets = []
+        self.sizes = []
+
+    def __len__(self):
+        return len(self.holes)
+
+    def __contains__(self, pos):
+        return pos in self.holes
+
+    def __getitem__(self, pos):
+        return self.holes[pos]
+
+    def __iter__(self):
+        return iter(self.holes)
+
+    def __setitem__(self, pos, size):
+        self.set(pos, size)
+
+    def items(self):
+        return self.holes.items()
+
+    def set(self, pos, size):
+        """
+        Raw insert, no merging
+        """
+        if pos in self.holes:
+            self.remove(pos)
+
+        self.holes[pos] = size
+        if size:
+            bisect.insort(self.offsets, pos)
+            bisect.insort(self.sizes, (size, pos))
+
+    def load(self, holes):
+        """
+        Bulk raw insert of (offset, size) pairs, no merging
+        """
+        self.holes.update(holes)
+        self.offsets = sorted(pos for pos, size in self.holes.items() if size)
+        self.sizes = sorted((size, pos) for pos, size in self.holes.items() if size)
+
+    def remove(self, pos):
+        """
+        Raw removal, return the size of the removed hole
+        """
+        size = self.holes.pop(pos)
+        if size:
+            del self.offsets[bisect.bisect_left(self.offsets, pos)]
+            del self.sizes[bisect.bisect_left(self.sizes, (size, pos))]
+        return size
+
+    def add(self, pos, size):
+        """
+        Insert a hole merging it with adjacent ones. Return the list of the
+        removed hole offsets and the resulting (offset, size)
+        """
+        removed = []
+        if size:
+            i = bisect.bisect_left(self.offsets, pos)
+
+            # next hole starts where we end
+            if i < len(self.offsets) and self.offsets[i] == pos + size:
+                nextpos = self.offsets[i]
+                size += self.remove(nextpos)
+                removed.append(nextpos)
+
+            # previous hole ends where we start
+            if i > 0:
+                prevpos = self.offsets[i - 1]
+                if prevpos + self.holes[prevpos] == pos:
+                    size += self.remove(prevpos)
+                    removed.append(prevpos)
+                    pos = prevpos
+
+        self.set(pos, size)
+        return removed, (pos, size)
+
+    def take(self, size):
+        """
+        Best fit: use the smallest hole that can hold ``size`` bytes. Return
+        the used offset and the remainder (offset, size) hole (or None), or
+        None if nothing fits
+        """
+        i = bisect.bisect_left(self.sizes, (size, -1))
+        if i == len(self.sizes):
+            return None
+
+        hsize, pos = self.sizes[i]
+        self.remove(pos)
+
+        remainder = None
+        if hsize > size:
+            remainder = (pos + size, hsize - size)
+            self.set(*remainder)
+
+        return pos, remainder
+
+
+class IndexJournal(BaseIO):
+    """
+    Append-only log of index changes since the last checkpoint. Every record
+    is an operation code followed by a ``<BQQQ`` body:
+
+    - ``+``: partition, id, position (+1 as in the index), size
+    - ``-``: partition, id, 0, 0
+    - ``e``: partition, size, position of an empty slot, 0
+    - ``f``: partition, 0, position of an empty slot that was (re)used, 0
+
+    Up to version 2 the size was missing (``<cBQQ``), see legacy().
+
+    Records are buffered in memory until the next flush and appended in one
+    write, so a single change costs O(1) I/O instead of a full index dump.
+    """
+    LENGTH = 26
+    RECORD = struct.Struct("<cBQQQ")
+    V2_RECORD = struct.Struct("<cBQQ")
+
+    OP_SET = b"+"
+    OP_DEL = b"-"
+    OP_EMPTY = b"e"
+    OP_FREE = b"f"
 
     def __init__(self, fd):
+        super(IndexJournal, self).__init__(fd)
+        self.pending = []
+        self.records = 0
+        self.record = IndexJournal.RECORD
+
+    def legacy(self, legacy=True):
+        """
+        Read version 2 records until the next reset()
+        """
+        self.record = IndexJournal.V2_RECORD if legacy else IndexJournal.RECORD
+
+    def append(self, op, part, key, value, size=0):
+        self.pending.append(IndexJournal.RECORD.pack(op, part, key, value, size))
+
+    def read(self, pos=0, seek=True):
+        """
+        Return all the records in the journal as (op, part, key, value, size)
+        tuples. A torn record at the end (crash while appending) is ignored.
+        """
+        if seek:
+            self.seek(pos)
+
+        data = self.fd.read()
+        usable = len(data) - len(data) % self.record.size
+        if usable != len(data):
+            lg.warning("Ignoring %d bytes of torn journal record" % (len(data) - usable))
+
+        records = list(self.record.iter_unpack(data[:usable]))
+        if self.record is IndexJournal.V2_RECORD:
+            records = [record + (0,) for record in records]
+        self.records = len(records)
+        return records
+
+    def write(self, pos=None, seek=False):
+        """
+        Append the pending records, return how many were written
+        """
+        if not self.pending:
+            return 0
+
+        # Writers may log under their partition lock only, do not lose them
+        pending, self.pending = self.pending, []
+
+        self.fd.seek(0, 2)
+        self.fd.write(b"".join(pending))
+        self.fd.flush()
+
+        self.records += len(pending)
+        return len(pending)
+
+    def reset(self):
+        """
+        Empty the journal (after its content was folded into the index)
+        """
+        self.pending = []
+        self.records = 0
+        self.record = IndexJournal.RECORD
+        self.fd.seek(0)
+        self.fd.truncate()
+        self.fd.flush()
+
+    def close(self):
+        self.fd.close()
+
+
+class Index(object):
+
+    JOURNAL_MIN = 10000
+    """Minimum number of journal records before a checkpoint"""
+
+    def __init__(self, fd, jfd=None):
         self.fd = fd
         self.header = None
         self.clean = True
         self.lock = RLock()
+        self.journal = IndexJournal(jfd) if jfd is not None else None
         self.load()
 
     def load(self):
@@ -121,14 +362,57 @@ class Index(object):
             if self.header.version == -1:
                 lg.debug("No header in the index file... initializing")
                 self._initHeader()
+            elif self.header.version > IndexHeader.VERSION:
+                raise UnsupportedVersionError(
+                    "Database version %d is newer than %d" % (self.header.version, IndexHeader.VERSION))
+
+            if self.journal is not None:
+                self.journal.legacy(self.header.version < 3)
             self._loadIndex()
 
+            if self.header.version < IndexHeader.VERSION:
+                self._upgrade()
+
+    def _upgrade(self):
+        """
+        Bring an older database to the current version. No need to lock
+        ... parent did
+        """
+        lg.info("Upgrading database from version %d to %d" % (self.header.version, IndexHeader.VERSION))
+
+        # Version 2 only adds TLV types, old data remain valid
+        self.header.version = IndexHeader.VERSION
+        self.header.write()
+        self.fd.flush()
+
     def create(self, part, id, pos):
         pass
 
+    def addPartition(self):
+        """
+        Add an empty partition and return its number
+        """
+        pass
+
+    def countItems(self):
+        return self.header.items
+
+    def range(self, lo=1, hi=None):
+        """
+        Iterate (id, partition, position) of the entries with
+        ``lo <= id < hi`` in ID order
+        """
+        pass
+
     def get(self, tlvid):
         pass
 
+    def getSize(self, tlvid):
+        """
+        Size of the entry, None if not known
+        """
+        return None
+
     def update(self, tlv):
         pass
 
@@ -142,16 +426,51 @@ class Index(object):
         pass
 
     def flush(self):
+        """
+        Persist pending changes. With a journal this only appends the changed
+        entries; the whole index is rewritten once the journal grows larger
+        than the index itself (amortized O(1) per change)
+        """
+        with self.lock:
+            if self.journal is None:
+                return self.checkpoint()
+
+            pending = len(self.journal.pending)
+            if self.journal.records + pending > max(Index.JOURNAL_MIN, self.countItems()):
+                return self.checkpoint()
+
+            lg.debug("Appending %d entries to the index journal" % pending)
+            self.journal.write()
+
+    def checkpoint(self):
+        """
+        Fold everything into the base index file and empty the journal
+        """
         with self.lock:
             lg.info("Flushing Index")
+            self.header.items = self.countItems()
             self.header.write()
             self._dumpIndex()
             self.fd.flush()
             self.fd.truncate()
 
+            if self.journal is not None:
+                self.journal.reset()
+
+    def _log(self, op, part, key, value, size=0):
+        """
+        Record a change in the journal (if any). Caller holds the index or the
+        partition lock
+        """
+        if self.journal is not None:
+            self.journal.append(op, part, key, value, size)
+
     def close(self):
         # make sure no one is writing/flushing
         with self.lock:
+            if self.journal is not None:
+                self.journal.write()
+                self.journal.close()
             self.fd.close()
 
 class HashIndex(Index):
@@ -164,23 +483,38 @@ class HashIndex(Index):
     - Each partition can have maximum 2**64 -1 number of Bytes
     - Each index can have maximum 2**64 -1 number of Items
 
-    Therefore the index format is BQQ.
+    Therefore the index format is BQQQ: partition, id, position + 1 and the
+    size of the entry (0: unknown, as after an upgrade from version 2).
 
     There is however a special partition! That is partition 255 which contains
-    the empty spaces in all other partitions. Its format is BB7BQ:
+    the empty spaces in all other partitions. Its format is BB7BQQ:
 
     - B: 255
     - B: partition number
     - 7B: size available
     - Q: position
+    - Q: 0
+
+    Entries are placed in partitions by TlvStorage (see tlvpolicy). IDs are
+    allocated densely, so in memory the entries are two vectors indexed by ID:
 
-    NOTE: Partition 0 is the only one tested!
+    - offsets: array of Q, the position + 1 (0: no such entry, as on disk)
+    - parts: bytearray, the partition
+    - sizes: array of I, the size (0: unknown or 4GB and more)
+
+    That is 13 bytes per ID instead of a dict entry. Lookups do not depend on
+    the number of partitions and take no lock.
     """
 
-    def __init__(self, *args):
+    def __init__(self, *args, **kwargs):
         self.partitions = []
+        self.offsets = array("Q")
+        self.parts = bytearray()
+        self.sizes = array("I")
         self.nextid = 1
-        super(HashIndex, self).__init__(*args)
+        # Upgraded from a version without sizes, see TlvStorage
+        self.migrated = False
+        super(HashIndex, self).__init__(*args, **kwargs)
 
     def reload(self):
         """
@@ -188,71 +522,249 @@ class HashIndex(Index):
         """
         with self.lock:
             self.partitions = []
+            self.offsets = array("Q")
+            self.parts = bytearray()
+            self.sizes = array("I")
             self.nextid = 1
+            if self.journal is not None:
+                self.journal.pending = []
 
         # This will re-lock
         self.load()
 
 
-    def create(self, part, tid, pos):
-        with self.lock:
+    def create(self, part, tid, pos, size=0):
+        """
+        Register a new entry of ``size`` bytes. Only the partition is locked
+        so that writers of different partitions do not wait for each other:
+        ``tid`` should come from reserve()
+        """
+        with self.partitions[part]["lock"]:
             self.clean = False
-            self.header.items += 1
-            self.nextid += 1
+            if self.nextid <= tid:
+                self.nextid = tid + 1
+            self._log(IndexJournal.OP_SET, part, tid, pos + 1, size)
 
-        with self.partitions[part]["lock"]:
-            # Start indexing from 1: 0 is empty!
-            self.partitions[part]["index"][tid] = pos + 1
+            self._set(part, tid, pos)
+            self._setSize(tid, size)
             self.partitions[part]["items"] += 1
 
-    def update(self, part, tid, pos):
+    def reserve(self, count=1):
+        """
+        Reserve ``count`` consecutive IDs and return the first one
+        """
         with self.lock:
+            first = self.nextid
+            self.nextid += count
+            return first
+
+    def createMany(self, part, entries):
+        """
+        Register many (tid, pos, size) entries of a partition under a single
+        lock acquisition. IDs should come from reserve()
+        """
+        with self.partitions[part]["lock"]:
             self.clean = False
+            for tid, pos, size in entries:
+                if self.nextid <= tid:
+                    self.nextid = tid + 1
+                self._log(IndexJournal.OP_SET, part, tid, pos + 1, size)
+                self._set(part, tid, pos)
+                self._setSize(tid, size)
+            self.partitions[part]["items"] += len(entries)
+
+    def addPartition(self):
+        with self.lock:
+            if len(self.partitions) >= IndexHeader.MAX_PARTITIONS:
+                raise PartitionLimitError("No more than %d partitions" % IndexHeader.MAX_PARTITIONS)
 
+            self.partitions.append(self._newPartition())
+            self.header.partitions = len(self.partitions)
+
+            # The journal can only refer to partitions the header knows of
+            self.checkpoint()
+            return len(self.partitions) - 1
+
+    def countItems(self):
+        return sum(p["items"] for p in self.partitions)
+
+    def checkpoint(self):
+        # Creates only hold their partition lock: keep them out until the
+        # journal is reset, or their records would be lost
+        with self.lock, ExitStack() as stack:
+            for p in self.partitions:
+                stack.enter_context(p["lock"])
+            super(HashIndex, self).checkpoint()
+
+    def update(self, part, tid, pos, size=None):
+        """
+        Move an entry inside its partition, ``size`` None keeps the size.
+        Only the partition is locked, as in create()
+        """
         with self.partitions[part]["lock"]:
-            # Start indexing from 1: 0 is empty!
-            self.partitions[part]["index"][tid] = pos + 1
+            if size is None:
+                size = self.getSize(tid) or 0
+            self.clean = False
+            self._log(IndexJournal.OP_SET, part, tid, pos + 1, size)
+            self._set(part, tid, pos)
+            self._setSize(tid, size)
+
+    def relocate(self, part, tid, pos):
+        """
+        In memory move without journaling: the caller checkpoints (vacuum)
+        """
+        self._set(part, tid, pos)
+
+    def setSize(self, tid, size):
+        """
+        In memory size without journaling: the caller checkpoints
+        """
+        self._setSize(tid, size)
+
+    def _setSize(self, tid, size):
+        """
+        Caller holds the partition lock
+        """
+        sizes = self.sizes
+        if tid >= len(sizes):
+            sizes.frombytes(bytes((max(tid + 1, len(self.offsets)) - len(sizes)) * sizes.itemsize))
+
+        # Unknown if it does not fit
+        sizes[tid] = size if size < 2**32 else 0
+
+    def _set(self, part, tid, pos):
+        """
+        Caller holds the partition lock
+        """
+        if tid >= len(self.offsets):
+            # Grow geometrically, the partition first: readers check the offset
+            grow = max(tid + 1 - len(self.offsets), len(self.offsets) // 2, 1024)
+            self.parts.extend(bytes(grow))
+            self.offsets.frombytes(bytes(grow * self.offsets.itemsize))
+
+        self.parts[tid] = part
+        # Start indexing from 1: 0 is empty!
+        self.offsets[tid] = pos + 1
+
+    def _unset(self, tid):
+        """
+        Caller holds the partition lock
+        """
+        self.offsets[tid] = 0
+        if tid < len(self.sizes):
+            self.sizes[tid] = 0
 
     def get(self, tlvid):
-        with self.lock:
-            for part, p in enumerate(self.partitions):
-                if tlvid in p["index"]:
-                    return part, p["index"][tlvid] - 1
+        """
+        Return (partition, position) or (False, None). Lock free: entries are
+        replaced atomically, callers check again under the partition file lock
+        if they need the entry to stay put
+        """
+        try:
+            npos = self.offsets[tlvid]
+        except IndexError:
+            return False, None
+
+        if npos == 0:
             return False, None
+        return self.parts[tlvid], npos - 1
 
+    def getSize(self, tlvid):
+        """
+        Lock free as get(), check it under the partition file lock
+        """
+        try:
+            return self.sizes[tlvid] or None
+        except IndexError:
+            return None
+
+    def range(self, lo=1, hi=None):
+        offsets, parts = self.offsets, self.parts
+        hi = len(offsets) if hi is None else min(hi, len(offsets))
+        for tid in range(max(lo, 0), hi):
+            if offsets[tid]:
+                yield tid, parts[tid], offsets[tid] - 1
+
+    def entries(self, part):
+        """
+        (position, id) pairs of a partition sorted by position
+        """
+        offsets, parts = self.offsets, self.parts
+        return sorted((offsets[tid] - 1, tid) for tid in range(0, len(offsets))
+            if offsets[tid] and parts[tid] == part)
 
     def delete(self, tlvid):
         """
         Remove an object from the index and return its old position
         """
         with self.lock:
-            for part, p in enumerate(self.partitions):
-                if tlvid not in p["index"]:
-                    continue
+            part, oldpos = self.get(tlvid)
+            if part is False:
+                return False, None
 
-                # DEPRECATED: Check if already deleted...
-                # This is a reserved position in the index
-                if p["index"][tlvid] == 0:
-                    return False, None
-                oldpos = p["index"][tlvid] - 1
-                del p["index"][tlvid]
-                self.header.items -= 1
+            p = self.partitions[part]
+            with p["lock"]:
+                self._unset(tlvid)
                 p["items"] -= 1
                 self.clean = False
-                return part, oldpos
-
-            return False, None
+                self._log(IndexJournal.OP_DEL, part, tlvid, 0)
+            return part, oldpos
 
     def setEmpty(self, part, oldpos, del_size):
-        # Simple in memory lock
+        # Simple in memory lock (callers may hold the partition file lock, so
+        # do not take the index lock here)
+        with self.partitions[part]["lock"]:
+            removed, hole = self.partitions[part]["empty"].add(oldpos, del_size)
+            for pos in removed:
+                self._log(IndexJournal.OP_FREE, part, 0, pos)
+            self._log(IndexJournal.OP_EMPTY, part, hole[1], hole[0])
+
+    def clearEmpty(self, part, lo, hi):
+        """
+        Forget the empty slots starting in ``[lo, hi)``, they have been
+        filled (compaction)
+        """
         with self.partitions[part]["lock"]:
-            self.partitions[part]["empty"][oldpos] = del_size
+            empty = self.partitions[part]["empty"]
+            for pos in [pos for pos in empty if lo <= pos < hi]:
+                empty.remove(pos)
+                self._log(IndexJournal.OP_FREE, part, 0, pos)
+
+    def allocate(self, part, size):
+        """
+        Reuse an empty slot that can hold ``size`` bytes. Return its position
+        or None if there is no such slot
+        """
+        with self.partitions[part]["lock"]:
+            found = self.partitions[part]["empty"].take(size)
+            if found is None:
+                return None
+
+            pos, remainder = found
+            self._log(IndexJournal.OP_FREE, part, 0, pos)
+            if remainder is not None:
+                self._log(IndexJournal.OP_EMPTY, part, remainder[1], remainder[0])
+
+            return pos
+
+    def _upgrade(self):
+        """
+        Rewrite the entries of a version without sizes in the current format.
+        The sizes are unknown until TlvStorage measures them (``migrated``)
+        """
+        if self.header.version >= 3:
+            return super(HashIndex, self)._upgrade()
+
+        lg.info("Upgrading index from version %d to %d" % (self.header.version, IndexHeader.VERSION))
+        self.header.version = IndexHeader.VERSION
+        self.migrated = True
+        self.checkpoint()
 
     def _initHeader(self):
         """
         No need to lock ... parent did
         """
-        self.header.version = 1
+        self.header.version = IndexHeader.VERSION
         self.header.type = IndexHeader.TYPE_HASH
         self.header.items = 0
         self.header.partitions = 1
@@ -270,42 +782,96 @@ class HashIndex(Index):
         data_len = len(data)
 
         for i in range(0, self.header.partitions):
-            self.partitions.append({
-                "index": {},
-                "empty": {},
-                "items": 0,
-                "lock": RLock()
-            })
-
-        # parse it
-        # for i in range(0, self.header.items):
-        datapos = 0
-        while datapos < data_len:
-            # lg.debug("Reading index entry from=%d to to=%d" % (datapos, datapos+IndexEntry.LENGTH))
-            part, tid, npos = struct.unpack("<BQQ", data[datapos:datapos + IndexEntry.LENGTH])
-            datapos += IndexEntry.LENGTH
-
-            if part == 255:
-                size = tid
-                part = 0
-                # Split to new format
-                if size != 0:
-                    size<<=1*8
-                    part = tid
-                    part>>7*8
-
-                # Mark it
-                self.partitions[part]["empty"][npos] = size
-                continue
-
-            self.partitions[part]["index"][tid] = npos
-            self.partitions[part]["items"] += 1
-
-            # if npos == 0:
-            #     self.header.empty += 1
-
-            if self.nextid <= tid:
-                self.nextid = tid + 1
+            self.partitions.append(self._newPartition())
+
+        # parse it in one go, up to version 2 without the sizes
+        if self.header.version < 3:
+            fmt, length = IndexEntry.V2_FORMAT, IndexEntry.V2_LENGTH
+        else:
+            fmt, length = IndexEntry.FORMAT, IndexEntry.LENGTH
+
+        usable = data_len - data_len % length
+        if usable != data_len:
+            lg.warning("Ignoring %d trailing bytes of the index" % (data_len - usable))
+
+        records = list(struct.iter_unpack(fmt, memoryview(data)[:usable]))
+        if length == IndexEntry.V2_LENGTH:
+            records = [record + (0,) for record in records]
+        live = [r for r in records if r[0] != 255]
+
+        if live:
+            parts, tids, nposs, sizes = zip(*live)
+            top = max(tids) + 1
+            if self.nextid < top:
+                self.nextid = top
+
+            # Allocate the vectors once, then fill them
+            self.parts = bytearray(top)
+            self.offsets = array("Q", bytes(top * self.offsets.itemsize))
+            self.sizes = array("I", bytes(top * self.sizes.itemsize))
+            offsets, vparts, vsizes = self.offsets, self.parts, self.sizes
+            for part, tid, npos, size in live:
+                vparts[tid] = part
+                # DEPRECATED: 0 was a reserved (deleted) position
+                offsets[tid] = npos
+                vsizes[tid] = size
+
+            for part, items in Counter(compress(parts, nposs)).items():
+                self.partitions[part]["items"] += items
+
+        # The empty slots (partition 255): BB7BQQ
+        empty = [[] for p in self.partitions]
+        for _, combo, pos, _ in (r for r in records if r[0] == 255):
+            empty[combo >> 7*8].append((pos, combo & (2**(7*8) - 1)))
+
+        for p, holes in zip(self.partitions, empty):
+            p["empty"].load(holes)
+
+        if self.journal is not None:
+            self._replayJournal()
+
+        self.header.items = sum(p["items"] for p in self.partitions)
+
+    def _newPartition(self):
+        return {
+            "empty": FreeSpace(),
+            "items": 0,
+            "lock": RLock()
+        }
+
+    def _replayJournal(self):
+        """
+        Apply the changes logged after the last checkpoint. No need to lock
+        ... parent did
+        """
+        records = self.journal.read()
+        lg.debug("Replaying %d index journal records" % len(records))
+
+        for op, part, key, value, size in records:
+            p = self.partitions[part]
+            if op == IndexJournal.OP_SET:
+                old = self.get(key)[0]
+                if old is False:
+                    p["items"] += 1
+                elif old != part:
+                    self.partitions[old]["items"] -= 1
+                    p["items"] += 1
+                self._set(part, key, value - 1)
+                self._setSize(key, size)
+
+                if self.nextid <= key:
+                    self.nextid = key + 1
+            elif op == IndexJournal.OP_DEL:
+                if self.get(key)[0] is not False:
+                    self._unset(key)
+                    p["items"] -= 1
+            elif op == IndexJournal.OP_EMPTY:
+                p["empty"].set(value, key)
+            elif op == IndexJournal.OP_FREE:
+                if value in p["empty"]:
+                    p["empty"].remove(value)
+            else:
+                lg.warning("Unknown journal operation %s" % op)
 
     def _dumpIndex(self):
         """
@@ -314,17 +880,19 @@ class HashIndex(Index):
         # skip header (already read)
         self.fd.seek(IndexHeader.LENGTH)
 
-        for part, cont in enumerate(self.partitions):
-            for tid, pos in cont["index"].items():
-                # lg.debug("Dumping index entry port=%d pos=%d" % (part, pos))
-                data = struct.pack("<BQQ", part, tid, pos)
+        offsets, parts = self.offsets, self.parts
+        for tid in range(0, len(offsets)):
+            if offsets[tid]:
+                data = struct.pack(IndexEntry.FORMAT, parts[tid], tid, offsets[tid],
+                    self.getSize(tid) or 0)
                 self.fd.write(data)
 
+        for part, cont in enumerate(self.partitions):
             for pos, size in cont["empty"].items():
                 combo = part
                 combo <<= 7*8
                 combo |= size
-                data = struct.pack("<BQQ", 255, combo, pos)
+                data = struct.pack(IndexEntry.FORMAT, 255, combo, pos, 0)
                 self.fd.write(data)
 
 
@@ -342,3 +910,725 @@ class HashIndex(Index):
                 "          Free: %d\n"
             ) % (s, part, cont["items"], len(cont["empty"]))
         return s
+
+
+class SidecarIndex(HashIndex):
+    """
+    Base of the indexes that keep their entries on disk and only read a small
+    sidecar file at open: the empty slots and the item counts of the
+    partitions (``<BQQ`` entries as in the version 2 HashIndex, ``part,
+    items, 0`` for the counts), rewritten on flush when changed. Entries are
+    updated in place, there is no journal. They do not store the entry
+    sizes, getSize() is always None.
+    """
+
+    def __init__(self, fd, sfd=None):
+        self.sfd = sfd
+        self.dirty = False
+        # Guards the on-disk structure, shared by all partitions
+        self.tlock = Lock()
+        super(SidecarIndex, self).__init__(fd)
+
+    def _syncEntries(self):
+        """
+        Persist the entries. Caller holds the structure lock
+        """
+        pass
+
+    def _closeEntries(self):
+        pass
+
+    def _loadSidecar(self):
+        """
+        No need to lock ... parent did
+        """
+        for i in range(0, self.header.partitions):
+            self.partitions.append(self._newPartition())
+
+        if self.sfd is None:
+            return
+
+        self.sfd.seek(0)
+        data = self.sfd.read()
+        empty = [[] for p in self.partitions]
+        usable = len(data) - len(data) % IndexEntry.V2_LENGTH
+        for part, key, value in struct.iter_unpack(IndexEntry.V2_FORMAT, data[:usable]):
+            if part == 255:
+                empty[key >> 7*8].append((value, key & (2**(7*8) - 1)))
+            else:
+                self.partitions[part]["items"] = key
+
+        for p, holes in zip(self.partitions, empty):
+            p["empty"].load(holes)
+
+        self.header.items = self.countItems()
+
+    def _log(self, op, part, key, value, size=0):
+        """
+        Entries are written in place, only remember that the sidecar changed
+        """
+        self.dirty = True
+
+    def _upgrade(self):
+        # Entries have no room for the sizes, the format did not change
+        Index._upgrade(self)
+
+    def _setSize(self, tid, size):
+        pass
+
+    def getSize(self, tlvid):
+        return None
+
+    def checkpoint(self):
+        with self.lock, ExitStack() as stack:
+            for p in self.partitions:
+                stack.enter_context(p["lock"])
+
+            with self.tlock:
+                self.header.items = self.countItems()
+                self.header.write()
+                self._syncEntries()
+                self.fd.flush()
+
+            if self.dirty and self.sfd is not None:
+                self._dumpSidecar()
+                self.dirty = False
+
+    def flush(self):
+        self.checkpoint()
+
+    def _dumpSidecar(self):
+        data = bytearray()
+        for part, cont in enumerate(self.partitions):
+            data += struct.pack(IndexEntry.V2_FORMAT, part, cont["items"], 0)
+            for pos, size in cont["empty"].items():
+                data += struct.pack(IndexEntry.V2_FORMAT, 255, part << 7*8 | size, pos)
+
+        self.sfd.seek(0)
+        self.sfd.write(data)
+        self.sfd.truncate()
+        self.sfd.flush()
+
+    def close(self):
+        with self.lock:
+            self.dirty = True
+            self.checkpoint()
+            self._closeEntries()
+            if self.sfd is not None:
+                self.sfd.close()
+            self.fd.close()
+
+
+class DiskHashIndex(SidecarIndex):
+    """
+    Open addressing hash table stored in the index file and probed in place
+    through a memory map, so opening a database does not read its entries.
+    After the header comes a meta block and the table:
+
+    - meta ``<QQQ``: capacity (slots), used slots (including deleted ones),
+      next ID
+    - slot ``<QQ``: ID (0: empty, 2**64-1: deleted), partition << 56 |
+      position + 1
+
+    Slots are found with Fibonacci hashing and linear probing. The table
+    doubles when it is 70% used. The empty slots of the partitions and their
+    item counts are kept in the sidecar file (see SidecarIndex).
+    """
+
+    META = struct.Struct("<QQQ")
+    META_START = IndexHeader.LENGTH
+    TABLE_START = IndexHeader.LENGTH + 64
+
+    SLOT = struct.Struct("<QQ")
+    EMPTY = 0
+    DELETED = 2**64 - 1
+
+    MIN_CAPACITY = 1024
+    LOAD = 0.7
+
+    def __init__(self, fd, sfd=None):
+        self.map = None
+        self.capacity = 0
+        self.used = 0
+        self.gen = 0
+        super(DiskHashIndex, self).__init__(fd, sfd)
+
+    def reload(self):
+        with self.lock:
+            self.partitions = []
+            self.nextid = 1
+            if self.map is not None:
+                self.map.close()
+                self.map = None
+
+        self.load()
+
+    def get(self, tlvid):
+        """
+        Probe the map without locking, retry if the table was resized
+        meanwhile
+        """
+        while True:
+            gen = self.gen
+            if gen % 2:
+                # Resizing, wait for it
+                with self.tlock:
+                    continue
+
+            m, capacity = self.map, self.capacity
+            found = self._find(m, capacity, tlvid)[1]
+            if self.gen != gen:
+                continue
+
+            if found is None:
+                return False, None
+            return found >> 56, (found & (2**56 - 1)) - 1
+
+    def entries(self, part):
+        m = self.map
+        table = m[DiskHashIndex.TABLE_START:DiskHashIndex.TABLE_START + self.capacity * DiskHashIndex.SLOT.size]
+        return sorted(((value & (2**56 - 1)) - 1, tid)
+            for tid, value in DiskHashIndex.SLOT.iter_unpack(table)
+            if tid != DiskHashIndex.EMPTY and tid != DiskHashIndex.DELETED and value >> 56 == part)
+
+    def range(self, lo=1, hi=None):
+        m = self.map
+        table = m[DiskHashIndex.TABLE_START:DiskHashIndex.TABLE_START + self.capacity * DiskHashIndex.SLOT.size]
+        found = sorted((tid, value) for tid, value in DiskHashIndex.SLOT.iter_unpack(table)
+            if tid != DiskHashIndex.EMPTY and tid != DiskHashIndex.DELETED and
+                lo <= tid and (hi is None or tid < hi))
+        for tid, value in found:
+            yield tid, value >> 56, (value & (2**56 - 1)) - 1
+
+    def _slot(self, capacity, tid):
+        # Fibonacci hashing, capacity is a power of 2
+        return ((tid * 11400714819323198485) & (2**64 - 1)) >> (64 - capacity.bit_length() + 1)
+
+    def _find(self, m, capacity, tid):
+        """
+        Return the offset of the slot of ``tid`` (or of the first free one to
+        use for it) and its value (None if not found)
+        """
+        free = None
+        i = self._slot(capacity, tid)
+        for n in range(0, capacity):
+            offset = DiskHashIndex.TABLE_START + i * DiskHashIndex.SLOT.size
+            key, value = DiskHashIndex.SLOT.unpack_from(m, offset)
+            if key == tid:
+                return offset, value
+            if key == DiskHashIndex.EMPTY:
+                return offset if free is None else free, None
+            if key == DiskHashIndex.DELETED and free is None:
+                free = offset
+            i = (i + 1) & (capacity - 1)
+
+        return free, None
+
+    def _set(self, part, tid, pos):
+        with self.tlock:
+            offset, value = self._find(self.map, self.capacity, tid)
+            if value is None:
+                key = DiskHashIndex.SLOT.unpack_from(self.map, offset)[0]
+                if key == DiskHashIndex.EMPTY:
+                    if self.used + 1 > self.capacity * DiskHashIndex.LOAD:
+                        self._resize(self.capacity * 2)
+                        offset = self._find(self.map, self.capacity, tid)[0]
+                    self.used += 1
+
+            DiskHashIndex.SLOT.pack_into(self.map, offset, tid, part << 56 | (pos + 1))
+
+    def _unset(self, tid):
+        with self.tlock:
+            offset, value = self._find(self.map, self.capacity, tid)
+            if value is not None:
+                DiskHashIndex.SLOT.pack_into(self.map, offset, DiskHashIndex.DELETED, 0)
+
+    def _resize(self, capacity):
+        """
+        Rehash into a table of ``capacity`` slots (dropping deleted ones).
+        Caller holds the table lock
+        """
+        lg.info("Resizing disk hash index to %d slots" % capacity)
+        old = self.map[DiskHashIndex.TABLE_START:DiskHashIndex.TABLE_START + self.capacity * DiskHashIndex.SLOT.size]
+        live = [(tid, value) for tid, value in DiskHashIndex.SLOT.iter_unpack(old)
+            if tid != DiskHashIndex.EMPTY and tid != DiskHashIndex.DELETED]
+
+        table = bytearray(DiskHashIndex.TABLE_START + capacity * DiskHashIndex.SLOT.size)
+        for tid, value in live:
+            offset = self._find(table, capacity, tid)[0]
+            DiskHashIndex.SLOT.pack_into(table, offset, tid, value)
+
+        # Readers retry while the generation is odd or changed
+        self.gen += 1
+        self.fd.seek(DiskHashIndex.TABLE_START)
+        self.fd.write(memoryview(table)[DiskHashIndex.TABLE_START:])
+        self.fd.flush()
+
+        # Readers may still use the old map, let the GC close it
+        self.map = mmap.mmap(self.fd.fileno(), 0)
+        self.capacity = capacity
+        self.used = len(live)
+        self._writeMeta()
+        self.gen += 1
+
+    def _writeMeta(self):
+        DiskHashIndex.META.pack_into(self.map, DiskHashIndex.META_START,
+            self.capacity, self.used, self.nextid)
+
+    def _initHeader(self):
+        """
+        No need to lock ... parent did
+        """
+        self.header.version = IndexHeader.VERSION
+        self.header.type = IndexHeader.TYPE_DISKHASH
+        self.header.items = 0
+        self.header.partitions = 1
+        self.header.write()
+
+        self.fd.write(b"\0" * (DiskHashIndex.TABLE_START - IndexHeader.LENGTH))
+        self.fd.write(b"\0" * DiskHashIndex.MIN_CAPACITY * DiskHashIndex.SLOT.size)
+        self.fd.flush()
+        self.map = mmap.mmap(self.fd.fileno(), 0)
+        self.capacity = DiskHashIndex.MIN_CAPACITY
+        self._writeMeta()
+
+    def _loadIndex(self):
+        """
+        Map the table and read the sidecar. No need to lock ... parent did
+        """
+        if self.map is None:
+            self.fd.flush()
+            self.map = mmap.mmap(self.fd.fileno(), 0)
+            self.capacity, self.used, self.nextid = DiskHashIndex.META.unpack_from(
+                self.map, DiskHashIndex.META_START)
+
+        self._loadSidecar()
+
+    def _syncEntries(self):
+        self._writeMeta()
+        self.map.flush()
+
+    def _closeEntries(self):
+        self.map.close()
+
+
+class BTreeNode(object):
+    """
+    A page of the BTreeIndex. Leaves hold the entries (``values`` are
+    partition << 56 | position + 1) and link to the next leaf, inner nodes
+    hold the separator keys and one more child page than keys
+    """
+
+    def __init__(self, page, leaf, keys=None, values=None, next=0):
+        self.page = page
+        self.leaf = leaf
+        self.keys = keys if keys is not None else []
+        self.values = values if values is not None else []
+        self.next = next
+        self.dirty = True
+
+
+class BTreeIndex(SidecarIndex):
+    """
+    B+tree of the IDs stored in pages of the index file and read on demand
+    through an LRU page cache, so only the visited part of the index is
+    loaded. Leaves are linked for ordered range scans. Page 0 holds the
+    header and the meta ``<QQQ`` (root page, number of pages, next ID), every
+    other page is a node:
+
+    - ``<BHQ``: leaf (1) or inner (2), number of keys, next leaf page
+    - leaf: key, value pairs as ``Q``
+    - inner: the keys, then the child pages as ``Q``
+
+    Deletes just remove the key from its leaf, nodes are never merged.
+    Appending IDs (the common case) splits the last node unevenly so pages
+    stay full.
+    """
+
+    PAGE = 4096
+    META = struct.Struct("<QQQ")
+    META_START = IndexHeader.LENGTH
+
+    NODE = struct.Struct("<BHQ")
+    NODE_HEADER = 16
+    LEAF = 1
+    INNER = 2
+
+    LEAF_MAX = (PAGE - NODE_HEADER) // 16
+    INNER_MAX = (PAGE - NODE_HEADER - 8) // 16
+
+    CACHE_PAGES = 1024
+    """Pages kept in memory"""
+
+    def __init__(self, fd, sfd=None):
+        self.cache = OrderedDict()
+        self.root = 1
+        self.pages = 2
+        super(BTreeIndex, self).__init__(fd, sfd)
+
+    def reload(self):
+        with self.lock:
+            self.partitions = []
+            self.nextid = 1
+            self.cache = OrderedDict()
+
+        self.load()
+
+    def get(self, tlvid):
+        with self.tlock:
+            node = self._findLeaf(tlvid)
+            i = bisect.bisect_left(node.keys, tlvid)
+            if i == len(node.keys) or node.keys[i] != tlvid:
+                return False, None
+            value = node.values[i]
+
+        return value >> 56, (value & (2**56 - 1)) - 1
+
+    def range(self, lo=1, hi=None):
+        """
+        Walk the leaves, holding the lock for one leaf at a time
+        """
+        with self.tlock:
+            page = self._findLeaf(lo).page
+
+        while page:
+            with self.tlock:
+                node = self._node(page)
+                i = bisect.bisect_left(node.keys, lo)
+                j = len(node.keys) if hi is None else bisect.bisect_left(node.keys, hi)
+                found = list(zip(node.keys[i:j], node.values[i:j]))
+                page = 0 if j < len(node.keys) else node.next
+
+            for tid, value in found:
+                yield tid, value >> 56, (value & (2**56 - 1)) - 1
+
+            # Nodes may split meanwhile, never go back
+            if found:
+                lo = found[-1][0] + 1
+
+    def entries(self, part):
+        return sorted((pos, tid) for tid, p, pos in self.range() if p == part)
+
+    def _set(self, part, tid, pos):
+        with self.tlock:
+            split = self._insert(self._node(self.root), tid, part << 56 | (pos + 1))
+            if split is not None:
+                # Grow a new root
+                key, page = split
+                root = self._newNode(False, [key], [self.root, page])
+                self.root = root.page
+
+    def _unset(self, tid):
+        with self.tlock:
+            node = self._findLeaf(tid)
+            i = bisect.bisect_left(node.keys, tid)
+            if i < len(node.keys) and node.keys[i] == tid:
+                del node.keys[i]
+                del node.values[i]
+                node.dirty = True
+
+    def _findLeaf(self, key):
+        """
+        Caller holds the tree lock
+        """
+        node = self._node(self.root)
+        while not node.leaf:
+            node = self._node(node.values[bisect.bisect_right(node.keys, key)])
+        return node
+
+    def _insert(self, node, key, value):
+        """
+        Insert below ``node``, return (separator key, new page) if it split
+        """
+        if node.leaf:
+            i = bisect.bisect_left(node.keys, key)
+            node.dirty = True
+            if i < len(node.keys) and node.keys[i] == key:
+                node.values[i] = value
+                return None
+
+            node.keys.insert(i, key)
+            node.values.insert(i, value)
+            if len(node.keys) <= BTreeIndex.LEAF_MAX:
+                return None
+
+            # Appending: keep this one full
+            mid = len(node.keys) - 1 if i == len(node.keys) - 1 else len(node.keys) // 2
+            new = self._newNode(True, node.keys[mid:], node.values[mid:], node.next)
+            del node.keys[mid:]
+            del node.values[mid:]
+            node.next = new.page
+            return new.keys[0], new.page
+
+        i = bisect.bisect_right(node.keys, key)
+        split = self._insert(self._node(node.values[i]), key, value)
+        if split is None:
+            return None
+
+        node.keys.insert(i, split[0])
+        node.values.insert(i + 1, split[1])
+        node.dirty = True
+        if len(node.keys) <= BTreeIndex.INNER_MAX:
+            return None
+
+        mid = len(node.keys) - 1 if i == len(node.keys) - 1 else len(node.keys) // 2
+        sep = node.keys[mid]
+        new = self._newNode(False, node.keys[mid + 1:], node.values[mid + 1:])
+        del node.keys[mid:]
+        del node.values[mid + 1:]
+        return sep, new.page
+
+    def _newNode(self, leaf, keys, values, next=0):
+        node = BTreeNode(self.pages, leaf, keys, values, next)
+        self.pages += 1
+        self._cache(node)
+        return node
+
+    def _node(self, page):
+        """
+        Get a node through the cache. Caller holds the tree lock
+        """
+        node = self.cache.get(page)
+        if node is not None:
+            self.cache.move_to_end(page)
+            return node
+
+        self.fd.seek(page * BTreeIndex.PAGE)
+        data = self.fd.read(BTreeIndex.PAGE)
+        kind, count, next = BTreeIndex.NODE.unpack_from(data)
+        if kind == BTreeIndex.LEAF:
+            flat = struct.unpack_from("<%dQ" % (2 * count), data, BTreeIndex.NODE_HEADER)
+            node = BTreeNode(page, True, list(flat[0::2]), list(flat[1::2]), next)
+        else:
+            flat = struct.unpack_from("<%dQ" % (2 * count + 1), data, BTreeIndex.NODE_HEADER)
+            node = BTreeNode(page, False, list(flat[:count]), list(flat[count:]))
+
+        node.dirty = False
+        self._cache(node)
+        return node
+
+    def _cache(self, node):
+        self.cache[node.page] = node
+        while len(self.cache) > BTreeIndex.CACHE_PAGES:
+            page, old = self.cache.popitem(last=False)
+            if old.dirty:
+                self._writeNode(old)
+
+    def _writeNode(self, node):
+        data = bytearray(BTreeIndex.PAGE)
+        if node.leaf:
+            BTreeIndex.NODE.pack_into(data, 0, BTreeIndex.LEAF, len(node.keys), node.next)
+            flat = [x for pair in zip(node.keys, node.values) for x in pair]
+        else:
+            BTreeIndex.NODE.pack_into(data, 0, BTreeIndex.INNER, len(node.keys), 0)
+            flat = node.keys + node.values
+        struct.pack_into("<%dQ" % len(flat), data, BTreeIndex.NODE_HEADER, *flat)
+
+        self.fd.seek(node.page * BTreeIndex.PAGE)
+        self.fd.write(data)
+        node.dirty = False
+
+    def _syncEntries(self):
+        for node in self.cache.values():
+            if node.dirty:
+                self._writeNode(node)
+
+        self.fd.seek(BTreeIndex.META_START)
+        self.fd.write(BTreeIndex.META.pack(self.root, self.pages, self.nextid))
+
+    def _initHeader(self):
+        """
+        No need to lock ... parent did
+        """
+        self.header.version = IndexHeader.VERSION
+        self.header.type = IndexHeader.TYPE_BTREE
+        self.header.items = 0
+        self.header.partitions = 1
+        self.header.write()
+
+        self.root = 1
+        self.pages = 1
+        self._newNode(True, [], [])
+        self._syncEntries()
+
+    def _loadIndex(self):
+        """
+        Read the meta and the sidecar, pages are read when needed. No need
+        to lock ... parent did
+        """
+        self.fd.seek(BTreeIndex.META_START)
+        self.root, self.pages, self.nextid = BTreeIndex.META.unpack(
+            self.fd.read(BTreeIndex.META.size))
+
+        self._loadSidecar()
+
+
+class SecondaryIndex(BaseIO):
+    """
+    Index of the ``indexed`` attributes of one IPackable class. For every
+    attribute it keeps a hash (value -> ids) and the sorted distinct values
+    for range queries. It lives in memory and is persisted as an append-only
+    log of dumps() records:
+
+    - ``[b"+", id, attributes, values]``: the indexed values of an object
+    - ``[b"-", id]``: the object was deleted
+
+    The log is rewritten with only the live objects once it grows larger
+    than the index itself (as the index journal).
+    """
+
+    OP_SET = b"+"
+    OP_DEL = b"-"
+
+    def __init__(self, fd):
+        super(SecondaryIndex, self).__init__(fd)
+        self.byid = {}
+        self.hash = {}
+        self.sorted = {}
+        self.pending = []
+        self.records = 0
+        self.lock = RLock()
+        self.read()
+
+    @staticmethod
+    def key(value):
+        """
+        The indexed form of a value: strings as bytes (as they are decoded),
+        sequences as tuples
+        """
+        t = type(value)
+        if t is str:
+            return value.encode("ascii")
+        if t is list or t is tuple:
+            return tuple(SecondaryIndex.key(v) for v in value)
+        return value
+
+    def set(self, tid, values):
+        """
+        Index the ``attribute -> value`` dict of object ``tid``, replacing what
+        was indexed before. None values are not indexed
+        """
+        keys = dict((attr, SecondaryIndex.key(v)) for attr, v in values.items() if v is not None)
+        with self.lock:
+            if self.byid.get(tid) == keys:
+                return
+
+            self._remove(tid)
+            self._add(tid, keys)
+            self.pending.append(dumps([SecondaryIndex.OP_SET, tid, list(keys), list(keys.values())]))
+
+    def remove(self, tid):
+        with self.lock:
+            if tid not in self.byid:
+                return False
+
+            self._remove(tid)
+            self.pending.append(dumps([SecondaryIndex.OP_DEL, tid]))
+            return True
+
+    def find(self, attr, value):
+        """
+        IDs of the objects whose ``attr`` equals ``value``
+        """
+        with self.lock:
+            return set(self.hash.get(attr, {}).get(SecondaryIndex.key(value), ()))
+
+    def range(self, attr, lo=None, hi=None):
+        """
+        IDs of the objects with ``lo <= attr < hi`` ordered by the value
+        (then by ID). None means unbounded
+        """
+        with self.lock:
+            values = self.sorted.get(attr, [])
+            i = 0 if lo is None else bisect.bisect_left(values, SecondaryIndex.key(lo))
+            j = len(values) if hi is None else bisect.bisect_left(values, SecondaryIndex.key(hi))
+
+            ids = []
+            for value in values[i:j]:
+                ids.extend(sorted(self.hash[attr][value]))
+            return ids
+
+    def _add(self, tid, keys):
+        self.byid[tid] = keys
+        for attr, key in keys.items():
+            ids = self.hash.setdefault(attr, {}).setdefault(key, set())
+            if not ids:
+                try:
+                    bisect.insort(self.sorted.setdefault(attr, []), key)
+                except TypeError:
+                    lg.warning("Values of %s can not be ordered, %s is not in range()" % (attr, key))
+            ids.add(tid)
+
+    def _remove(self, tid):
+        keys = self.byid.pop(tid, None)
+        if keys is None:
+            return
+
+        for attr, key in keys.items():
+            ids = self.hash[attr][key]
+            ids.discard(tid)
+            if not ids:
+                del self.hash[attr][key]
+                values = self.sorted.get(attr, [])
+                try:
+                    i = bisect.bisect_left(values, key)
+                except TypeError:
+                    continue
+                if i < len(values) and values[i] == key:
+                    del values[i]
+
+    def read(self, pos=0, seek=True):
+        """
+        Replay the log. A torn record at the end is ignored
+        """
+        if seek:
+            self.seek(pos)
+
+        data = self.fd.read()
+        offset = 0
+        self.records = 0
+        while offset < len(data):
+            try:
+                record, offset = decodeValue(data, offset)
+            except TlvShortBufferError:
+                lg.warning("Ignoring %d bytes of torn secondary index record" % (len(data) - offset))
+                break
+
+            self.records += 1
+            if record[0] == SecondaryIndex.OP_SET:
+                self._remove(record[1])
+                attrs = [attr.decode("ascii") for attr in record[2]]
+                self._add(record[1], dict(zip(attrs, (SecondaryIndex.key(v) for v in record[3]))))
+            elif record[0] == SecondaryIndex.OP_DEL:
+                self._remove(record[1])
+
+    def flush(self):
+        """
+        Append the pending records, or rewrite the log if it grew too much
+        """
+        with self.lock:
+            if self.records + len(self.pending) > max(Index.JOURNAL_MIN, len(self.byid)):
+                return self.checkpoint()
+
+            if not self.pending:
+                return
+
+            pending, self.pending = self.pending, []
+            self.fd.seek(0, 2)
+            self.fd.write(b"".join(pending))
+            self.fd.flush()
+            self.records += len(pending)
+
+    def checkpoint(self):
+        with self.lock:
+            self.pending = []
+            self.fd.seek(0)
+            for tid, keys in self.byid.items():
+                self.fd.write(dumps([SecondaryIndex.OP_SET, tid, list(keys), list(keys.values())]))
+            self.fd.truncate()
+            self.fd.flush()
+            self.records = len(self.byid)
+
+    def close(self):
+        self.flush()
+        self.fd.close()
@@ -0,0 +1,76 @@
+import logging as lg
+from multiprocessing import Lock
+
+
+class PartitionPolicy(object):
+    """
+    Decides in which partition a new entry is stored. ``select()`` is called
+    without any storage lock held, so it may add partitions
+    """
+
+    def select(self, storage, tid, size):
+        """
+        Return the partition for ``size`` bytes of the entry with id ``tid``
+        (the first id for batches)
+        """
+        raise NotImplementedError()
+
+
+class RoundRobinPolicy(PartitionPolicy):
+    """
+    Spread the entries over all partitions in turn
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.next = 0
+
+    def select(self, storage, tid, size):
+        with self.lock:
+            part = self.next % len(storage.dfds)
+            self.next = part + 1
+            return part
+
+
+class HashPolicy(PartitionPolicy):
+    """
+    Place entries by their ID, so the partition of an ID is predictable
+    """
+
+    def select(self, storage, tid, size):
+        return tid % len(storage.dfds)
+
+
+class RolloverPolicy(PartitionPolicy):
+    """
+    Fill the last partition until it reaches ``max_size`` bytes, then add a
+    new one
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.lock = Lock()
+
+    def select(self, storage, tid, size):
+        with self.lock:
+            part = len(storage.dfds) - 1
+            if storage.getPartitionSize(part) + size > self.max_size and storage.getPartitionSize(part) > 0:
+                lg.info("Partition %d is full, rolling over" % part)
+                part = storage.addPartition()
+            return part
+
+
+class LeastFragmentedPolicy(PartitionPolicy):
+    """
+    Prefer the partition with the fewest empty slots per item, the one that
+    least needs a vacuum
+    """
+
+    def select(self, storage, tid, size):
+        best = 0
+        best_frag = None
+        for part, cont in enumerate(storage.index.partitions):
+            frag = len(cont["empty"]) / max(cont["items"], 1)
+            if best_frag is None or frag < best_frag:
+                best, best_frag = part, frag
+        return best
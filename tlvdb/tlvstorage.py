@@ -1,33 +1,68 @@
 import os
+import glob
 import time
+import mmap
 import signal
+import threading
 import logging as lg
+from collections import deque
+from concurrent.futures import Future
 # We are using simple Lock for individual partition fds since noone else is
 # using them
 from multiprocessing import Lock
 
 
 from tlvdb import util
+from tlvdb import tlv
 from tlvdb.tlv import TLV
-from tlvdb.tlvindex import HashIndex
+from tlvdb.tlvindex import IndexHeader, HashIndex, DiskHashIndex, BTreeIndex, FreeSpace, SecondaryIndex
+from tlvdb.tlvpolicy import RoundRobinPolicy
 from tlvdb.tlverrors import *
 from tlvdb.util import DelayedInterrupt
 
 # x MB buffer
 IO_BUFFER_LEN = 1000000
 
+# Index implementation and the extension of its companion file, by type
+INDEX_TYPES = {
+    IndexHeader.TYPE_HASH: (HashIndex, "jnl"),
+    IndexHeader.TYPE_DISKHASH: (DiskHashIndex, "free"),
+    IndexHeader.TYPE_BTREE: (BTreeIndex, "free"),
+}
+
+# read_many() coalesces records closer than this into one read...
+READ_MANY_GAP = 65536
+# ... as long as the read stays below this
+READ_MANY_SPAN = 4 * IO_BUFFER_LEN
+
+# Most bytes compact() moves in one locked step
+COMPACT_CHUNK = IO_BUFFER_LEN
+
 
 class TlvStorage(object):
 
     VERSION = 1
     """Storage version"""
 
-    def __init__(self, index_file, backfill=False, vacuum_thres = 0.1):
+    def __init__(self, index_file, backfill=False, vacuum_thres = 0.1,
+        mmap_reads=False, partitions=1, policy=None,
+        index_type=IndexHeader.TYPE_HASH):
         """
         :param str index_file: Path to the main index file
+        :param bool mmap_reads: Decode reads straight from a read-only memory
+            map of the partitions, without seeking or locking
+        :param int partitions: Minimum number of partitions, missing ones are
+            added
+        :param policy: tlvpolicy.PartitionPolicy placing new entries
+            (default: round-robin)
+        :param int index_type: IndexHeader.TYPE_* of a new database. Existing
+            ones keep the type they were created with. TYPE_DISKHASH opens in
+            constant time, without reading the entries
         """
         self.backfill = backfill
         self.vacuum_thres = vacuum_thres
+        self.mmap_reads = mmap_reads
+        self.policy = policy if policy is not None else RoundRobinPolicy()
 
         # Sort out files
         self.basename = os.path.basename(index_file)
@@ -37,7 +72,23 @@ class TlvStorage(object):
 
         # open fds
         self.ifd = util.create_open(index_file)
-        self.index = HashIndex(self.ifd)
+        found_type = IndexHeader.peekType(self.ifd)
+        if found_type is not None and found_type != index_type:
+            lg.info("Opening existing index of type %d" % found_type)
+            index_type = found_type
+
+        if index_type not in INDEX_TYPES:
+            raise UnsupportedVersionError("Unknown index type %d" % index_type)
+
+        index_class, ext = INDEX_TYPES[index_type]
+        self.jfd = util.create_open("%s/%s.%s" % (self.dirname, self.basename, ext))
+        self.index = index_class(self.ifd, self.jfd)
+
+        # Secondary indexes by class name: <base>.<class>.sdx
+        self.secondary = {}
+        for path in glob.glob("%s/%s.*.sdx" % (self.dirname, self.basename)):
+            name = os.path.basename(path)[len(self.basename) + 1:-len(".sdx")]
+            self.secondary[name] = SecondaryIndex(util.create_open(path))
 
 
         # Global storage lock required for vacuuming and creating
@@ -47,17 +98,54 @@ class TlvStorage(object):
         with self.lock:
             self.dfds = []
             for p in range(0, self.getHeader().partitions):
-                tmppath = "%s/%s.%d.dat" % (self.dirname, self.basename, p)
-                # Open partition
-                tmpfd = util.create_open(tmppath, "r+b", buffering=IO_BUFFER_LEN)
-                self.dfds.append({
-                    "fd": tmpfd,
-                    "path": tmppath,
-                    "lock": Lock()
-                    })
+                self._openPartition(p)
 
             self.clean = True
 
+        while len(self.dfds) < partitions:
+            self.addPartition()
+
+        # Background compact(), see startCompactor()
+        self.compactor = None
+        # Batched flushes, see startGroupCommit()
+        self.committer = None
+
+        if getattr(self.index, "migrated", False):
+            self._measure()
+
+    def _openPartition(self, part):
+        """
+        Caller is responsible of locking
+        """
+        tmppath = "%s/%s.%d.dat" % (self.dirname, self.basename, part)
+        # Open partition
+        tmpfd = util.create_open(tmppath, "r+b", buffering=IO_BUFFER_LEN)
+        self.dfds.append({
+            "fd": tmpfd,
+            "path": tmppath,
+            "lock": Lock(),
+            "map": None,
+            "seq": 0,
+            "dirty": False
+            })
+
+    def addPartition(self):
+        """
+        Add a new (empty) partition and return its number
+        """
+        with self.lock, self.index.lock:
+            part = self.index.addPartition()
+            self._openPartition(part)
+            lg.info("Added partition %d" % part)
+            return part
+
+    def getPartitionSize(self, part):
+        """
+        Bytes used by the partition file (including empty slots)
+        """
+        with self.dfds[part]["lock"]:
+            return self._getDataFileEnd(part)
+
     def _getDataFileEnd(self, part):
         """
         Caller is responsible of locking
@@ -71,7 +159,63 @@ class TlvStorage(object):
         self.dfds[part]["last"] = self.dfds[part]["fd"].tell()
         return self.dfds[part]["last"]
 
+    def _writeData(self, part, pos, data):
+        """
+        Write at the given position. Caller is responsible of locking
+        """
+        p = self.dfds[part]
+
+        # The buffer may spill to the file: let mapped readers know (seqlock)
+        p["seq"] += 1
+        p["fd"].seek(pos)
+        p["fd"].write(data)
+        p["dirty"] = True
+        p["seq"] += 1
+
+    def _flushData(self, part):
+        """
+        Flush the partition buffer, making writes visible to mapped readers.
+        Caller is responsible of locking
+        """
+        p = self.dfds[part]
+        p["seq"] += 1
+        p["fd"].flush()
+        p["dirty"] = False
+        p["seq"] += 1
+
+    def _remap(self, part):
+        """
+        Flush and map the partition again if it grew. Caller is responsible
+        of locking
+        """
+        p = self.dfds[part]
+        if p["dirty"]:
+            self._flushData(part)
+
+        size = os.fstat(p["fd"].fileno()).st_size
+        if p["map"] is not None and len(p["map"]) >= size:
+            return
+
+        if size == 0:
+            p["map"] = None
+            return
+
+        # Readers may still use the old map, let the GC close it
+        lg.debug("Mapping partition %d, %d bytes" % (part, size))
+        p["map"] = mmap.mmap(p["fd"].fileno(), 0, access=mmap.ACCESS_READ)
+
     def _findAGoodPossiotion(self, part, size):
+        """
+        Reuse an empty slot if we know their sizes (backfill), else append.
+        Caller is responsible of locking
+        """
+        # Not while compacting: the holes are about to be overwritten
+        if self.backfill is True and "compact" not in self.dfds[part]:
+            pos = self.index.allocate(part, size)
+            if pos is not None:
+                lg.debug("Reusing empty slot at %d for %d bytes" % (pos, size))
+                return pos
+
         return self._getDataFileEnd(part)
 
 
@@ -80,147 +224,630 @@ class TlvStorage(object):
 
     def endTransaction(self):
         self.in_trance = False
-        self.index.flush()
+        self._flushIndex()
 
-        for p in self.dfds:
+        for part, p in enumerate(self.dfds):
             with p["lock"]:
-                p["fd"].flush()
+                self._flushData(part)
 
     def create(self, packable):
         """
         Create a new entry in the database from the given tlv
         """
-        with self.index.lock:
-            # 1. Find next available ID
-            nextid = self.index.nextid
+        # 1. Find next available ID
+        nextid = self.index.reserve()
 
-            # 2. Find the best partition (TODO)
-            part = 0
+        data = packable.pack()
+        datalen = len(data)
 
-            # 3. Find next pos in data file (TODO: consult index)
-            data = packable.pack()
-            datalen = len(data)
+        # 2. Find the best partition
+        part = self.policy.select(self, nextid, datalen)
 
-            # Lock the partition
-            with self.dfds[part]["lock"]:
-                pos = self._findAGoodPossiotion(part, datalen)
+        # Lock only the partition, writers of other partitions go on
+        with self.dfds[part]["lock"]:
+            # 3. Find next pos in data file
+            pos = self._findAGoodPossiotion(part, datalen)
 
-                # 4. Write data
-                # If in transaction, use the buffer
-                self.dfds[part]["fd"].seek(pos)
-                self.dfds[part]["fd"].write(data)
+            # 4. Write data
+            # If in transaction, use the buffer
+            self._writeData(part, pos, data)
+            if self._getDataFileEnd(part) == pos:
                 self.dfds[part]["last"] += datalen
 
-            # 5. Update index
-            self.index.create(part, nextid, pos)
-            if self.in_trance is False:
-                self.index.flush()
-                with self.dfds[part]["lock"]:
-                    self.dfds[part]["fd"].flush()
+            # 5. Update index (before anyone can vacuum the partition)
+            self.index.create(part, nextid, pos, datalen)
 
-            return nextid
+        self._indexObject(nextid, packable)
+        self._commit([part])
 
-    def read(self, tid, klass=TLV, criteria=None):
+        return nextid
+
+    def read(self, tid, klass=TLV, criteria=None, fields=None):
         """
         Read an object with the given ID into the given class. Default class is
-        TLV. The class should implement IPackable and have a default constructor
+        TLV. The class should implement IPackable and have a default constructor.
+
+        :param fields: decode only these attributes (keys for TLV dicts),
+            skipping the rest of the record. Such an object can not be
+            updated. See also ``tlv.LazyTLV``
         """
         instance = klass()
-        part, pos = self.index.get(tid)
-        if part is False:
-            raise IndexNotFoundError("Could not find item with id=%d" % tid)
 
-        # Lock the partition we are reading from
-        #
-        with self.dfds[part]["lock"]:
-            self.dfds[part]["fd"].seek(pos)
-            instance.unpack(self.dfds[part]["fd"])
+        if self.mmap_reads is True:
+            self._readMapped(tid, instance, fields)
+        else:
+            while True:
+                part, pos = self.index.get(tid)
+                if part is False:
+                    raise IndexNotFoundError("Could not find item with id=%d" % tid)
+
+                # Lock the partition we are reading from. Entries only move
+                # under this lock, so check that it did not move meanwhile
+                with self.dfds[part]["lock"]:
+                    if self.index.get(tid) != (part, pos):
+                        continue
+                    self._unpackAt(part, pos, instance, fields, self.index.getSize(tid))
+                    break
 
         instance._tlvdb_id = tid
         instance._tlvdb_clean = True
         return instance
 
+    def _unpackAt(self, part, pos, instance, fields=None, size=None):
+        """
+        Unpack the instance from the partition file, reading exactly ``size``
+        bytes if known, else in as few calls as possible. Caller is
+        responsible of locking
+        """
+        def decoder(buf, offset):
+            if fields is not None:
+                # Projections stop early, the end does not matter
+                instance.unpackFrom(buf, offset, fields)
+                return instance, offset
+            instance.unpackFrom(buf, offset)
+            return instance, offset + instance._tlvdb_size
+
+        fd = self.dfds[part]["fd"]
+        if size:
+            fd.seek(pos)
+            try:
+                return decoder(fd.read(size), 0)[0]
+            except TlvShortBufferError:
+                lg.warning("Entry at %d of partition %d is larger than %d" % (pos, part, size))
+
+        return tlv.readBuffered(fd, pos, decoder)[0]
+
+    def _readMapped(self, tid, instance, fields=None):
+        """
+        Decode from the partition map without locking. Writers bump the
+        partition sequence around anything that can change the file, so retry
+        if it changed (or the item moved) while we were decoding
+        """
+        while True:
+            part, pos = self.index.get(tid)
+            if part is False:
+                raise IndexNotFoundError("Could not find item with id=%d" % tid)
+
+            p = self.dfds[part]
+            seq = p["seq"]
+            m = p["map"]
+
+            if seq % 2 or p["dirty"] or m is None or pos >= len(m):
+                with p["lock"]:
+                    self._remap(part)
+                    m = p["map"]
+                    if m is None or pos >= len(m):
+                        raise IndexNotFoundError("Item with id=%d is beyond partition %d" % (tid, part))
+                continue
+
+            try:
+                if fields is None:
+                    instance.unpackFrom(m, pos)
+                else:
+                    instance.unpackFrom(m, pos, fields)
+            except Exception:
+                if p["seq"] == seq and p["map"] is m:
+                    raise
+                continue
+
+            if p["seq"] == seq and p["map"] is m and self.index.get(tid) == (part, pos):
+                return instance
+
+    def read_many(self, ids, klass=TLV):
+        """
+        Read many objects at once. Positions are resolved first and the
+        records are read partition by partition in offset order, coalescing
+        neighbours into large sequential reads.
+
+        :returns: list of instances in the requested order
+        """
+        ids = list(ids)
+        found = dict(self.iread_many(ids, klass))
+        return [found[tid] for tid in ids]
+
+    def iread_many(self, ids, klass=TLV):
+        """
+        Like read_many() but streams ``(id, instance)`` pairs in storage
+        order, holding only one coalesced read in memory at a time
+        """
+        located = []
+        for tid in set(ids):
+            part, pos = self.index.get(tid)
+            if part is False:
+                raise IndexNotFoundError("Could not find item with id=%d" % tid)
+            located.append((part, pos, tid))
+
+        located.sort()
+        for found in self._readLocated(located, klass):
+            yield found
+
+    def scan(self, klass=TLV, partition=None, where=None):
+        """
+        Stream ``(id, instance)`` pairs of all the entries (or of one
+        partition) in physical order. The partitions are read sequentially in
+        large chunks, skipping the empty slots, and only one chunk is held in
+        memory at a time. Entries deleted during the scan are skipped.
+
+        :param where: ``{key: value or callable}`` filter on the top level
+            keys of dict entries, checked on the raw bytes so that only
+            matching entries get decoded. Callables get the decoded value
+            (strings as bytes)
+        """
+        tests = tlv.predicates(where) if where else None
+        parts = range(0, len(self.dfds)) if partition is None else [partition]
+        for part in parts:
+            located = [(part, pos, tid) for pos, tid in self.index.entries(part)]
+            for found in self._readLocated(located, klass, missing_ok=True, tests=tests):
+                yield found
+
+    def _readLocated(self, located, klass, missing_ok=False, tests=None):
+        """
+        Read sorted (part, pos, tid) entries with coalesced reads, yielding
+        ``(id, instance)`` for those that pass ``tests`` (see tlv.predicates())
+        """
+        for part, run in self._runs(located):
+            start = run[0][0]
+            end = run[-1][0] + tlv.READ_CHUNK
+
+            with self.dfds[part]["lock"]:
+                # Entries only move under this lock: find those that moved
+                # in the meantime
+                moved = [tid for pos, tid in run if self.index.get(tid) != (part, pos)]
+
+                fd = self.dfds[part]["fd"]
+                fd.seek(start)
+                buf = fd.read(end - start)
+
+            for pos, tid in run:
+                record, offset = buf, pos - start
+
+                # Also when it changed since the read (the caller may be slow)
+                if tid in moved or self.index.get(tid) != (part, pos):
+                    record, offset = self._readRaw(tid, missing_ok), 0
+                    if record is None:
+                        continue
+
+                try:
+                    instance = self._decodeMatching(record, offset, klass, tests)
+                except TlvShortBufferError:
+                    # The last record spills over the read
+                    record = self._readRaw(tid, missing_ok)
+                    if record is None:
+                        continue
+                    instance = self._decodeMatching(record, 0, klass, tests)
+
+                if instance is None:
+                    continue
+
+                instance._tlvdb_id = tid
+                instance._tlvdb_clean = True
+                yield tid, instance
+
+    def _decodeMatching(self, buf, offset, klass, tests):
+        """
+        Decode the record at ``offset`` if it passes ``tests``, else None
+        """
+        if tests is not None and not tlv.matches(buf, offset, tests):
+            return None
+
+        instance = klass()
+        instance.unpackFrom(buf, offset)
+        return instance
+
+    def _readRaw(self, tid, missing_ok=False):
+        """
+        Read the encoded bytes of an entry, or None if it is gone and
+        ``missing_ok``
+        """
+        while True:
+            part, pos = self.index.get(tid)
+            if part is False:
+                if missing_ok:
+                    return None
+                raise IndexNotFoundError("Could not find item with id=%d" % tid)
+
+            with self.dfds[part]["lock"]:
+                if self.index.get(tid) != (part, pos):
+                    continue
+                return self._rawAt(part, pos, self.index.getSize(tid))
+
+    def _rawAt(self, part, pos, size=None):
+        """
+        The encoded bytes of the entry at ``pos``, of ``size`` bytes if known.
+        Caller is responsible of locking
+        """
+        fd = self.dfds[part]["fd"]
+        if size:
+            fd.seek(pos)
+            return fd.read(size)
+
+        def sizer(buf, offset):
+            end = tlv.skip(buf, offset)
+            return buf[offset:end], end
+
+        return tlv.readBuffered(fd, pos, sizer)[0]
+
+    def _runs(self, located):
+        """
+        Split sorted (part, pos, tid) entries into (part, [(pos, tid), ...])
+        runs that are worth reading in one go
+        """
+        run = []
+        for part, pos, tid in located:
+            if run and (part != run_part or pos - run[-1][0] > READ_MANY_GAP or
+                    pos - run[0][0] > READ_MANY_SPAN):
+                yield run_part, run
+                run = []
+
+            run_part = part
+            run.append((pos, tid))
+
+        if run:
+            yield run_part, run
+
     def delete(self, tid, klass=None):
         """
         Delete an entry. If class is given, the deleted entry will be returned
         """
-        # This will lock the index for reading...
-        part, oldpos = self.index.delete(tid)
+        # Hold the index until the free space is recorded, vacuum could
+        # otherwise move things under our feet
+        with self.index.lock:
+            size = self.index.getSize(tid)
+            part, oldpos = self.index.delete(tid)
 
-        if part is False:
-            return False
+            if part is False:
+                return False
 
-        # we have deleted, check if we should return the old entry...
-        ret = True
-        if klass:
-            instance = klass()
+            self._unindex(tid)
 
-            # Lock and load
-            with self.dfds[part]["lock"]:
-                self.dfds[part]["fd"].seek(oldpos)
-                ret = instance.unpack(self.dfds[part]["fd"])
+            # we have deleted, check if we should return the old entry...
+            ret = True
+            if klass:
+                instance = klass()
+
+                # Lock and load
+                with self.dfds[part]["lock"]:
+                    ret = self._unpackAt(part, oldpos, instance, size=size)
 
-        # Handle index
-        self._handleEmptying(part, oldpos)
+            # Handle index
+            self._handleEmptying(part, oldpos, size)
 
         # In any case, flush index
-        if self.in_trance is False:
-            self.index.flush()
+        self._commit([])
 
         return ret
 
-    def update(self, obj):
+    def _checkWhole(self, obj):
+        """
+        Only objects read as a whole can be written back
+        """
         if not hasattr(obj, "_tlvdb_id"):
             raise WrongInstanceError()
+        if getattr(obj, "_tlvdb_fields", None) is not None:
+            raise WrongInstanceError("Object with id=%d was read with fields=%s only" %
+                (obj._tlvdb_id, obj._tlvdb_fields))
 
-        # Read original object
-        old = self.read(obj._tlvdb_id)
-
-        # get old index
-        part, oldpos = self.index.get(obj._tlvdb_id)
-        if not oldpos:
-            raise IndexNotFoundError("Object with id=%d not found" % obj._tlvdb_id)
+    def update(self, obj):
+        """
+        Write the object back. It is overwritten in place if it still fits in
+        the stored size of the old record, which is neither read nor packed
+        again. The index is only touched if the entry moves or shrinks
+        """
+        self._checkWhole(obj)
+        tid = obj._tlvdb_id
 
         new_data = obj.pack()
-        old_data = old.pack()
-
         datalen = len(new_data)
 
-        # See if we can fit it!
-        pos = -1
-        with self.dfds[part]["lock"]:
-            if datalen <= len(old_data):
+        # Compare and write without anyone moving the object
+        with self.index.lock:
+            part, oldpos = self.index.get(tid)
+            if part is False:
+                raise IndexNotFoundError("Object with id=%d not found" % tid)
+
+            old_size = self.index.getSize(tid)
+            if old_size is None:
+                with self.dfds[part]["lock"]:
+                    old_size = self._sizeAt(part, oldpos)
+
+            # See if we can fit it!
+            pos = -1
+            if datalen <= old_size:
                 lg.debug("Update: Object is fitting in its old place")
                 pos = oldpos
+
+                # Give back what we do not use anymore
+                if self.backfill is True and datalen < old_size:
+                    self.index.setEmpty(part, pos + datalen, old_size - datalen)
             else:
                 lg.debug("Update: Object is NOT fitting")
-                pos = self._findAGoodPossiotion(part, datalen)
-                self._handleEmptying(part, oldpos)
+                self._handleEmptying(part, oldpos, old_size)
 
-                # If we append, remember the partitions last byte
-                if self.dfds[part]["last"] == pos:
-                    self.dfds[part]["last"] += datalen
+            with self.dfds[part]["lock"]:
+                if pos == -1:
+                    pos = self._findAGoodPossiotion(part, datalen)
+
+                    # If we append, remember the partitions last byte
+                    if self._getDataFileEnd(part) == pos:
+                        self.dfds[part]["last"] += datalen
+
+                self._writeData(part, pos, new_data)
+
+                # Update the index (readers check it under this lock)
+                if datalen != old_size:
+                    self.index.update(part, tid, pos, datalen)
+
+            self._indexObject(tid, obj)
+
+        self._commit([part], index=datalen != old_size)
+
+    def create_many(self, packables):
+        """
+        Create many entries at once: everything is encoded into one buffer,
+        the IDs are reserved in one step and the data hit the partition with
+        a single write.
+
+        :returns: list of the new IDs, in the given order
+        """
+        packables = list(packables)
+        buf = bytearray()
+        offsets = []
+        for packable in packables:
+            offsets.append(len(buf))
+            buf += packable.pack()
+
+        if not offsets:
+            return []
+
+        first = self.index.reserve(len(offsets))
+        part = self.policy.select(self, first, len(buf))
+
+        with self.dfds[part]["lock"]:
+            pos = self._getDataFileEnd(part)
+            self._writeData(part, pos, buf)
+            self.dfds[part]["last"] += len(buf)
+
+            ends = offsets[1:] + [len(buf)]
+            self.index.createMany(part,
+                [(first + i, pos + off, end - off) for i, (off, end) in enumerate(zip(offsets, ends))])
+
+        for i, packable in enumerate(packables):
+            self._indexObject(first + i, packable)
+        self._commit([part])
+
+        return list(range(first, first + len(offsets)))
+
+    def update_many(self, objs):
+        """
+        Update many objects at once. Objects that still fit are written in
+        place, the rest are appended to their partition with a single write.
+        The index and the data are flushed once at the end
+        """
+        objs = list(objs)
+        with self.index.lock:
+            # part -> (buffer, [(tid, offset in buffer)])
+            moved = {}
+            touched = set()
+
+            for obj in objs:
+                self._checkWhole(obj)
+
+                part, oldpos = self.index.get(obj._tlvdb_id)
+                if part is False:
+                    raise IndexNotFoundError("Object with id=%d not found" % obj._tlvdb_id)
+
+                new_data = obj.pack()
+                datalen = len(new_data)
+                old_size = self.index.getSize(obj._tlvdb_id)
+                if old_size is None:
+                    with self.dfds[part]["lock"]:
+                        old_size = self._sizeAt(part, oldpos)
+
+                touched.add(part)
+                if datalen <= old_size:
+                    with self.dfds[part]["lock"]:
+                        self._writeData(part, oldpos, new_data)
+                        if datalen != old_size:
+                            self.index.update(part, obj._tlvdb_id, oldpos, datalen)
+
+                    # Give back what we do not use anymore
+                    if self.backfill is True and datalen < old_size:
+                        self.index.setEmpty(part, oldpos + datalen, old_size - datalen)
+                else:
+                    self._handleEmptying(part, oldpos, old_size)
+                    buf, entries = moved.setdefault(part, (bytearray(), []))
+                    entries.append((obj._tlvdb_id, len(buf), datalen))
+                    buf += new_data
+
+            for part, (buf, entries) in moved.items():
+                with self.dfds[part]["lock"]:
+                    pos = self._getDataFileEnd(part)
+                    self._writeData(part, pos, buf)
+                    self.dfds[part]["last"] += len(buf)
+
+                    for tid, off, size in entries:
+                        self.index.update(part, tid, pos + off, size)
+
+            for obj in objs:
+                self._indexObject(obj._tlvdb_id, obj)
+            self._commit(touched)
+
+    def delete_many(self, tids):
+        """
+        Delete many entries with a single index flush
+
+        :returns: list of the IDs that were actually deleted
+        """
+        deleted = []
+        with self.index.lock:
+            touched = set()
+            for tid in tids:
+                size = self.index.getSize(tid)
+                part, oldpos = self.index.delete(tid)
+                if part is False:
+                    continue
 
+                self._unindex(tid)
+                self._handleEmptying(part, oldpos, size)
+                touched.add(part)
+                deleted.append(tid)
 
-            # No transaction support since we are not writing in a continues blocks
-            if not pos: print(pos)
-            self.dfds[part]["fd"].seek(pos)
-            self.dfds[part]["fd"].write(new_data)
-            self.dfds[part]["fd"].flush()
+            if deleted:
+                self._commit(touched)
 
-        # Update the index
-        self.index.update(part, obj._tlvdb_id, pos)
+        return deleted
+
+    def _commit(self, parts, index=True):
+        """
+        Flush the index (``index`` False: only the secondary ones) and the
+        given partitions, unless in a transaction. With group commit the
+        commit thread does it for many writers at once, see
+        startGroupCommit(). Caller must not hold locks
+        """
+        if self.in_trance is True:
+            return
+
+        committer = self.committer
+        if committer is not None:
+            return committer.commit(parts)
+
+        if index:
+            self._flushIndex()
+        else:
+            for sec in list(self.secondary.values()):
+                sec.flush()
+        for part in parts:
+            with self.dfds[part]["lock"]:
+                self._flushData(part)
+
+    def _sync(self, parts, fsync=False):
+        """
+        Flush the indexes and the given partitions, then push them to the disk
+        if ``fsync``. Caller must not hold locks
+        """
+        self._flushIndex()
+        for part in parts:
+            with self.dfds[part]["lock"]:
+                self._flushData(part)
+                if fsync:
+                    os.fsync(self.dfds[part]["fd"].fileno())
+
+        if fsync:
+            with self.index.lock:
+                os.fsync(self.ifd.fileno())
+                os.fsync(self.jfd.fileno())
+            for sec in list(self.secondary.values()):
+                with sec.lock:
+                    os.fsync(sec.fd.fileno())
+
+    def _flushIndex(self):
+        """
+        Persist the primary and the secondary indexes
+        """
         self.index.flush()
+        for sec in list(self.secondary.values()):
+            sec.flush()
+
+    def _indexObject(self, tid, obj):
+        """
+        Update the secondary index of the object's class, if it has
+        ``indexed`` attributes
+        """
+        indexed = getattr(type(obj), "indexed", None)
+        if not indexed:
+            return
+
+        name = type(obj).__name__
+        sec = self.secondary.get(name)
+        if sec is None:
+            with self.lock:
+                sec = self.secondary.get(name)
+                if sec is None:
+                    path = "%s/%s.%s.sdx" % (self.dirname, self.basename, name)
+                    sec = self.secondary[name] = SecondaryIndex(util.create_open(path))
+
+        sec.set(tid, dict((attr, getattr(obj, attr, None)) for attr in indexed))
+
+    def _unindex(self, tid):
+        for sec in list(self.secondary.values()):
+            sec.remove(tid)
+
+    def find(self, klass, **criteria):
+        """
+        Objects of ``klass`` whose attributes equal the given values, using
+        the secondary index of the ``indexed`` ones (at least one is
+        required). The rest of the criteria are checked on the read objects
+        """
+        indexed = [attr for attr in criteria if attr in getattr(klass, "indexed", [])]
+        if not indexed:
+            raise NotIndexedError("None of %s is indexed by %s" % (list(criteria), klass.__name__))
+
+        sec = self.secondary.get(klass.__name__)
+        if sec is None:
+            return []
+
+        ids = None
+        for attr in indexed:
+            found = sec.find(attr, criteria[attr])
+            ids = found if ids is None else ids & found
+
+        rest = [attr for attr in criteria if attr not in indexed]
+        return [obj for obj in self.read_many(sorted(ids), klass)
+            if all(SecondaryIndex.key(getattr(obj, attr, None)) == SecondaryIndex.key(criteria[attr])
+                for attr in rest)]
+
+    def range(self, klass, attr, lo=None, hi=None):
+        """
+        Objects of ``klass`` with ``lo <= attr < hi``, ordered by ``attr``.
+        None means unbounded
+        """
+        if attr not in getattr(klass, "indexed", []):
+            raise NotIndexedError("%s is not indexed by %s" % (attr, klass.__name__))
+
+        sec = self.secondary.get(klass.__name__)
+        if sec is None:
+            return []
+
+        return self.read_many(sec.range(attr, lo, hi), klass)
+
+    def _sizeAt(self, part, pos):
+        """
+        Size of the TLV stored at ``pos``. Caller is responsible of locking
+        """
+        return tlv.readBuffered(self.dfds[part]["fd"], pos,
+            lambda buf, offset: (None, tlv.skip(buf, offset)))[1]
 
-    def _handleEmptying(self, part, oldpos):
+    def _handleEmptying(self, part, oldpos, size=None):
         """
-        Called when something is moved or deleted
+        Called when something of ``size`` bytes (None: unknown) is moved or
+        deleted
         """
         if self.backfill is True:
             # Log with detail
-            with self.dfds[part]["lock"]:
-                tmp_instance = TLV(fd=self.dfds[part]["fd"])
-                del_size = tmp_instance.size(oldpos)
+            del_size = size
+            if del_size is None:
+                with self.dfds[part]["lock"]:
+                    del_size = self._sizeAt(part, oldpos)
 
             self.index.setEmpty(part, oldpos, del_size)
         else:
@@ -229,8 +856,17 @@ class TlvStorage(object):
 
 
     def close(self):
+        if self.compactor is not None:
+            self.compactor.stop()
+        if self.committer is not None:
+            self.committer.stop()
+            self.committer = None
         self.index.close()
+        for sec in self.secondary.values():
+            sec.close()
         for fd in self.dfds:
+            if fd["map"] is not None:
+                fd["map"].close()
             fd["fd"].close()
 
     def vacuum(self, force=False):
@@ -249,110 +885,444 @@ class TlvStorage(object):
             raise AlreadyInTranceError("In the middle of transaction, vacuum was called!")
 
         # Lock everything
-        self.lock.acquire()
-        self.index.lock.acquire()
-
+        with self.lock, self.index.lock:
+            # Iterate, read, write
+            for part, cont in enumerate(self.index.partitions):
+                # Lock our partition pointers, then the partition (index
+                # level): the same order as create()
+                with self.dfds[part]["lock"], cont["lock"]:
+                    empty = len(cont["empty"])
+                    items = cont["items"]
+                    lg.info("Vacuum: partition %d, status %d/%d" % (part, empty, items))
+                    if (empty == 0 and not force):
+                        lg.info("Skipping ... partition is clean")
+                        continue
+
+                    if items and self.vacuum_thres > empty/items:
+                        lg.info("Skipping ... partition less than threshold (thres=%f <> frag=%f)" % (self.vacuum_thres, empty/items))
+                        continue
+
+                    self._vacuumPartition(part, cont)
+
+    def _vacuumPartition(self, part, cont):
+        """
+        Copy all live items of a partition to a swap file and swap it with the
+        real one. Caller holds all the locks
+        """
         # Start at the beginning
         new_pos = 0
 
-        # Iterate, read, write
-        for part, cont in enumerate(self.index.partitions):
-            # Lock that partition (index level)
-            cont["lock"].acquire()
-
-            empty = len(cont["empty"])
-            items = cont["items"]
-            lg.info("Vacuum: partition %d, status %d/%d" % (part, empty, items))
-            if (empty == 0 and not force):
-                lg.info("Skipping ... partition is clean")
-                cont["lock"].release()
-                continue
+        # Positions are about to change, keep mapped readers out
+        self.dfds[part]["seq"] += 1
 
-            if items and self.vacuum_thres > empty/items:
-                lg.info("Skipping ... partition less than threshold (thres=%f <> frag=%f)" % (self.vacuum_thres, empty/items))
-                cont["lock"].release()
-                continue
+        # Whatever compact() was doing is moot now
+        self.dfds[part].pop("compact", None)
 
+        # Create swap (not named as a partition, those may be added later)
+        lg.info("Vacuum: Starting Partition %d" % part)
+        swap_path = "%s/%s.%d.swp" % (self.dirname, self.basename, part)
+        swap_fd = open(swap_path, "wb", buffering=0)
 
-            # Create swap
-            swap_part = len(self.dfds)
-            lg.info("Vacuum: Starting Partition %d" % swap_part)
-            swap_path = "%s/%s.%d.dat" % (self.dirname, self.basename, swap_part)
-            self.dfds.append({})
-            self.dfds[swap_part]["last"] = 0
-            self.dfds[swap_part]["lock"] = Lock()
-            self.dfds[swap_part]["fd"] = open(swap_path, "wb")
+        lg.info(" ... Vacuum: Starting ")
 
-            lg.info(" ... Vacuum: Starting ")
+        # Raw copies straight from the file: flush whatever remainder first
+        self._flushData(part)
 
-            # lock our partition pointers
-            self.dfds[part]["lock"].acquire()
-
-            # Lock swap
-            self.dfds[swap_part]["lock"].acquire()
+        # Coalesce neighbours into [start, length] runs, copied as they are
+        runs = []
+        for pos, tid, size in self._sizes(part, self.index.entries(part)):
+            if runs and runs[-1][0] + runs[-1][1] == pos:
+                runs[-1][1] += size
+            else:
+                runs.append([pos, size])
 
-            for tid, pos in cont["index"].items():
-                if pos == 0:
-                    lg.warning("Skipping empty/deleted index?")
-                    self.dfds[part]["lock"].release()
-                    continue
+            # In memory update of the index
+            lg.debug("Updating index with %d=>%d" % (tid, new_pos))
+            self.index.relocate(part, tid, new_pos)
 
-                tmptlv = TLV(fd=self.dfds[part]["fd"])
-                # REMEMBER: pos==0 means empty!
-                lg.debug("Reading from pos=%d" % (pos-1))
-                data_len = tmptlv.read(pos-1)
-                lg.debug("Got data length=%d: %s" % (data_len, tmptlv))
+            new_pos += size
 
-                self.dfds[swap_part]["fd"].write(tmptlv.pack())
+        src = self.dfds[part]["fd"].fileno()
+        for pos, length in runs:
+            util.copy_range(src, swap_fd.fileno(), pos, length)
+        lg.info(" ... Vacuum: copied %d bytes in %d runs" % (new_pos, len(runs)))
 
-                # In memory update of the index
-                lg.debug("Updating index with %d=>%d (with +1 offset)" % (tid, new_pos + 1))
-                cont["index"][tid] = new_pos + 1
+        # Clean up temp partition
+        swap_fd.close()
 
-                new_pos += data_len
+        # Clean up real partition
+        self.dfds[part]["fd"].close()
+        if "last" in self.dfds[part]:
+            del self.dfds[part]["last"]
 
-            # Flash whatever remainder
-            self.dfds[part]["fd"].flush()
+        # DANGEROUS PART: SHOULD NOT BE INTERUPTED
+        orig_part = "%s/%s.%d.dat" % (self.dirname, self.basename, part)
 
-            # Clean up temp partition
-            self.dfds[swap_part]["fd"].flush()
-            self.dfds[swap_part]["fd"].close()
+        # with DelayedInterrupt(signal.SIGINT):
+        try:
+            os.rename(swap_path, orig_part)
+        except:
+            lg.critical("Failed to move packed parition...")
+            self.index.reload()
+        else:
+            lg.info(" ...Done ")
+            cont["empty"] = FreeSpace()
+            # Positions were changed in place, rewrite the whole index
+            self.index.checkpoint()
+        finally:
+            # Reopen real partition
+            self.dfds[part]["fd"] = util.create_open(orig_part, "r+b", buffering=IO_BUFFER_LEN)
+            self.dfds[part]["dirty"] = False
+            self.dfds[part]["map"] = None
+            self.dfds[part]["seq"] += 1
+
+    def _sizes(self, part, entries):
+        """
+        (position, id, size) of sorted (position, id) entries. The sizes not
+        in the index are parsed (without decoding) from large sequential
+        reads. Caller is responsible of locking
+        """
+        fd = self.dfds[part]["fd"]
+        buf = b""
+        start = 0
+        sized = []
+        for pos, tid in entries:
+            size = self.index.getSize(tid)
+            if size is not None:
+                sized.append((pos, tid, size))
+                continue
 
-            # Release swap... all done for this partions (swap is per-part)
-            self.dfds[swap_part]["lock"].release()
+            try:
+                size = tlv.skip(buf, pos - start) - (pos - start)
+            except TlvShortBufferError:
+                fd.seek(pos)
+                buf = fd.read(READ_MANY_SPAN)
+                start = pos
+                try:
+                    size = tlv.skip(buf, 0)
+                except TlvShortBufferError:
+                    # Larger than a read
+                    size = self._sizeAt(part, pos)
+            sized.append((pos, tid, size))
+        return sized
+
+    def _measure(self):
+        """
+        Store the sizes of the entries of an index upgraded from a version
+        without them, reading each partition sequentially once
+        """
+        lg.info("Measuring the entries of the upgraded index")
+        for part in range(0, len(self.dfds)):
+            with self.dfds[part]["lock"]:
+                for pos, tid, size in self._sizes(part, self.index.entries(part)):
+                    self.index.setSize(tid, size)
 
-            del self.dfds[swap_part]
+        self.index.migrated = False
+        self.index.checkpoint()
 
-            # Clean up real partition
-            self.dfds[part]["fd"].close()
-            if "last" in self.dfds[part]:
-                del self.dfds[part]["last"]
+    def compact(self, time_budget=None, io_budget=None, max_bytes=COMPACT_CHUNK):
+        """
+        Online vacuum: slide the live entries of the partitions over their
+        empty slots in steps of at most ``max_bytes``. Each step holds the
+        locks only while it moves one run of neighbouring entries, readers
+        use the old positions until the step commits the new ones. Entries
+        are only moved to space that is already free, so a crash leaves
+        either position valid. The tail is truncated at the end (except with
+        mmap_reads, appends reuse it then). Empty slots are not reused while
+        a partition is compacted.
+
+        Call it repeatedly (see startCompactor()) until it returns True.
+
+        :param float time_budget: stop after about this many seconds
+        :param int io_budget: stop after about this many bytes read/written
+        :returns: True when every partition is compact
+        """
+        if self.in_trance:
+            raise AlreadyInTranceError("In the middle of transaction, compact was called!")
 
-            # DANGEROUS PART: SHOULD NOT BE INTERUPTED
-            orig_part = "%s/%s.%d.dat" % (self.dirname, self.basename, part)
+        deadline = None if time_budget is None else time.time() + time_budget
+        spent = 0
+        for part, cont in enumerate(self.index.partitions):
+            while True:
+                if deadline is not None and time.time() >= deadline:
+                    return False
+                if io_budget is not None and spent >= io_budget:
+                    return False
+
+                # Same order as vacuum()
+                with self.lock, self.index.lock, self.dfds[part]["lock"], cont["lock"]:
+                    io, done = self._compactStep(part, cont, max_bytes)
+                spent += io
+                if done:
+                    break
+
+        return True
+
+    def _compactStep(self, part, cont, max_bytes):
+        """
+        Move one run of entries down to the first empty slot. The pass state
+        is the write position and the (position, id) entries after it.
+        Caller holds all the locks.
 
-            # with DelayedInterrupt(signal.SIGINT):
+        :returns: (bytes read and written, whether the partition is compact)
+        """
+        p = self.dfds[part]
+        state = p.get("compact")
+        if state is None:
+            if len(cont["empty"]) == 0:
+                return 0, True
+
+            start = min(cont["empty"])
+            lg.info("Compact: starting partition %d at %d" % (part, start))
+            state = p["compact"] = {
+                "pos": start,
+                "todo": deque(e for e in self.index.entries(part) if e[0] >= start)
+            }
+
+        todo = state["todo"]
+        w = state["pos"]
+
+        # Skip what was deleted or moved since
+        while todo and self.index.get(todo[0][1]) != (part, todo[0][0]):
+            todo.popleft()
+
+        if not todo:
+            return self._compactTail(part, state)
+
+        # The run of neighbours at p0 that fits in the free gap below it
+        p0 = todo[0][0]
+        gap = p0 - w
+        fd = p["fd"]
+        fd.seek(p0)
+        buf = fd.read(min(gap, max_bytes) if gap else max_bytes)
+        io = len(buf)
+
+        run = []
+        n = 0
+        for pos, tid in todo:
+            if pos != p0 + n or self.index.get(tid) != (part, pos):
+                break
             try:
-                os.rename(swap_path, orig_part)
-            except:
-                lg.critical("Failed to move packed parition...")
-                self.index.reload()
-            else:
-                lg.info(" ...Done ")
-                cont["empty"] = {}
-                self.index.flush()
-            finally:
-                # Reopen real partition
-                self.dfds[part]["fd"] = util.create_open(orig_part)
+                end = tlv.skip(buf, n)
+            except TlvShortBufferError:
+                break
+            run.append(tid)
+            n = end
+
+        if not run:
+            # Even the first one does not fit in the read, take it alone
+            buf = self._rawAt(part, p0, self.index.getSize(todo[0][1]))
+            run = [todo[0][1]]
+            n = len(buf)
+            io += n
+
+        for tid in run:
+            todo.popleft()
+
+        if gap == 0:
+            # Already in place
+            state["pos"] = w + n
+            return io, False
+
+        if n <= gap:
+            dest = w
+            state["pos"] = w + n
+        else:
+            # Bigger than the gap: out of the way to the end, its place
+            # widens the gap
+            dest = self._getDataFileEnd(part)
+            p["last"] += n
+
+        self._writeData(part, dest, buf[0:n])
+        self._flushData(part)
+
+        offset = 0
+        for tid in run:
+            size = tlv.skip(buf, offset) - offset
+            self.index.update(part, tid, dest + offset)
+            offset += size
+
+        if dest == w:
+            self.index.clearEmpty(part, w, p0)
+            self.index.setEmpty(part, w + n, gap)
+        else:
+            self.index.setEmpty(part, p0, n)
+        self.index.flush()
 
-            # Time to release, this partition is done
-            cont["lock"].release()
-            self.dfds[part]["lock"].release()
+        return io + n, False
+
+    def _compactTail(self, part, state):
+        """
+        Everything up to the write position is compact: start over with the
+        entries added since, or cut the free tail and finish the pass
+        """
+        w = state["pos"]
+        fresh = [e for e in self.index.entries(part) if e[0] >= w]
+        if fresh:
+            state["todo"] = deque(fresh)
+            return 0, False
+
+        p = self.dfds[part]
+        self.index.clearEmpty(part, w, tlv.Q)
+        self._flushData(part)
+        if self.mmap_reads is False:
+            # Mapped readers could fault past the end
+            p["fd"].truncate(w)
+        p["last"] = w
+        del p["compact"]
+        self.index.flush()
 
+        lg.info("Compact: partition %d done, %d bytes" % (part, w))
+        # Deletes behind the write position need another pass
+        return 0, len(self.index.partitions[part]["empty"]) == 0
 
-        # Be free...
-        self.lock.release()
-        self.index.lock.acquire()
+    def startCompactor(self, interval=1.0, time_budget=0.1, io_budget=None):
+        """
+        Run compact() in a background thread with the given budget per call,
+        pausing ``interval`` seconds between the calls once everything is
+        compact. Stopped by close()
+        """
+        if self.compactor is None:
+            self.compactor = Compactor(self, interval, time_budget, io_budget)
+            self.compactor.start()
+        return self.compactor
+
+    def startGroupCommit(self, durability="flush", interval=0.005, batch=128):
+        """
+        Outside transactions, let a background thread flush the changes of
+        concurrent writers together: one index journal append, one flush of
+        every partition written and (``fsync``) one fsync per ``interval``
+        seconds or ``batch`` commits. Durability of a returning write:
+
+        - ``none``: not waited for, flushed within ``interval``
+        - ``flush``: handed to the OS
+        - ``fsync``: on the disk
+
+        Stopped by close()
+        """
+        if durability not in GroupCommitter.DURABILITY:
+            raise DurabilityError("Unknown durability %s" % durability)
+
+        if self.committer is None:
+            self.committer = GroupCommitter(self, durability, interval, batch)
+            self.committer.start()
+        return self.committer
 
     def getHeader(self):
+        self.index.header.items = self.index.countItems()
         return self.index.header
+
+
+class Compactor(threading.Thread):
+    """
+    Background thread calling TlvStorage.compact() with a time and/or I/O
+    budget per call
+    """
+
+    def __init__(self, storage, interval=1.0, time_budget=0.1, io_budget=None):
+        super(Compactor, self).__init__(name="tlvdb-compactor")
+        self.daemon = True
+        self.storage = storage
+        self.interval = interval
+        self.time_budget = time_budget
+        self.io_budget = io_budget
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                done = self.storage.compact(self.time_budget, self.io_budget)
+            except AlreadyInTranceError:
+                done = True
+            except Exception:
+                lg.exception("Compactor failed")
+                done = True
+
+            # Give the others a chance between the steps
+            self.stopped.wait(self.interval if done else 0.001)
+
+    def stop(self):
+        self.stopped.set()
+        if self is not threading.current_thread():
+            self.join()
+
+
+class GroupCommitter(threading.Thread):
+    """
+    Background thread flushing the storage for all the writers that committed
+    since its last round. Writers block on the Future of their commit
+    """
+    DURABILITY = ("none", "flush", "fsync")
+
+    def __init__(self, storage, durability="flush", interval=0.005, batch=128):
+        super(GroupCommitter, self).__init__(name="tlvdb-committer")
+        self.daemon = True
+        self.storage = storage
+        self.durability = durability
+        self.interval = interval
+        self.batch = batch
+        self.lock = threading.Lock()
+        self.waiting = []
+        self.parts = set()
+        self.closed = False
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        # Rounds done, for the curious
+        self.rounds = 0
+
+    def commit(self, parts):
+        """
+        Queue the partitions written and wait as the durability says
+        """
+        future = Future()
+        with self.lock:
+            queued = not self.closed
+            if queued:
+                self.waiting.append(future)
+                self.parts.update(parts)
+                if len(self.waiting) >= self.batch:
+                    self.wakeup.set()
+
+        if not queued:
+            # Stopped meanwhile, nobody else will do it
+            self.storage._sync(parts, self.durability == "fsync")
+            future.set_result(1)
+
+        if self.durability != "none":
+            future.result()
+        return future
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self._round()
+
+        self._round()
+
+    def _round(self):
+        with self.lock:
+            waiting, self.waiting = self.waiting, []
+            parts, self.parts = self.parts, set()
+
+        if not waiting:
+            return
+
+        try:
+            self.storage._sync(parts, self.durability == "fsync")
+        except Exception as e:
+            lg.exception("Group commit failed")
+            for future in waiting:
+                future.set_exception(e)
+        else:
+            self.rounds += 1
+            for future in waiting:
+                future.set_result(len(waiting))
+
+    def stop(self):
+        with self.lock:
+            self.closed = True
+        self.stopped.set()
+        self.wakeup.set()
+        if self is not threading.current_thread():
+            self.join()
@@ -11,6 +11,45 @@ def create_open(fname, mode="r+b", buffering=-1):
     return open(fname, "r+b", buffering=buffering)
 
 
+# Largest buffered copy step
+COPY_CHUNK = 1 << 20
+
+
+def copy_range(src, dst, pos, length):
+    """
+    Copy ``length`` bytes from ``pos`` of the ``src`` file descriptor to the
+    current position of ``dst``, in the kernel where possible
+    (copy_file_range, sendfile), else through a buffer
+    """
+    end = pos + length
+    for copier in (_copy_file_range, _sendfile, _copy_buffered):
+        try:
+            while pos < end:
+                copied = copier(src, dst, pos, end - pos)
+                if copied == 0:
+                    raise EOFError("Source ended at %d, %d bytes short" % (pos, end - pos))
+                pos += copied
+            return
+        except (AttributeError, OSError) as e:
+            if copier is _copy_buffered:
+                raise
+            # Not available here (platform, file system): go on with the next
+            logging.debug("%s failed: %s" % (copier.__name__, e))
+
+def _copy_file_range(src, dst, pos, count):
+    return os.copy_file_range(src, dst, count, pos)
+
+def _sendfile(src, dst, pos, count):
+    return os.sendfile(dst, src, pos, count)
+
+def _copy_buffered(src, dst, pos, count):
+    data = os.pread(src, min(count, COPY_CHUNK), pos)
+    view = memoryview(data)
+    while view:
+        view = view[os.write(dst, view):]
+    return len(data)
+
+
 # class based on: http://stackoverflow.com/a/21919644/487556
 class DelayedInterrupt(object):
     def __init__(self, signals):
@@ -10,11 +10,18 @@ from tlvdb.tlverrors import *
 
 dbindexfile = sys.argv[1]
 storage = TlvStorage(dbindexfile)
+
+if len(sys.argv) > 2:
+    # Just the given IDs
+    for i in sys.argv[2:]:
+        try:
+            print(" - %s: %s" % (i, storage.read(int(i))))
+        except IndexNotFoundError:
+            print(" - %s: not found" % i)
+    sys.exit(0)
+
 print(storage.index.header.getStrInfo())
 print(storage.index.getStrInfo())
-for i in range(storage.index.nextid-1, 0, -1):
-    try:
-        t = storage.read(i)
-        print(" - %d: %s" % (i, t))
-    except IndexNotFoundError:
-        pass
+for i, part, pos in storage.index.range():
+    t = storage.read(i)
+    print(" - %d: %s" % (i, t))